@@ -21,7 +21,7 @@ from rest_framework.generics import get_object_or_404
 from twilio.base.exceptions import TwilioRestException
 
 from api.views import SaveToRequestUser
-from emails.models import Profile, get_storing_phone_log
+from emails.models import Profile, get_storing_phone_log, increment_counters
 from emails.utils import incr_if_enabled
 
 from phones.models import (
@@ -512,9 +512,7 @@ def inbound_sms(request):
         status_callback=app.sms_status_callback,
         to=real_phone.number,
     )
-    relay_number.remaining_texts -= 1
-    relay_number.texts_forwarded += 1
-    relay_number.save()
+    increment_counters(relay_number, {"remaining_texts": -1, "texts_forwarded": 1})
     return response.Response(
         status=201,
         template_name="twiml_empty_response.xml",
@@ -547,8 +545,7 @@ def inbound_call(request):
     if inbound_contact:
         _check_and_update_contact(inbound_contact, "calls", relay_number)
 
-    relay_number.calls_forwarded += 1
-    relay_number.save()
+    increment_counters(relay_number, {"calls_forwarded": 1})
 
     # Note: TemplateTwiMLRenderer will render this as TwiML
     incr_if_enabled("phones_outbound_call")
@@ -575,8 +572,7 @@ def voice_status(request):
     if call_duration is None:
         raise exceptions.ValidationError("completed call data missing CallDuration")
     relay_number, _ = _get_phone_objects(called)
-    relay_number.remaining_seconds = relay_number.remaining_seconds - int(call_duration)
-    relay_number.save()
+    increment_counters(relay_number, {"remaining_seconds": -int(call_duration)})
     if relay_number.remaining_seconds < 0:
         info_logger.info(
             "phone_limit_exceeded",
@@ -650,18 +646,14 @@ def _handle_sms_reply(relay_number, real_phone, inbound_body):
         body=inbound_body,
         to=last_text_sender.inbound_number,
     )
-    relay_number.remaining_texts -= 1
-    relay_number.texts_forwarded += 1
-    relay_number.save()
+    increment_counters(relay_number, {"remaining_texts": -1, "texts_forwarded": 1})
 
 
 def _check_disabled(relay_number, contact_type):
     # Check if RelayNumber is disabled
     if not relay_number.enabled:
-        attr = f"{contact_type}_blocked"
         incr_if_enabled(f"phones_{contact_type}_global_blocked")
-        setattr(relay_number, attr, getattr(relay_number, attr) + 1)
-        relay_number.save()
+        increment_counters(relay_number, {f"{contact_type}_blocked": 1})
         return True
 
 
@@ -689,22 +681,17 @@ def _get_inbound_contact(relay_number, inbound_from):
 def _check_and_update_contact(inbound_contact, contact_type, relay_number):
     if inbound_contact.blocked:
         incr_if_enabled(f"phones_{contact_type}_specific_blocked")
-        contact_attr = f"num_{contact_type}_blocked"
-        setattr(
-            inbound_contact, contact_attr, getattr(inbound_contact, contact_attr) + 1
-        )
-        inbound_contact.save()
-        relay_attr = f"{contact_type}_blocked"
-        setattr(relay_number, relay_attr, getattr(relay_number, relay_attr) + 1)
-        relay_number.save()
+        increment_counters(inbound_contact, {f"num_{contact_type}_blocked": 1})
+        increment_counters(relay_number, {f"{contact_type}_blocked": 1})
         raise exceptions.ValidationError(f"Number is not accepting {contact_type}.")
 
-    inbound_contact.last_inbound_date = datetime.now(timezone.utc)
-    # strip trailing "s": InboundContact.last_inbound_type is max_length 4
-    inbound_contact.last_inbound_type = contact_type[:-1]
-    attr = f"num_{contact_type}"
-    setattr(inbound_contact, attr, getattr(inbound_contact, attr) + 1)
-    inbound_contact.save()
+    increment_counters(
+        inbound_contact,
+        {f"num_{contact_type}": 1},
+        last_inbound_date=datetime.now(timezone.utc),
+        # strip trailing "s": InboundContact.last_inbound_type is max_length 4
+        last_inbound_type=contact_type[:-1],
+    )
 
 
 def _validate_twilio_request(request):
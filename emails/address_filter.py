@@ -0,0 +1,198 @@
+"""
+A Bloom filter of the live relay addresses, to reject unknown recipients.
+
+Much of the inbound email is for relay addresses that never existed, or were
+deleted. A Bloom filter answers "definitely not a relay address" or "maybe a
+relay address" in a few bits per address, so these emails can be rejected
+without querying the RelayAddress and DeletedAddress tables.
+
+The filter is a snapshot, rebuilt periodically by the rebuild_address_filter
+command, and stored as bytes in the Django cache named by
+settings.RELAY_ADDRESS_FILTER_CACHE. That cache must be shared by the web and
+email processes, such as Redis. Processes keep a copy of the filter for
+RELAY_ADDRESS_FILTER_REFRESH_SECONDS.
+
+An address created after the snapshot is not in the filter. When an address
+is created, a key is added to the shared cache for longer than a snapshot can
+be used, so a "definitely not" answer is confirmed with a check for that key.
+Snapshots older than RELAY_ADDRESS_FILTER_MAX_AGE_SECONDS are not used.
+"""
+
+from hashlib import blake2b
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from emails.models import DOMAIN_CHOICES, RelayAddress, get_domains_from_settings
+
+logger = logging.getLogger("events")
+
+# The cache key of the filter snapshot
+FILTER_KEY = "relay-address-filter"
+# The prefix of the cache keys for addresses created after the snapshot
+ADDED_KEY_PREFIX = "relay-address-filter-added:"
+# Added keys outlive the snapshots by this many seconds, for clock skew
+ADDED_KEY_MARGIN_SECONDS = 300
+# Leave room in the filter for addresses created until the next rebuild
+CAPACITY_MARGIN = 1.1
+# The smallest capacity, so a small filter is not full of false positives
+MIN_CAPACITY = 1000
+
+_local_filter = None
+_local_fetched_at = None
+_local_lock = threading.Lock()
+
+
+class BloomFilter:
+    """A Bloom filter of strings, with a bytearray of bits."""
+
+    def __init__(self, size_bits, hash_count, bits=None):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        if bits is None:
+            bits = bytearray((size_bits + 7) // 8)
+        self.bits = bits
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """Create a filter sized for a number of items and false positive rate."""
+        capacity = max(capacity, 1)
+        size_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hash_count = max(1, round(size_bits / capacity * math.log(2)))
+        return cls(size_bits, hash_count)
+
+    def _positions(self, item):
+        # Double hashing, from the two halves of one digest
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size_bits
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+def _get_filter_cache():
+    alias = getattr(settings, "RELAY_ADDRESS_FILTER_CACHE", "")
+    return caches[alias] if alias else None
+
+
+def _max_age():
+    return settings.RELAY_ADDRESS_FILTER_MAX_AGE_SECONDS
+
+
+def build_address_filter():
+    """
+    Build a filter of the full addresses of all relay addresses.
+
+    Return is a dict suitable for storing in the cache.
+    """
+    built_at = time.time()
+    domain_names = get_domains_from_settings()
+    domain_values = {number: domain_names[name] for number, name in DOMAIN_CHOICES}
+    address_filter = BloomFilter.for_capacity(
+        max(round(RelayAddress.objects.count() * CAPACITY_MARGIN), MIN_CAPACITY),
+        settings.RELAY_ADDRESS_FILTER_ERROR_RATE,
+    )
+    count = 0
+    addresses = RelayAddress.objects.values_list("address", "domain")
+    for address, domain in addresses.iterator(chunk_size=10_000):
+        address_filter.add(f"{address}@{domain_values[domain]}")
+        count += 1
+    return {
+        "built_at": built_at,
+        "count": count,
+        "size_bits": address_filter.size_bits,
+        "hash_count": address_filter.hash_count,
+        "bits": bytes(address_filter.bits),
+    }
+
+
+def rebuild_address_filter():
+    """
+    Build the filter and store it in the cache.
+
+    Return is a dict suitable for logging context, or None if the filter is
+    turned off.
+    """
+    cache = _get_filter_cache()
+    if cache is None:
+        return None
+    data = build_address_filter()
+    cache.set(FILTER_KEY, data, _max_age())
+    return {
+        "count": data["count"],
+        "size_bytes": len(data["bits"]),
+        "hash_count": data["hash_count"],
+        "build_s": round(time.time() - data["built_at"], 3),
+    }
+
+
+def add_address_to_filter(full_address):
+    """Record an address created after the filter snapshot."""
+    cache = _get_filter_cache()
+    if cache is None:
+        return
+    cache.set(
+        ADDED_KEY_PREFIX + full_address, True, _max_age() + ADDED_KEY_MARGIN_SECONDS
+    )
+
+
+def _get_filter(cache):
+    """Return the filter snapshot, refreshing the local copy if due."""
+    global _local_filter, _local_fetched_at
+    now = time.time()
+    with _local_lock:
+        if (
+            _local_fetched_at is None
+            or now - _local_fetched_at >= settings.RELAY_ADDRESS_FILTER_REFRESH_SECONDS
+        ):
+            data = cache.get(FILTER_KEY)
+            _local_filter = None
+            if data is not None:
+                _local_filter = (
+                    data["built_at"],
+                    BloomFilter(data["size_bits"], data["hash_count"], data["bits"]),
+                )
+            _local_fetched_at = now
+        return _local_filter
+
+
+def address_is_absent(full_address):
+    """
+    Return True if the address is definitely not a relay address.
+
+    False means it may be a relay address, or that there is no usable filter.
+    """
+    cache = _get_filter_cache()
+    if cache is None:
+        return False
+    snapshot = _get_filter(cache)
+    if snapshot is None:
+        return False
+    built_at, address_filter = snapshot
+    if time.time() - built_at >= _max_age():
+        return False
+    if full_address in address_filter:
+        return False
+    return cache.get(ADDED_KEY_PREFIX + full_address) is None
+
+
+def clear_local_filter():
+    """Drop the local copy of the filter, to fetch it on the next check."""
+    global _local_filter, _local_fetched_at
+    with _local_lock:
+        _local_filter = None
+        _local_fetched_at = None
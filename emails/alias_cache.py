@@ -0,0 +1,120 @@
+"""
+A cache of the relay addresses that inbound emails are sent to.
+
+Each email resolves its recipient to a RelayAddress or DomainAddress. The
+cache maps the full recipient address to the identity of the address, so the
+next email to the same alias loads the address by primary key, instead of
+looking up the address and its deleted address hash, or locking the profile
+of a subdomain.
+
+Only facts that never change are cached: the address type, primary key, and
+user of an alias, and that a relay address was deleted, which can not be
+reused. Mutable fields like enabled and block_list_emails are read from the
+loaded address, because the email view updates its counters anyway. A cached
+primary key that no longer loads is treated as a miss.
+
+There is an in-process tier, and an optional shared tier in a Django cache,
+such as Redis, named by settings.RELAY_ALIAS_CACHE. Entries expire after
+settings.RELAY_ALIAS_CACHE_SECONDS, and 0 turns off the cache. Entries are
+removed when an address is created or deleted, by the signal handlers in
+emails/signals.py.
+"""
+
+from collections import OrderedDict, namedtuple
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from emails.utils import incr_if_enabled
+
+# The address types of cache entries
+RELAY = "relay"
+DOMAIN = "domain"
+DELETED = "deleted"
+
+# The most in-process entries, dropping the least recently used
+ALIAS_CACHE_SIZE = 10_000
+# Prefix of the keys in the shared cache
+SHARED_KEY_PREFIX = "relay-alias:"
+
+AliasEntry = namedtuple("AliasEntry", ("address_type", "id", "user_id"))
+
+_aliases: OrderedDict[str, tuple[AliasEntry, float]] = OrderedDict()
+_aliases_lock = threading.Lock()
+
+
+def _get_ttl():
+    return getattr(settings, "RELAY_ALIAS_CACHE_SECONDS", 0)
+
+
+def _get_shared_cache():
+    alias = getattr(settings, "RELAY_ALIAS_CACHE", "")
+    return caches[alias] if alias else None
+
+
+def get_alias(full_address):
+    """Return the cached AliasEntry for an address, or None."""
+    if _get_ttl() <= 0:
+        return None
+    entry = _get_entry(full_address)
+    incr_if_enabled("alias_cache_hit" if entry else "alias_cache_miss", 1)
+    return entry
+
+
+def _get_entry(full_address):
+    now = time.time()
+    with _aliases_lock:
+        cached = _aliases.get(full_address)
+        if cached is not None:
+            entry, expires_at = cached
+            if now < expires_at:
+                _aliases.move_to_end(full_address)
+                return entry
+            del _aliases[full_address]
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        return None
+    value = shared_cache.get(SHARED_KEY_PREFIX + full_address)
+    if value is None:
+        return None
+    entry = AliasEntry(*value)
+    _set_local(full_address, entry, now)
+    return entry
+
+
+def set_alias(full_address, address_type, id=None, user_id=None):
+    """Cache the identity of an address."""
+    ttl = _get_ttl()
+    if ttl <= 0:
+        return
+    entry = AliasEntry(address_type, id, user_id)
+    _set_local(full_address, entry, time.time())
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.set(SHARED_KEY_PREFIX + full_address, tuple(entry), ttl)
+
+
+def _set_local(full_address, entry, now):
+    with _aliases_lock:
+        _aliases[full_address] = (entry, now + _get_ttl())
+        _aliases.move_to_end(full_address)
+        while len(_aliases) > ALIAS_CACHE_SIZE:
+            _aliases.popitem(last=False)
+
+
+def invalidate_alias(full_address):
+    """Remove an address from the in-process and shared caches."""
+    with _aliases_lock:
+        _aliases.pop(full_address, None)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete(SHARED_KEY_PREFIX + full_address)
+
+
+def clear_alias_cache():
+    """Remove all addresses from the in-process cache."""
+    with _aliases_lock:
+        _aliases.clear()
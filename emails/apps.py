@@ -3,12 +3,11 @@ import logging
 import os
 import requests
 
-import boto3
-from botocore.config import Config
-
 from django.apps import AppConfig
 from django.conf import settings
 
+from .aws import create_aws_client
+
 
 logger = logging.getLogger("events")
 
@@ -34,15 +33,12 @@ class EmailsConfig(AppConfig):
     def __init__(self, app_name, app_module):
         super(EmailsConfig, self).__init__(app_name, app_module)
         try:
-            self.ses_client = boto3.client("ses", region_name=settings.AWS_REGION)
-            s3_config = Config(
-                region_name=settings.AWS_REGION,
-                retries={
-                    "max_attempts": 1,  # this includes the initial attempt to get the email
-                    "mode": "standard",
-                },
+            self.ses_client = create_aws_client("ses")
+            self.s3_client = create_aws_client(
+                "s3",
+                # this includes the initial attempt to get the email
+                retries={"max_attempts": 1},
             )
-            self.s3_client = boto3.client("s3", config=s3_config)
         except Exception:
             logger.exception("exception during SES connect")
 
@@ -0,0 +1,42 @@
+"""
+Create AWS (boto3) clients with shared settings.
+
+The clients for SES, S3, and SQS use the same connection pool size, timeouts,
+TCP keep-alive, and retry mode, from the AWS_* settings. The pool is sized for
+the threads of the email processing commands, and keeps connections open
+between messages, so the TLS handshakes are not repeated.
+"""
+
+import boto3
+from botocore.config import Config
+
+from django.conf import settings
+
+
+def aws_client_config(**overrides):
+    """
+    Return the botocore Config for an AWS client.
+
+    Keyword arguments override the Config options from settings. A retries
+    dict is merged with the retries settings.
+    """
+    options = {
+        "region_name": settings.AWS_REGION,
+        "max_pool_connections": settings.AWS_MAX_POOL_CONNECTIONS,
+        "connect_timeout": settings.AWS_CONNECT_TIMEOUT,
+        "read_timeout": settings.AWS_READ_TIMEOUT,
+        "tcp_keepalive": settings.AWS_TCP_KEEPALIVE,
+        "retries": {
+            "mode": settings.AWS_RETRY_MODE,
+            "max_attempts": settings.AWS_MAX_ATTEMPTS,
+        },
+    }
+    if "retries" in overrides:
+        options["retries"].update(overrides.pop("retries"))
+    options.update(overrides)
+    return Config(**options)
+
+
+def create_aws_client(service_name, **overrides):
+    """Create a boto3 client, with the config from aws_client_config()."""
+    return boto3.client(service_name, config=aws_client_config(**overrides))
@@ -0,0 +1,206 @@
+"""
+Benchmark tracker counting and removal on a synthetic email corpus.
+
+The corpus is newsletter-style HTML with paragraphs, images, and links, in a
+range of sizes and tracker densities. The tracker density is the fraction of
+links and images that point at a domain from the tracker lists. Each tracker
+function is timed on each email, and the results are written as JSON, so runs
+can be compared after a tracker list update or a matcher change.
+"""
+
+from datetime import datetime, timezone
+import json
+import logging
+import platform
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.utils import (
+    TRACKERS,
+    count_all_trackers,
+    count_tracker,
+    remove_trackers,
+)
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod"
+    " tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam"
+    " quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo"
+).split()
+PLAIN_DOMAINS = (
+    "example.com",
+    "shop.example.com",
+    "cdn.example.net",
+    "news.example.org",
+    "images.example.org",
+)
+FUNCTIONS = {
+    "remove_trackers": lambda html: remove_trackers(html),
+    "count_tracker": lambda html: count_tracker(html, TRACKERS.general),
+    "count_all_trackers": lambda html: count_all_trackers(html),
+}
+
+
+def generate_newsletter_html(size, tracker_density, rng):
+    """
+    Generate a newsletter-style HTML email body of about size bytes.
+
+    Arguments:
+    size - The target size of the body in bytes
+    tracker_density - The fraction of links and images using a tracker domain
+    rng - A random.Random instance, for a repeatable corpus
+    """
+    trackers = TRACKERS.general + TRACKERS.strict
+
+    def url(path):
+        if rng.random() < tracker_density:
+            domain = rng.choice(("", "www.", "click.", "open.")) + rng.choice(trackers)
+        else:
+            domain = rng.choice(PLAIN_DOMAINS)
+        return f"https://{domain}/{path}?id={rng.randrange(10**8)}"
+
+    def text(count):
+        return " ".join(rng.choice(WORDS) for _ in range(count))
+
+    parts = [
+        "<html><head><style>p {margin: 0 0 1em}</style></head>"
+        '<body><table width="100%"><tr><td>'
+        f'<img src="{url("logo.png")}" alt="Logo" width="200">'
+    ]
+    footer = (
+        f'<p><a href="{url("unsubscribe")}">Unsubscribe</a>'
+        f' | <a href="{url("preferences")}">Preferences</a></p>'
+        f'<img src="{url("open.gif")}" width="1" height="1">'
+        "</td></tr></table></body></html>"
+    )
+    length = len(parts[0]) + len(footer)
+    while length < size:
+        block = (
+            f"<h2>{text(6)}</h2>"
+            f'<img src="{url("story.jpg")}" alt="{text(3)}" width="600">'
+            f"<p>{text(60)}</p>"
+            f'<p><a href="{url("story")}" style="color: #0060df">{text(4)}</a></p>'
+        )
+        parts.append(block)
+        length += len(block)
+    parts.append(footer)
+    return "".join(parts)
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list."""
+    index = max(0, round(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = "Benchmark tracker counting and removal on a synthetic email corpus."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="5,50,250",
+            help="Comma-separated email sizes, in KB.",
+        )
+        parser.add_argument(
+            "--densities",
+            default="0,0.1,0.5",
+            help="Comma-separated fractions of links that are trackers.",
+        )
+        parser.add_argument(
+            "--emails",
+            type=int,
+            default=20,
+            help="Number of emails for each size and density.",
+        )
+        parser.add_argument(
+            "--functions",
+            default=",".join(FUNCTIONS),
+            help="Comma-separated tracker functions to benchmark.",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Random seed for the corpus."
+        )
+        parser.add_argument(
+            "--output", help="Path to write the JSON results. Omit to skip."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+            densities = [float(value) for value in options["densities"].split(",")]
+        except ValueError as e:
+            raise CommandError(f"Invalid sizes or densities: {e}") from e
+        functions = options["functions"].split(",")
+        unknown = set(functions) - set(FUNCTIONS)
+        if unknown:
+            raise CommandError(f"Unknown functions: {', '.join(sorted(unknown))}")
+        if options["emails"] < 1:
+            raise CommandError("--emails must be at least 1")
+
+        rng = random.Random(options["seed"])
+        results = []
+        # The tracker functions log a summary for each email
+        logging.disable(logging.INFO)
+        try:
+            for size_kb in sizes:
+                for density in densities:
+                    corpus = [
+                        generate_newsletter_html(size_kb * 1024, density, rng)
+                        for _ in range(options["emails"])
+                    ]
+                    for name in functions:
+                        result = self.run_benchmark(name, corpus)
+                        result.update({"size_kb": size_kb, "tracker_density": density})
+                        results.append(result)
+                        self.stdout.write(self.format_result(result))
+        finally:
+            logging.disable(logging.NOTSET)
+
+        if options["output"]:
+            data = {
+                "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "general_trackers": len(TRACKERS.general),
+                "strict_trackers": len(TRACKERS.strict),
+                "emails": options["emails"],
+                "seed": options["seed"],
+                "results": results,
+            }
+            with open(options["output"], "w", encoding="utf-8") as output_file:
+                json.dump(data, output_file, indent=2)
+
+    def run_benchmark(self, name, corpus):
+        """Time a tracker function on each email in the corpus."""
+        function = FUNCTIONS[name]
+        latencies = []
+        for html in corpus:
+            start = time.perf_counter()
+            function(html)
+            latencies.append(time.perf_counter() - start)
+        total_s = sum(latencies)
+        total_mb = sum(len(html.encode()) for html in corpus) / 1024**2
+        latencies.sort()
+        return {
+            "function": name,
+            "total_mb": round(total_mb, 3),
+            "total_s": round(total_s, 6),
+            "mb_per_s": round(total_mb / total_s, 3) if total_s else None,
+            "emails_per_s": round(len(corpus) / total_s, 1) if total_s else None,
+            "latency_ms": {
+                f"p{percent}": round(percentile(latencies, percent) * 1000, 3)
+                for percent in (50, 90, 99)
+            },
+        }
+
+    def format_result(self, result):
+        latency = result["latency_ms"]
+        return (
+            f"{result['function']:<20} {result['size_kb']:>5} KB"
+            f" density {result['tracker_density']:<5}"
+            f" {result['mb_per_s']!s:>9} MB/s {result['emails_per_s']!s:>9} emails/s"
+            f" p50 {latency['p50']} ms p90 {latency['p90']} ms"
+            f" p99 {latency['p99']} ms"
+        )
@@ -75,6 +75,7 @@ class Command(CommandFromDjangoSettings):
         * error: If failed, the failure detail, else omitted
         * data: The healthcheck data, or omitted if non-JSON
         * age_s: The timestamp age in seconds, millisecond precision, if found
+        * worker_age_s: The timestamp age of the first failing worker, if any
 
         Raises exceptions (which are also failures) if:
         * The healthcheck file doesn't exist
@@ -82,6 +83,9 @@ class Command(CommandFromDjangoSettings):
         * The JSON doesn't have a "timestamp" field
         * The timestamp doesn't match the format of datetime.toisoformat()
         * The timestamp doesn't include timezone data
+
+        If the healthcheck has a "workers" object, as written by a supervisor
+        of worker processes, each worker's timestamp must also be recent.
         """
         context = {"success": False, "healthcheck_path": healthcheck_file.name}
         try:
@@ -98,6 +102,22 @@ class Command(CommandFromDjangoSettings):
         context["age_s"] = round(age, 3)
         if age > max_age:
             context["error"] = "Timestamp is too old"
-        else:
-            context["success"] = True
+            return context
+
+        # A supervisor of worker processes adds an entry per worker, with the
+        # worker number as a string key
+        workers = sorted(
+            data.get("workers", {}).items(), key=lambda worker: int(worker[0])
+        )
+        for worker_num, worker_data in workers:
+            worker_timestamp = datetime.fromisoformat(worker_data["timestamp"])
+            worker_age = (
+                datetime.now(tz=timezone.utc) - worker_timestamp
+            ).total_seconds()
+            if worker_age > max_age:
+                context["error"] = f"Timestamp is too old for worker {worker_num}"
+                context["worker_age_s"] = round(worker_age, 3)
+                return context
+
+        context["success"] = True
         return context
@@ -9,6 +9,7 @@ from botocore.exceptions import ClientError
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from emails.aws import aws_client_config
 from emails.views import _sns_inbound_logic, validate_sns_arn_and_type, verify_from_sns
 from emails.utils import incr_if_enabled
 
@@ -52,7 +53,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         self.exit_code = 0
         try:
-            sqs_client = boto3.resource("sqs", region_name=settings.AWS_REGION)
+            sqs_client = boto3.resource("sqs", config=aws_client_config())
             dl_queue = sqs_client.Queue(settings.AWS_SQS_QUEUE_URL)
         except ClientError as e:
             logger.error("sqs_client_error: ", extra=e.response["Error"])
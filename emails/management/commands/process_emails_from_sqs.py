@@ -9,36 +9,236 @@ https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-s
 https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Queue.receive_messages
 """
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from urllib.parse import urlsplit
+from queue import Empty, Full, Queue
 import gc
 import json
 import logging
 import shlex
+import signal
+import threading
 import time
 
 import boto3
 from botocore.exceptions import ClientError
 from codetiming import Timer
 from markus.utils import generate_tag
-import OpenSSL
 
 from django.core.management.base import CommandError
+from django.db import close_old_connections
 
-from emails.sns import verify_from_sns
+from emails.aws import aws_client_config
+from emails.models import ABUSE_COUNTERS, COUNTER_BUFFER
+from emails.sns import verify_batch_from_sns
 from emails.views import _sns_inbound_logic, validate_sns_arn_and_type
-from emails.utils import incr_if_enabled, gauge_if_enabled
+from emails.utils import (
+    S3_DELETE_QUEUE,
+    add_stage_timings,
+    collect_stage_timings,
+    gauge_if_enabled,
+    incr_if_enabled,
+    time_stage,
+)
 from emails.management.command_from_django_settings import (
     CommandFromDjangoSettings,
     SettingToLocal,
 )
+from emails.management.message_profiler import MessageProfiler
+from emails.management.worker_supervisor import WorkerSupervisor
 
 logger = logging.getLogger("eventsinfo.process_emails_from_sqs")
 
 
+def change_message_visibility(queue, message_batch, visibility_seconds):
+    """
+    Change the visibility timeout of a batch of messages.
+
+    Return is a list of the messages that were changed. Messages that failed,
+    such as a message received by another process after its timeout ran out,
+    are left out, and all the messages are left out if the request failed.
+    """
+    if not message_batch:
+        return []
+    entries = [
+        {
+            "Id": str(num),
+            "ReceiptHandle": message.receipt_handle,
+            "VisibilityTimeout": visibility_seconds,
+        }
+        for num, message in enumerate(message_batch)
+    ]
+    try:
+        response = queue.change_message_visibility_batch(Entries=entries)
+    except ClientError as e:
+        logger.error("sqs_change_visibility_error", extra=e.response["Error"])
+        return []
+    failed_ids = set()
+    for failure in response.get("Failed", []):
+        failed_ids.add(failure["Id"])
+        logger.error(
+            "sqs_change_visibility_failed",
+            extra={"code": failure["Code"], "error_message": failure.get("Message")},
+        )
+    if failed_ids:
+        incr_if_enabled("message_from_sqs_visibility_error", len(failed_ids))
+    return [
+        message
+        for num, message in enumerate(message_batch)
+        if str(num) not in failed_ids
+    ]
+
+
+class PrefetchedBatch:
+    """A batch of SQS messages received by the MessagePrefetcher."""
+
+    def __init__(self, messages, poll_s, received_at):
+        self.messages = messages
+        self.received_count = len(messages)
+        self.poll_s = poll_s
+        self.received_at = received_at
+        self.leased_at = received_at
+        self.lock = threading.Lock()
+
+    def extend_if_due(self, queue, visibility_seconds, due_seconds):
+        """
+        Extend the visibility of the messages, if due_seconds have passed.
+
+        Messages that could not be extended are removed from the batch, since
+        another process may receive them. Return is True if the visibility
+        was extended.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.leased_at <= due_seconds:
+                return False
+            self.leased_at = now
+            self.messages = change_message_visibility(
+                queue, self.messages, visibility_seconds
+            )
+            return True
+
+
+class MessagePrefetcher:
+    """
+    Receive SQS messages on a background thread, ahead of processing.
+
+    Batches are long-polled into a bounded buffer, so that the next batch is
+    requested while the current one is processed. The prefetch thread should
+    use its own SQS resource, since boto3 resources are not thread safe, and
+    only the prefetch thread uses it.
+
+    Between polls, the prefetch thread extends the visibility timeout of the
+    buffered batches that would run out before the next poll returns, or are
+    past half their timeout, so they are not received by another process
+    while they wait. Messages that can not be extended are dropped from the
+    buffer, and are processed after SQS makes them visible again.
+    """
+
+    def __init__(
+        self, queue, batch_size, wait_seconds, visibility_seconds, max_batches
+    ):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self.visibility_seconds = visibility_seconds
+        # Leave time for a long poll, and for waiting on a full buffer
+        self.extend_after_seconds = min(
+            visibility_seconds / 2, visibility_seconds - wait_seconds - 2
+        )
+        self.buffer = Queue(maxsize=max_batches)
+        self.stop_requested = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="sqs_prefetch", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        """
+        Poll for batches until stopped, then release the buffered batches.
+
+        Runs on the prefetch thread, so that all its SQS calls are made there.
+        """
+        self.poll_until_stopped()
+        while True:
+            try:
+                batch = self.buffer.get_nowait()
+            except Empty:
+                break
+            with batch.lock:
+                self.release_messages(batch.messages)
+
+    def poll_until_stopped(self):
+        """Poll for batches and add them to the buffer, until stopped."""
+        while not self.stop_requested.is_set():
+            self.extend_buffered_batches()
+            received_at = time.monotonic()
+            try:
+                with Timer(logger=None) as poll_timer:
+                    message_batch = self.queue.receive_messages(
+                        MaxNumberOfMessages=self.batch_size,
+                        VisibilityTimeout=self.visibility_seconds,
+                        WaitTimeSeconds=self.wait_seconds,
+                    )
+            except Exception as e:
+                logger.error("sqs_prefetch_error", extra={"error": repr(e)})
+                self.stop_requested.wait(1)
+                continue
+            if not message_batch:
+                continue
+            if self.stop_requested.is_set():
+                self.release_messages(message_batch)
+                return
+            batch = PrefetchedBatch(message_batch, poll_timer.last, received_at)
+            while True:
+                try:
+                    self.buffer.put(batch, timeout=1)
+                    break
+                except Full:
+                    if self.stop_requested.is_set():
+                        self.release_messages(batch.messages)
+                        return
+                    self.extend_buffered_batches(batch)
+
+    def extend_buffered_batches(self, *waiting):
+        """Extend the visibility of buffered and waiting batches, if due."""
+        with self.buffer.mutex:
+            batches = list(self.buffer.queue)
+        for batch in batches + list(waiting):
+            batch.extend_if_due(
+                self.queue, self.visibility_seconds, self.extend_after_seconds
+            )
+
+    def get_batch(self, timeout):
+        """
+        Get the next prefetched batch, waiting up to timeout seconds.
+
+        Return is a PrefetchedBatch, or None if none arrived in time.
+        """
+        try:
+            return self.buffer.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def stop(self):
+        """Stop prefetching, and wait for the buffered messages to be released."""
+        self.stop_requested.set()
+        self.thread.join(timeout=self.wait_seconds + 1)
+
+    def release_messages(self, message_batch):
+        """Make unprocessed messages visible to other receivers."""
+        change_message_visibility(self.queue, message_batch, 0)
+
+
 class Command(CommandFromDjangoSettings):
     help = "Fetch email tasks from SQS and process them."
 
+    DELETE_MESSAGES_MAX_TRIES = 3
+    COUNTER_FLUSH_MAX_TRIES = 3
+
     settings_to_locals = [
         SettingToLocal(
             "PROCESS_EMAIL_BATCH_SIZE",
@@ -76,6 +276,73 @@ class Command(CommandFromDjangoSettings):
             "Maximum time to process before exiting, or None to run forever.",
             lambda max_seconds: max_seconds is None or max_seconds > 0.0,
         ),
+        SettingToLocal(
+            "PROCESS_EMAIL_MAX_WORKERS",
+            "max_workers",
+            "Number of threads processing the messages of a batch, or 1 to process them in sequence.",
+            lambda max_workers: max_workers > 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_WORKER_PROCESSES",
+            "worker_processes",
+            "Number of worker processes to fork and supervise, or 1 to process in this process.",
+            lambda worker_processes: worker_processes > 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_PREFETCH_BATCHES",
+            "prefetch_batches",
+            "Number of batches to receive ahead of processing, or 0 to receive after each batch is processed.",
+            lambda prefetch_batches: prefetch_batches >= 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_QUEUE_REFRESH_SECONDS",
+            "queue_refresh_seconds",
+            "Minimum time between reloads of the queue attributes, or 0 to reload each cycle.",
+            lambda queue_refresh_seconds: queue_refresh_seconds >= 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_BATCH_S3_DELETES",
+            "batch_s3_deletes",
+            "Delete processed emails from S3 in batches at the end of each cycle, instead of after each message.",
+            lambda batch_s3_deletes: batch_s3_deletes in (True, False),
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_BUFFER_COUNTERS",
+            "buffer_counters",
+            "Buffer the address counters, and write them in bulk, instead of after each message.",
+            lambda buffer_counters: buffer_counters in (True, False),
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_COUNTER_FLUSH_SECONDS",
+            "counter_flush_seconds",
+            "When buffering counters, minimum time between writes at the end of a cycle.",
+            lambda counter_flush_seconds: counter_flush_seconds >= 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_COUNTER_FLUSH_MESSAGES",
+            "counter_flush_messages",
+            "When buffering counters, write them after this many counter updates.",
+            lambda counter_flush_messages: counter_flush_messages > 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_PROFILE",
+            "profile",
+            "Profile a sample of the messages at startup. SIGUSR1 to the command process"
+            " turns profiling on and off, in all worker processes.",
+            lambda profile: profile in (True, False),
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_PROFILE_EVERY",
+            "profile_every",
+            "When profiling, profile every Nth message.",
+            lambda profile_every: profile_every > 0,
+        ),
+        SettingToLocal(
+            "PROCESS_EMAIL_PROFILE_DIR",
+            "profile_dir",
+            "Directory to write the profile stats files.",
+            lambda profile_dir: bool(profile_dir),
+        ),
         SettingToLocal(
             "AWS_REGION",
             "aws_region",
@@ -100,28 +367,82 @@ class Command(CommandFromDjangoSettings):
         """Handle call from command line (called by BaseCommand)"""
         self.init_from_settings(verbosity)
         self.init_locals()
-        logger.info(
-            "Starting process_emails_from_sqs",
-            extra={
-                "batch_size": self.batch_size,
-                "wait_seconds": self.wait_seconds,
-                "visibility_seconds": self.visibility_seconds,
-                "healthcheck_path": self.healthcheck_path,
-                "delete_failed_messages": self.delete_failed_messages,
-                "max_seconds": self.max_seconds,
-                "aws_region": self.aws_region,
-                "sqs_url": self.sqs_url,
-                "verbosity": self.verbosity,
-            },
-        )
+        logger.info("Starting process_emails_from_sqs", extra=self.startup_context())
 
+        if self.worker_processes > 1:
+            process_data = WorkerSupervisor(self).run()
+        else:
+            process_data = self.run_engine()
+        logger.info("Exiting process_emails_from_sqs", extra=process_data)
+
+    def run_engine(self):
+        """
+        Connect to SQS, and process the queue until an exit condition.
+
+        SIGTERM requests a graceful exit at the end of the current cycle, like
+        SIGINT. The queued S3 deletes and buffered counters are written before
+        returning.
+        """
         try:
             self.queue = self.create_client()
         except ClientError as e:
             raise CommandError("Unable to connect to SQS") from e
 
-        process_data = self.process_queue()
-        logger.info("Exiting process_emails_from_sqs", extra=process_data)
+        if self.max_workers > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="process_email"
+            )
+        if self.prefetch_batches:
+            self.prefetcher = MessagePrefetcher(
+                queue=self.create_client(),
+                batch_size=self.batch_size,
+                wait_seconds=self.wait_seconds,
+                visibility_seconds=self.visibility_seconds,
+                max_batches=self.prefetch_batches,
+            )
+            self.prefetcher.start()
+        S3_DELETE_QUEUE.enabled = self.batch_s3_deletes
+        self.start_counter_buffer()
+        self.profiler.install_signal_handler()
+        old_sigterm = signal.signal(signal.SIGTERM, self.request_halt)
+        try:
+            return self.process_queue()
+        finally:
+            if self.prefetcher:
+                self.prefetcher.stop()
+            if self.executor:
+                self.executor.shutdown(wait=True)
+            self.finish_s3_deletes()
+            self.finish_counter_buffer()
+            self.profiler.close()
+            signal.signal(signal.SIGTERM, old_sigterm)
+
+    def run_worker_process(self, worker_num, status_queue):
+        """
+        Process the queue in a worker process started by WorkerSupervisor.
+
+        Healthcheck data is sent to the supervisor instead of written to the
+        healthcheck file. SIGTERM requests a graceful exit at the end of the
+        current cycle.
+        """
+        self.worker_num = worker_num
+        self.status_queue = status_queue
+        # Replace the supervisor's handler, inherited by the fork, before
+        # connecting to SQS
+        signal.signal(signal.SIGTERM, self.request_halt)
+        process_data = self.run_engine()
+        status_queue.put(("exit", worker_num, process_data))
+
+    def request_halt(self, signum, frame):
+        """Signal handler to exit after the current cycle."""
+        self.halt_requested = True
+
+    def startup_context(self):
+        """Return the settings of the command, for the starting log."""
+        return {
+            setting.local_name: getattr(self, setting.local_name)
+            for setting in self.settings_to_locals
+        }
 
     def init_locals(self):
         """Initialize command attributes that don't come from settings."""
@@ -135,12 +456,25 @@ class Command(CommandFromDjangoSettings):
         self.queue_count = None
         self.queue_count_delayed = None
         self.queue_count_not_visible = None
+        self.executor = None
+        self.prefetcher = None
+        self.queue_refreshed_at = None
+        self.worker_num = None
+        self.status_queue = None
+        self.healthcheck_lock = threading.Lock()
+        self.verified_messages = {}
+        self.counters_flushed_at = None
+        self.profiler = MessageProfiler(
+            self.profile_every, self.profile_dir, enabled=self.profile
+        )
 
     def create_client(self):
         """Create the SQS client."""
         assert self.aws_region
         assert self.sqs_url
-        sqs_client = boto3.resource("sqs", region_name=self.aws_region)
+        sqs_client = boto3.resource(
+            "sqs", region_name=self.aws_region, config=aws_client_config()
+        )
         return sqs_client.Queue(self.sqs_url)
 
     def process_queue(self):
@@ -168,7 +502,8 @@ class Command(CommandFromDjangoSettings):
                     "cycle_num": self.cycles,
                     "cycle_s": 0.0,
                 }
-                cycle_data.update(self.refresh_and_emit_queue_count_metrics())
+                if self.queue_refresh_is_due():
+                    cycle_data.update(self.refresh_and_emit_queue_count_metrics())
                 self.write_healthcheck()
 
                 # Check if we should exit due to time limit
@@ -182,6 +517,8 @@ class Command(CommandFromDjangoSettings):
                 with Timer(logger=None) as cycle_timer:
                     message_batch, cycle_data = self.poll_queue_for_messages()
                     cycle_data.update(self.process_message_batch(message_batch))
+                    cycle_data.update(S3_DELETE_QUEUE.flush())
+                    cycle_data.update(self.flush_counter_buffer_if_due())
 
                 # Collect data and log progress
                 self.total_messages += len(message_batch)
@@ -204,6 +541,9 @@ class Command(CommandFromDjangoSettings):
                 self.halt_requested = True
                 exit_on = "interrupt"
 
+        if self.halt_requested and exit_on == "unknown":
+            exit_on = "interrupt"
+
         process_data = {
             "exit_on": exit_on,
             "cycles": self.cycles,
@@ -216,6 +556,54 @@ class Command(CommandFromDjangoSettings):
             process_data["pause_count"] = self.pause_count
         return process_data
 
+    def finish_s3_deletes(self):
+        """Delete the emails still queued for batch deletion, and stop batching."""
+        if not S3_DELETE_QUEUE.enabled:
+            return
+        S3_DELETE_QUEUE.enabled = False
+        for _ in range(S3_DELETE_QUEUE.MAX_ATTEMPTS):
+            if not S3_DELETE_QUEUE.flush().get("s3_delete_pending"):
+                break
+
+    def start_counter_buffer(self):
+        """Start buffering the address counters, if enabled."""
+        COUNTER_BUFFER.enabled = self.buffer_counters
+        COUNTER_BUFFER.max_increments = self.counter_flush_messages
+        self.counters_flushed_at = time.time()
+
+    def flush_counter_buffer_if_due(self):
+        """Write the buffered counters, if it is time to."""
+        if not COUNTER_BUFFER.enabled:
+            return {}
+        now = time.time()
+        if now - self.counters_flushed_at < self.counter_flush_seconds:
+            return {}
+        self.counters_flushed_at = now
+        return COUNTER_BUFFER.flush()
+
+    def finish_counter_buffer(self):
+        """Write the buffered counters and abuse counts, and stop buffering."""
+        ABUSE_COUNTERS.persist()
+        if not COUNTER_BUFFER.enabled:
+            return
+        COUNTER_BUFFER.enabled = False
+        for _ in range(self.COUNTER_FLUSH_MAX_TRIES):
+            if not COUNTER_BUFFER.flush().get("counter_failed_rows"):
+                break
+
+    def queue_refresh_is_due(self):
+        """Return True if the queue attributes should be reloaded this cycle."""
+        if not self.queue_refresh_seconds:
+            return True
+        now = time.monotonic()
+        if (
+            self.queue_refreshed_at is None
+            or now - self.queue_refreshed_at >= self.queue_refresh_seconds
+        ):
+            self.queue_refreshed_at = now
+            return True
+        return False
+
     def refresh_and_emit_queue_count_metrics(self):
         """
         Query SQS queue attributes, store backlog metrics, and emit them as gauge stats
@@ -259,18 +647,30 @@ class Command(CommandFromDjangoSettings):
             "queue_count_not_visible": self.queue_count_not_visible,
         }
 
-    def poll_queue_for_messages(self):
+    def poll_queue_for_messages(self, max_messages=None):
         """Request a batch of messages, using the long-poll method.
 
+        Arguments:
+        * max_messages - the most messages to receive, or None for batch_size
+
         Return is a tuple:
         * message_batch: a list of messages, which may be empty
         * data: A dict suitable for logging context, with these keys:
             - message_count: the number of messages
             - sqs_poll_s: The poll time, in seconds with millisecond precision
+            - prefetch_wait_s: When prefetching, the time waiting for a batch
+            - prefetch_age_s: When prefetching, the time since the batch was received
+            - visibility_extended: True if the visibility of a prefetched batch
+              was extended, omitted if not
+            - visibility_failed_count: When prefetching, the number of messages
+              that were dropped because their visibility could not be
+              extended, omitted if 0
         """
+        if self.prefetcher:
+            return self.get_prefetched_messages()
         with Timer(logger=None) as poll_timer:
             message_batch = self.queue.receive_messages(
-                MaxNumberOfMessages=self.batch_size,
+                MaxNumberOfMessages=max_messages or self.batch_size,
                 VisibilityTimeout=self.visibility_seconds,
                 WaitTimeSeconds=self.wait_seconds,
             )
@@ -282,6 +682,41 @@ class Command(CommandFromDjangoSettings):
             },
         )
 
+    def get_prefetched_messages(self):
+        """
+        Get a batch from the prefetcher, extending visibility if it waited.
+
+        A batch that is past half its visibility timeout is reserved for
+        another full timeout, so that it does not become visible to other
+        receivers while it is processed. This uses the queue of this thread,
+        not the prefetch thread's. Messages that could not be extended are
+        not processed, since another process may receive them.
+        """
+        with Timer(logger=None) as wait_timer:
+            batch = self.prefetcher.get_batch(timeout=self.wait_seconds)
+        if batch is None:
+            return [], {
+                "message_count": 0,
+                "sqs_poll_s": 0.0,
+                "prefetch_wait_s": round(wait_timer.last, 3),
+            }
+        extended = batch.extend_if_due(
+            self.queue, self.visibility_seconds, self.visibility_seconds / 2
+        )
+        with batch.lock:
+            message_batch = batch.messages
+        data = {
+            "message_count": len(message_batch),
+            "sqs_poll_s": round(batch.poll_s, 3),
+            "prefetch_wait_s": round(wait_timer.last, 3),
+            "prefetch_age_s": round(time.monotonic() - batch.received_at, 3),
+        }
+        if extended:
+            data["visibility_extended"] = True
+        if len(message_batch) < batch.received_count:
+            data["visibility_failed_count"] = batch.received_count - len(message_batch)
+        return message_batch, data
+
     def process_message_batch(self, message_batch):
         """
         Process a batch of messages.
@@ -290,10 +725,17 @@ class Command(CommandFromDjangoSettings):
         * messages - a list of SQS messages, possibly empty
 
         Return is a dict suitable for logging context, with these keys:
-        * process_s: How long processing took, omitted if no messages
+        * verify_s: How long verifying the SNS signatures of the batch took
+        * process_s: How long processing took, omitted if no messages. When
+          messages are processed concurrently, this is the sum of the message
+          times, and can be longer than the cycle.
         * pause_count: How many pauses were taken for temporary errors, omitted if 0
         * pause_s: How long pauses took, omitted if no pauses
         * failed_count: How many messages failed to process, omitted if 0
+        * delete_count: How many messages were deleted from the queue, omitted if 0
+        * delete_s: How long the batch delete took, omitted if no deletes
+        * delete_failed_count: How many deletes failed after retries, omitted if 0
+        * delete_failed_codes: The error codes of failed deletes, omitted if none
 
         Times are in seconds, with millisecond precision
         """
@@ -303,29 +745,155 @@ class Command(CommandFromDjangoSettings):
         pause_time = 0.0
         pause_count = 0
         process_time = 0.0
-        for message in message_batch:
-            self.write_healthcheck()
-            with Timer(logger=None) as message_timer:
-                message_data = self.process_message(message)
-                if not message_data["success"]:
-                    failed_count += 1
-                if message_data["success"] or self.delete_failed_messages:
-                    message.delete()
-                pause_time += message_data.get("pause_s", 0.0)
-                pause_count += message_data.get("pause_count", 0)
-
-            message_data["message_process_time_s"] = round(message_timer.last, 3)
-            process_time += message_timer.last
-            logger.log(logging.INFO, "Message processed", extra=message_data)
-
-        batch_data = {"process_s": round((process_time - pause_time), 3)}
+        to_delete = []
+        verify_data = self.load_message_batch(message_batch)
+        if self.executor and len(message_batch) > 1:
+            message_results = self.process_messages_concurrently(message_batch)
+        else:
+            message_results = self.process_messages_in_sequence(message_batch)
+
+        for message, message_data, message_time in message_results:
+            if not message_data["success"]:
+                failed_count += 1
+            if message_data["success"] or self.delete_failed_messages:
+                to_delete.append(message)
+            pause_time += message_data.get("pause_s", 0.0)
+            pause_count += message_data.get("pause_count", 0)
+            process_time += message_time
+
+        batch_data = verify_data
+        batch_data["process_s"] = round((process_time - pause_time), 3)
         if pause_count:
             batch_data["pause_count"] = pause_count
             batch_data["pause_s"] = round(pause_time, 3)
         if failed_count:
             batch_data["failed_count"] = failed_count
+        if to_delete:
+            batch_data.update(self.delete_messages(to_delete))
         return batch_data
 
+    def process_messages_in_sequence(self, message_batch):
+        """
+        Process and log each message of a batch, one after another.
+
+        Yields a tuple for each message:
+        * message: The SQS message
+        * message_data: The dict returned by process_and_log_message
+        * message_time: The processing time in seconds
+        """
+        for message in message_batch:
+            self.write_healthcheck()
+            yield self.process_and_log_message(message)
+
+    def process_messages_concurrently(self, message_batch):
+        """
+        Process and log the messages of a batch on the thread pool.
+
+        Messages are submitted together, and the healthcheck is updated as each
+        completes. Yields the same tuples as process_messages_in_sequence, in
+        order of completion.
+        """
+        self.write_healthcheck()
+        futures = [
+            self.executor.submit(self.process_message_in_thread, message)
+            for message in message_batch
+        ]
+        for future in as_completed(futures):
+            self.write_healthcheck()
+            yield future.result()
+
+    def process_message_in_thread(self, message):
+        """
+        Process a message on a worker thread.
+
+        Each thread has its own database connection, which is closed when it
+        is unusable or too old, like Django does at the end of a request.
+        """
+        close_old_connections()
+        try:
+            return self.process_and_log_message(message)
+        finally:
+            close_old_connections()
+
+    def process_and_log_message(self, message):
+        """
+        Process a message and log the result.
+
+        Return is a tuple:
+        * message: The SQS message
+        * message_data: The dict returned by process_message, with the added key
+          message_process_time_s, and a <stage>_s key for each email processing
+          stage that ran, such as sns_verify_s and ses_send_s
+        * message_time: The processing time in seconds, full precision
+        """
+        with self.profiler.profile(), collect_stage_timings() as stage_timings:
+            with Timer(logger=None) as message_timer:
+                message_data = self.process_message(message)
+
+        for stage, stage_time in stage_timings.items():
+            message_data[f"{stage}_s"] = round(stage_time, 3)
+        message_data["message_process_time_s"] = round(message_timer.last, 3)
+        logger.log(logging.INFO, "Message processed", extra=message_data)
+        return message, message_data, message_timer.last
+
+    def delete_messages(self, messages):
+        """
+        Delete messages from the queue, with one DeleteMessageBatch call per try.
+
+        Deletes that fail on the SQS side are retried, up to
+        DELETE_MESSAGES_MAX_TRIES tries. Deletes that fail due to the request,
+        such as an expired receipt handle, are not retried.
+
+        Return is a dict suitable for logging context, with these keys:
+        * delete_count: How many messages were deleted, omitted if 0
+        * delete_s: How long the deletes took, in seconds with millisecond precision
+        * delete_failed_count: How many deletes failed, omitted if 0
+        * delete_failed_codes: Sorted error codes of failed deletes, omitted if none
+        """
+        pending = {
+            str(num): message.receipt_handle for num, message in enumerate(messages)
+        }
+        deleted_count = 0
+        failed = {}
+        retry_failed = {}
+        with Timer(logger=None) as delete_timer:
+            for _ in range(self.DELETE_MESSAGES_MAX_TRIES):
+                entries = [
+                    {"Id": entry_id, "ReceiptHandle": receipt_handle}
+                    for entry_id, receipt_handle in pending.items()
+                ]
+                try:
+                    response = self.queue.delete_messages(Entries=entries)
+                except ClientError as e:
+                    logger.error("sqs_delete_messages_error", extra=e.response["Error"])
+                    retry_failed = {
+                        entry_id: e.response["Error"]["Code"] for entry_id in pending
+                    }
+                    continue
+                deleted_count += len(response.get("Successful", []))
+                retry = {}
+                retry_failed = {}
+                for failure in response.get("Failed", []):
+                    entry_id = failure["Id"]
+                    if failure["SenderFault"]:
+                        failed[entry_id] = failure["Code"]
+                    else:
+                        retry[entry_id] = pending[entry_id]
+                        retry_failed[entry_id] = failure["Code"]
+                pending = retry
+                if not pending:
+                    break
+        failed.update(retry_failed)
+
+        data = {"delete_s": round(delete_timer.last, 3)}
+        if deleted_count:
+            data["delete_count"] = deleted_count
+        if failed:
+            incr_if_enabled("message_from_sqs_delete_error", len(failed))
+            data["delete_failed_count"] = len(failed)
+            data["delete_failed_codes"] = sorted(set(failed.values()))
+        return data
+
     def process_message(self, message):
         """
         Process an SQS message, which may include sending an email.
@@ -341,28 +909,14 @@ class Command(CommandFromDjangoSettings):
         """
         incr_if_enabled("process_message_from_sqs", 1)
         results = {"success": True, "sqs_message_id": message.message_id}
-        raw_body = message.body
-        try:
-            json_body = json.loads(raw_body)
-        except ValueError as e:
-            results.update(
-                {
-                    "success": False,
-                    "error": f"Failed to load message.body: {e}",
-                    "message_body_quoted": shlex.quote(raw_body),
-                }
-            )
-            return results
-        try:
-            verified_json_body = verify_from_sns(json_body)
-        except (KeyError, OpenSSL.crypto.Error) as e:
-            logger.error("Failed SNS verification", extra={"error": str(e)})
-            results.update(
-                {
-                    "success": False,
-                    "error": f"Failed SNS verification: {e}",
-                }
-            )
+        if message.message_id in self.verified_messages:
+            loaded, stage_timings = self.verified_messages.pop(message.message_id)
+            add_stage_timings(stage_timings)
+        else:
+            loaded = self.load_message(message)
+        verified_json_body, error_results = loaded
+        if error_results:
+            results.update(error_results)
             return results
 
         topic_arn = verified_json_body["TopicArn"]
@@ -415,9 +969,84 @@ class Command(CommandFromDjangoSettings):
                 )
         return results
 
+    def load_message(self, message):
+        """
+        Load the JSON body of an SQS message, and verify the SNS signature.
+
+        Return is a tuple:
+        * verified_json_body: The verified SNS notification, or None on error
+        * error_results: None, or a dict of failure details for process_message
+        """
+        json_body, error_results = self.parse_message_body(message)
+        if error_results:
+            return None, error_results
+        with time_stage("sns_verify"):
+            (result,) = verify_batch_from_sns([json_body])
+        return self.check_verify_result(result)
+
+    def load_message_batch(self, message_batch):
+        """
+        Load and verify the messages of a batch, before processing them.
+
+        Each message is verified on its own, so a bad signature only fails
+        that message. Other verification errors, such as a failed certificate
+        download, are raised before any message of the batch is processed, so
+        the batch stays on the queue to be retried. Messages that were verified recently, such as redelivered
+        messages, are not verified again. The results and the stage timings
+        of verifying each message are kept in verified_messages, and used by
+        process_message, so the message log has the sns_verify_s time.
+
+        Return is a dict suitable for logging context, with the key verify_s,
+        the time to verify the batch, in seconds with millisecond precision.
+        """
+        self.verified_messages = {}
+        with Timer(logger=None) as verify_timer:
+            for message in message_batch:
+                with collect_stage_timings() as stage_timings:
+                    loaded = self.load_message(message)
+                self.verified_messages[message.message_id] = (loaded, stage_timings)
+        return {"verify_s": round(verify_timer.last, 3)}
+
+    def parse_message_body(self, message):
+        """Parse the JSON body of an SQS message, or return error details."""
+        raw_body = message.body
+        try:
+            return json.loads(raw_body), None
+        except ValueError as e:
+            return None, {
+                "success": False,
+                "error": f"Failed to load message.body: {e}",
+                "message_body_quoted": shlex.quote(raw_body),
+            }
+
+    def check_verify_result(self, result):
+        """Convert a verify_batch_from_sns result to the load_message return."""
+        if isinstance(result, Exception):
+            logger.error("Failed SNS verification", extra={"error": str(result)})
+            return None, {
+                "success": False,
+                "error": f"Failed SNS verification: {result}",
+            }
+        return result, None
+
     def write_healthcheck(self):
-        """Update the healthcheck file with operations data, if path is set."""
-        data = {
+        """
+        Update the healthcheck file with operations data, if path is set.
+
+        In a worker process, the data is sent to the supervisor, which writes
+        the healthcheck file for all the workers.
+        """
+        data = self.healthcheck_data()
+        if self.status_queue is not None:
+            self.status_queue.put(("healthcheck", self.worker_num, data))
+            return
+        with self.healthcheck_lock:
+            with open(self.healthcheck_path, "w", encoding="utf-8") as healthcheck_file:
+                json.dump(data, healthcheck_file)
+
+    def healthcheck_data(self):
+        """Return the operations data for the healthcheck."""
+        return {
             "timestamp": datetime.now(tz=timezone.utc).isoformat(),
             "cycles": self.cycles,
             "total_messages": self.total_messages,
@@ -431,8 +1060,6 @@ class Command(CommandFromDjangoSettings):
                 "ApproximateNumberOfMessagesNotVisible"
             ],
         }
-        with open(self.healthcheck_path, "w", encoding="utf-8") as healthcheck_file:
-            json.dump(data, healthcheck_file)
 
     def pluralize(self, value, singular, plural=None):
         """Returns 's' suffix to make plural, like 's' in tasks"""
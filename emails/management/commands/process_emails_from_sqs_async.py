@@ -0,0 +1,265 @@
+"""
+Process the SQS email queue with an asyncio event loop.
+
+This is an alternative engine to process_emails_from_sqs. Instead of
+processing one batch before polling for the next, an event loop keeps up to
+max_in_flight messages in progress, and polls for more messages as soon as
+there is room for them.
+
+This is a thread pool that is refilled continuously, with asyncio to schedule
+it, not asynchronous I/O. The AWS clients (boto3) and the Django ORM are
+blocking, so each message is processed by the synchronous process_message on
+a thread pool of max_in_flight threads, including its SES and S3 calls and
+its database work. The event loop only awaits the threads. SQS calls run on a
+separate single thread, since boto3 resources are not thread safe. Since
+process_message is the same as in the synchronous command, the message logs,
+result dicts, and metrics are the same, and the two commands can be swapped
+per deployment.
+
+SIGINT and SIGTERM stop polling for messages. The messages already started
+are finished and deleted, and the queued S3 deletes and buffered counters are
+written, before the command exits.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import gc
+import logging
+import signal
+import time
+
+from botocore.exceptions import ClientError
+from codetiming import Timer
+
+from django.core.management.base import CommandError
+
+from emails.management.command_from_django_settings import SettingToLocal
+from emails.models import COUNTER_BUFFER
+from emails.utils import S3_DELETE_QUEUE
+from emails.management.commands.process_emails_from_sqs import (
+    Command as SyncCommand,
+)
+
+logger = logging.getLogger("eventsinfo.process_emails_from_sqs_async")
+
+# Settings of the synchronous engine that are replaced by max_in_flight
+SYNC_ONLY_SETTINGS = ("max_workers", "worker_processes", "prefetch_batches")
+
+
+class Command(SyncCommand):
+    help = "Fetch email tasks from SQS and process them with asyncio."
+
+    settings_to_locals = [
+        setting
+        for setting in SyncCommand.settings_to_locals
+        if setting.local_name not in SYNC_ONLY_SETTINGS
+    ] + [
+        SettingToLocal(
+            "PROCESS_EMAIL_ASYNC_MAX_IN_FLIGHT",
+            "max_in_flight",
+            "Maximum number of messages being processed at the same time.",
+            lambda max_in_flight: max_in_flight > 0,
+        ),
+    ]
+
+    def handle(self, verbosity, *args, **kwargs):
+        """Handle call from command line (called by BaseCommand)"""
+        self.init_from_settings(verbosity)
+        self.init_locals()
+        logger.info(
+            "Starting process_emails_from_sqs_async", extra=self.startup_context()
+        )
+
+        try:
+            self.queue = self.create_client()
+        except ClientError as e:
+            raise CommandError("Unable to connect to SQS") from e
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="process_email"
+        )
+        self.sqs_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="process_email_sqs"
+        )
+        S3_DELETE_QUEUE.enabled = self.batch_s3_deletes
+        self.start_counter_buffer()
+        self.profiler.install_signal_handler()
+        try:
+            process_data = asyncio.run(self.process_queue_async())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.sqs_executor.shutdown(wait=True)
+            self.finish_s3_deletes()
+            self.finish_counter_buffer()
+            self.profiler.close()
+        logger.info("Exiting process_emails_from_sqs_async", extra=process_data)
+
+    def init_locals(self):
+        """Initialize command attributes that don't come from settings."""
+        super().init_locals()
+        self.sqs_executor = None
+        self.in_flight = set()
+
+    async def run_sqs(self, func, *args):
+        """Run a blocking SQS call on the SQS thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.sqs_executor, func, *args)
+
+    async def process_queue_async(self):
+        """
+        Process the SQS email queue until an exit condition is reached.
+
+        Each cycle polls for as many messages as there is room for, starts
+        processing them, and deletes the messages that completed since the
+        last cycle. When there is no room, the cycle waits for a message to
+        complete.
+
+        Return is a dict suitable for logging context, with the same keys as
+        process_queue.
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.request_halt, signum, None)
+        exit_on = "unknown"
+        self.cycles = 0
+        self.total_messages = 0
+        self.failed_messages = 0
+        self.pause_count = 0
+        self.start_time = time.monotonic()
+
+        while not self.halt_requested:
+            try:
+                cycle_data = {
+                    "cycle_num": self.cycles,
+                    "cycle_s": 0.0,
+                }
+                if self.queue_refresh_is_due():
+                    cycle_data.update(
+                        await self.run_sqs(self.refresh_and_emit_queue_count_metrics)
+                    )
+                self.write_healthcheck()
+
+                # Check if we should exit due to time limit
+                if self.max_seconds is not None:
+                    elapsed = time.monotonic() - self.start_time
+                    if elapsed >= self.max_seconds:
+                        exit_on = "max_seconds"
+                        break
+
+                with Timer(logger=None) as cycle_timer:
+                    room = self.max_in_flight - len(self.in_flight)
+                    if room <= 0:
+                        await asyncio.wait(
+                            self.in_flight, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        message_batch = []
+                    else:
+                        message_batch, poll_data = await self.run_sqs(
+                            self.poll_queue_for_messages, min(room, self.batch_size)
+                        )
+                        cycle_data.update(poll_data)
+                    for message in message_batch:
+                        self.in_flight.add(
+                            loop.run_in_executor(
+                                self.executor, self.process_message_in_thread, message
+                            )
+                        )
+                    cycle_data.update(await self.collect_completed_messages())
+                    if S3_DELETE_QUEUE.enabled:
+                        cycle_data.update(await self.run_sqs(S3_DELETE_QUEUE.flush))
+                    if COUNTER_BUFFER.enabled:
+                        # The database work runs on the message threads
+                        cycle_data.update(
+                            await loop.run_in_executor(
+                                self.executor, self.flush_counter_buffer_if_due
+                            )
+                        )
+
+                # Collect data and log progress
+                completed = cycle_data.get("completed_count", 0)
+                cycle_data["in_flight_count"] = len(self.in_flight)
+                cycle_data["message_total"] = self.total_messages
+                cycle_data["cycle_s"] = round(cycle_timer.last, 3)
+                logger.log(
+                    logging.INFO
+                    if (message_batch or completed or self.verbosity > 1)
+                    else logging.DEBUG,
+                    f"Cycle {self.cycles}: received"
+                    f" {self.pluralize(len(message_batch), 'message')},"
+                    f" completed {completed}",
+                    extra=cycle_data,
+                )
+
+                self.cycles += 1
+                gc.collect()  # Force garbage collection of boto3 SQS client resources
+
+            except KeyboardInterrupt:
+                self.halt_requested = True
+                exit_on = "interrupt"
+
+        if self.halt_requested and exit_on == "unknown":
+            exit_on = "interrupt"
+
+        # Finish the messages already started
+        if self.in_flight:
+            await asyncio.wait(self.in_flight)
+            await self.collect_completed_messages()
+
+        process_data = {
+            "exit_on": exit_on,
+            "cycles": self.cycles,
+            "total_s": round(time.monotonic() - self.start_time, 3),
+            "total_messages": self.total_messages,
+        }
+        if self.failed_messages:
+            process_data["failed_messages"] = self.failed_messages
+        if self.pause_count:
+            process_data["pause_count"] = self.pause_count
+        return process_data
+
+    async def collect_completed_messages(self):
+        """
+        Gather the results of completed messages, and delete them from SQS.
+
+        Return is a dict suitable for logging context, with these keys:
+        * completed_count: How many messages completed, omitted if 0
+        * process_s, pause_count, pause_s, failed_count, delete_*: As returned
+          by process_message_batch, for the completed messages
+        """
+        done = {future for future in self.in_flight if future.done()}
+        if not done:
+            return {}
+        self.in_flight -= done
+        self.write_healthcheck()
+
+        failed_count = 0
+        pause_time = 0.0
+        pause_count = 0
+        process_time = 0.0
+        to_delete = []
+        for future in done:
+            message, message_data, message_time = future.result()
+            if not message_data["success"]:
+                failed_count += 1
+            if message_data["success"] or self.delete_failed_messages:
+                to_delete.append(message)
+            pause_time += message_data.get("pause_s", 0.0)
+            pause_count += message_data.get("pause_count", 0)
+            process_time += message_time
+
+        self.total_messages += len(done)
+        self.failed_messages += failed_count
+        self.pause_count += pause_count
+
+        data = {
+            "completed_count": len(done),
+            "process_s": round((process_time - pause_time), 3),
+        }
+        if pause_count:
+            data["pause_count"] = pause_count
+            data["pause_s"] = round(pause_time, 3)
+        if failed_count:
+            data["failed_count"] = failed_count
+        if to_delete:
+            data.update(await self.run_sqs(self.delete_messages, to_delete))
+        return data
@@ -0,0 +1,28 @@
+"""
+Rebuild the Bloom filter of relay addresses, used to reject unknown recipients.
+
+Run this periodically, more often than RELAY_ADDRESS_FILTER_MAX_AGE_SECONDS,
+so that the email processes have a filter to use. See emails/address_filter.py.
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emails.address_filter import rebuild_address_filter
+
+logger = logging.getLogger("eventsinfo.rebuild_address_filter")
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Bloom filter of relay addresses in the cache."
+
+    def handle(self, *args, **options):
+        filter_data = rebuild_address_filter()
+        if filter_data is None:
+            raise CommandError("RELAY_ADDRESS_FILTER_CACHE is not set.")
+        logger.info("Rebuilt address filter", extra=filter_data)
+        self.stdout.write(
+            f"Rebuilt address filter with {filter_data['count']} addresses"
+            f" in {filter_data['size_bytes']} bytes"
+        )
@@ -0,0 +1,117 @@
+"""
+MessageProfiler profiles a sample of the messages processed from a queue.
+
+When enabled, every Nth message is processed under cProfile, and the profiles
+are added up into one set of stats. The stats are written to a directory as
+a pstats file after a number of profiled messages, when profiling is turned
+off, and when the command exits. The files can be read with pstats, or
+converted to flame graphs with tools like flameprof or snakeviz.
+
+Profiling can be turned on and off with SIGUSR1, to profile a running worker
+without restarting it. When it is off, the cost is a flag check per message.
+With PROCESS_EMAIL_WORKER_PROCESSES > 1, send SIGUSR1 to the command's process
+to toggle profiling in every worker, or to one worker's pid, from the "workers"
+entries of the healthcheck file, to toggle only that worker.
+"""
+
+from datetime import datetime, timezone
+import contextlib
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import signal
+import threading
+
+logger = logging.getLogger("eventsinfo.process_emails_from_sqs")
+
+
+class MessageProfiler:
+    """Profile every Nth processed message, and write the combined stats."""
+
+    # Write the stats after this many profiled messages
+    WRITE_EVERY_PROFILES = 100
+
+    def __init__(self, every, directory, enabled=False):
+        self.every = every
+        self.directory = directory
+        self.enabled = enabled
+        self.message_counter = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = None
+        self.profiled_count = 0
+        self.old_sigusr1 = None
+
+    def install_signal_handler(self):
+        """Toggle profiling on SIGUSR1, until close()."""
+        self.old_sigusr1 = signal.signal(signal.SIGUSR1, self.toggle)
+
+    def close(self):
+        """Write the remaining stats, and restore the SIGUSR1 handler."""
+        self.write_stats()
+        if self.old_sigusr1 is not None:
+            signal.signal(signal.SIGUSR1, self.old_sigusr1)
+            self.old_sigusr1 = None
+
+    def toggle(self, signum=None, frame=None):
+        """Signal handler to turn profiling on or off."""
+        self.enabled = not self.enabled
+
+    @contextlib.contextmanager
+    def profile(self):
+        """Profile the block, if profiling is on and it is the Nth message."""
+        if not self.enabled:
+            if self.profiled_count:
+                # Profiling was turned off, write the profiles so far
+                self.write_stats()
+            yield
+            return
+        if next(self.message_counter) % self.every:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.add_profile(profiler)
+
+    def add_profile(self, profiler):
+        """Add a message profile to the stats, and write them if due."""
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+            self.profiled_count += 1
+            if self.profiled_count >= self.WRITE_EVERY_PROFILES:
+                self._write_stats()
+
+    def write_stats(self):
+        """
+        Write the stats of the profiled messages, if any.
+
+        Return is the path of the stats file, or None if there were no profiles.
+        """
+        with self.lock:
+            return self._write_stats()
+
+    def _write_stats(self):
+        if not self.profiled_count:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = datetime.now(tz=timezone.utc).strftime("%Y%m%dT%H%M%S.%f")
+        path = os.path.join(
+            self.directory, f"process_emails_{os.getpid()}_{timestamp}.prof"
+        )
+        self.stats.dump_stats(path)
+        logger.info(
+            "Profile stats written",
+            extra={"path": path, "profiled_messages": self.profiled_count},
+        )
+        self.stats = None
+        self.profiled_count = 0
+        return path
@@ -0,0 +1,243 @@
+"""
+WorkerSupervisor runs a queue processing command in several forked processes.
+
+Each worker process runs the command's processing loop, and sends its
+healthcheck data to the supervisor over a multiprocessing queue. The
+supervisor writes one healthcheck file with an entry per worker, restarts
+workers that crash, and asks the workers to exit gracefully when it is
+interrupted or terminated. SIGUSR1 is forwarded to the workers, to turn
+message profiling on and off in all of them.
+"""
+
+from datetime import datetime, timezone
+from queue import Empty
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from django.core.management.base import CommandError
+from django.db import connections
+
+from emails.utils import incr_if_enabled
+
+logger = logging.getLogger("eventsinfo.process_emails_from_sqs")
+
+# The per-worker counters that are summed for the process data and healthcheck
+SUMMED_KEYS = ("cycles", "total_messages", "failed_messages", "pause_count")
+
+
+class WorkerSupervisor:
+    """Fork and supervise worker processes for a queue processing command."""
+
+    # Pause before restarting a crashed worker
+    RESTART_DELAY_SECONDS = 1
+    # Give up if a worker crashes this many times without completing a cycle
+    MAX_CRASHES_WITHOUT_PROGRESS = 5
+
+    def __init__(self, command):
+        self.command = command
+        self.worker_count = command.worker_processes
+        self.healthcheck_path = command.healthcheck_path
+        self.context = multiprocessing.get_context("fork")
+        self.status_queue = self.context.Queue()
+        self.processes = {}
+        self.worker_data = {}
+        self.exit_data = {}
+        self.retired_totals = {key: 0 for key in SUMMED_KEYS}
+        self.crashes_without_progress = {}
+        self.restarts = 0
+        self.halt_requested = False
+        self.pid = os.getpid()
+
+    def run(self):
+        """
+        Run the workers until they all exit.
+
+        Return is a dict suitable for logging context, with these keys:
+        * exit_on: Why the workers exited, if all the same, else "unknown"
+        * worker_processes: The number of worker processes
+        * restarts: The number of crashed workers that were restarted, omitted if 0
+        * cycles, total_messages, failed_messages, pause_count: Summed for all
+          workers, including restarted workers. The last two are omitted if 0.
+        * total_s: The total execution time, in seconds with millisecond precision
+        """
+        start_time = time.monotonic()
+        old_sigterm = signal.signal(signal.SIGTERM, self.request_halt)
+        old_sigusr1 = signal.signal(signal.SIGUSR1, self.forward_signal)
+        # Forked processes should open their own database connections
+        connections.close_all()
+        try:
+            for worker_num in range(self.worker_count):
+                self.start_worker(worker_num)
+            while self.processes:
+                try:
+                    self.supervise()
+                except KeyboardInterrupt:
+                    self.request_halt()
+            self.read_status()
+        finally:
+            signal.signal(signal.SIGTERM, old_sigterm)
+            signal.signal(signal.SIGUSR1, old_sigusr1)
+
+        exit_ons = {data["exit_on"] for data in self.exit_data.values()}
+        process_data = {
+            "exit_on": exit_ons.pop() if len(exit_ons) == 1 else "unknown",
+            "worker_processes": self.worker_count,
+        }
+        if self.restarts:
+            process_data["restarts"] = self.restarts
+        process_data.update(self.totals())
+        for key in ("failed_messages", "pause_count"):
+            if not process_data[key]:
+                del process_data[key]
+        process_data["total_s"] = round(time.monotonic() - start_time, 3)
+        return process_data
+
+    def start_worker(self, worker_num):
+        """Fork a worker process."""
+        self.exit_data.pop(worker_num, None)
+        process = self.context.Process(
+            target=self.command.run_worker_process,
+            args=(worker_num, self.status_queue),
+            name=f"process_emails_worker_{worker_num}",
+        )
+        process.start()
+        self.processes[worker_num] = process
+        self.worker_data[worker_num] = {
+            "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+            "pid": process.pid,
+        }
+        self.write_healthcheck()
+
+    def supervise(self):
+        """Read status from the workers, and handle workers that exited."""
+        self.read_status(timeout=1)
+        for worker_num, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            # Read the last status sent before the worker exited
+            self.read_status()
+            del self.processes[worker_num]
+            self.retire_worker(worker_num)
+            if process.exitcode == 0 or self.halt_requested:
+                continue
+
+            crashes = self.crashes_without_progress.get(worker_num, 0) + 1
+            self.crashes_without_progress[worker_num] = crashes
+            logger.error(
+                "Worker process crashed",
+                extra={
+                    "worker_num": worker_num,
+                    "exitcode": process.exitcode,
+                    "crashes_without_progress": crashes,
+                },
+            )
+            incr_if_enabled("email_worker_process_crash", 1)
+            if crashes >= self.MAX_CRASHES_WITHOUT_PROGRESS:
+                self.request_halt()
+                raise CommandError(f"Worker process {worker_num} crashed repeatedly")
+
+            time.sleep(self.RESTART_DELAY_SECONDS)
+            self.restarts += 1
+            self.start_worker(worker_num)
+
+    def retire_worker(self, worker_num):
+        """
+        Keep the counts of an exited worker, and remove it from the healthcheck.
+
+        A worker that exited cleanly sent its final counts, which include the
+        cycle after its last healthcheck. For a crashed worker, the counts of
+        its last healthcheck are used.
+        """
+        data = self.worker_data.pop(worker_num)
+        if worker_num in self.exit_data:
+            data = self.exit_data[worker_num]
+        for key in SUMMED_KEYS:
+            self.retired_totals[key] += data.get(key, 0)
+        self.write_healthcheck()
+
+    def read_status(self, timeout=None):
+        """
+        Read status messages from the workers.
+
+        Waits up to timeout seconds for the first message, then reads any
+        other waiting messages. With no timeout, only waiting messages are read.
+        """
+        changed = False
+        while True:
+            try:
+                if timeout:
+                    kind, worker_num, data = self.status_queue.get(timeout=timeout)
+                    timeout = None
+                else:
+                    kind, worker_num, data = self.status_queue.get_nowait()
+            except Empty:
+                break
+            if kind == "exit":
+                self.exit_data[worker_num] = data
+            elif kind == "healthcheck" and worker_num in self.worker_data:
+                data["pid"] = self.worker_data[worker_num]["pid"]
+                self.worker_data[worker_num] = data
+                if data.get("cycles"):
+                    self.crashes_without_progress[worker_num] = 0
+                changed = True
+
+        if changed:
+            self.write_healthcheck()
+
+    def request_halt(self, signum=None, frame=None):
+        """Ask the workers to exit after their current cycle."""
+        self.halt_requested = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    def forward_signal(self, signum, frame=None):
+        """Signal handler to send the signal on to the workers."""
+        if os.getpid() != self.pid:
+            # A worker that has not installed its own handler yet
+            return
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def totals(self):
+        """Sum the counters of current and crashed workers."""
+        totals = dict(self.retired_totals)
+        for data in self.worker_data.values():
+            for key in SUMMED_KEYS:
+                totals[key] += data.get(key, 0)
+        return totals
+
+    def write_healthcheck(self):
+        """
+        Write the healthcheck file for all the workers.
+
+        The top-level timestamp is the oldest worker timestamp, so the
+        healthcheck fails if any worker stops updating.
+        """
+        if not self.worker_data:
+            return
+        workers = {
+            str(worker_num): data for worker_num, data in self.worker_data.items()
+        }
+        oldest = min(
+            self.worker_data.values(),
+            key=lambda data: datetime.fromisoformat(data["timestamp"]),
+        )
+        newest = max(
+            self.worker_data.values(),
+            key=lambda data: datetime.fromisoformat(data["timestamp"]),
+        )
+        data = {"timestamp": oldest["timestamp"]}
+        data.update(self.totals())
+        for key in ("queue_count", "queue_count_delayed", "queue_count_not_visible"):
+            if key in newest:
+                data[key] = newest[key]
+        data["workers"] = workers
+        with open(self.healthcheck_path, "w", encoding="utf-8") as healthcheck_file:
+            json.dump(data, healthcheck_file)
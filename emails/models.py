@@ -6,13 +6,18 @@ import logging
 import random
 import re
 import string
+import threading
+import time
 import uuid
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.core.exceptions import BadRequest
 from django.core.validators import MinLengthValidator
-from django.db import models, transaction
+from django.db import DatabaseError, models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Coalesce
 from django.dispatch import receiver
 from django.utils.functional import cached_property
 from django.utils.translation.trans_real import (
@@ -380,50 +385,28 @@ class Profile(models.Model):
         email_forwarded=False,
         forwarded_email_size=0,
     ):
-        #  TODO: this should be wrapped in atomic to ensure race conditions are properly handled
-        # look for abuse metrics created on the same UTC date, regardless of time.
-        midnight_utc_today = datetime.combine(
-            datetime.now(timezone.utc).date(), datetime.min.time()
-        ).astimezone(timezone.utc)
-        midnight_utc_tomorow = midnight_utc_today + timedelta(days=1)
-        abuse_metric = self.user.abusemetrics_set.filter(
-            first_recorded__gte=midnight_utc_today,
-            first_recorded__lt=midnight_utc_tomorow,
-        ).first()
-        if not abuse_metric:
-            abuse_metric = AbuseMetrics.objects.create(user=self.user)
-            AbuseMetrics.objects.filter(first_recorded__lt=midnight_utc_today).delete()
-
-        # increment the abuse metric
-        if address_created:
-            abuse_metric.num_address_created_per_day += 1
-        if replied:
-            abuse_metric.num_replies_per_day += 1
-        if email_forwarded:
-            abuse_metric.num_email_forwarded_per_day += 1
-        if forwarded_email_size > 0:
-            abuse_metric.forwarded_email_size_per_day += forwarded_email_size
-        abuse_metric.last_recorded = datetime.now(timezone.utc)
-        abuse_metric.save()
+        amounts = {
+            "num_address_created_per_day": int(address_created),
+            "num_replies_per_day": int(replied),
+            "num_email_forwarded_per_day": int(email_forwarded),
+            "forwarded_email_size_per_day": max(forwarded_email_size, 0),
+        }
+        if ABUSE_COUNTERS.enabled:
+            counts = ABUSE_COUNTERS.increment(self.user_id, amounts)
+        else:
+            counts = self._update_abuse_metric_row(amounts)
 
         # check user should be flagged for abuse
-        hit_max_create = False
-        hit_max_replies = False
-        hit_max_forwarded = False
-        hit_max_forwarded_email_size = False
-
         hit_max_create = (
-            abuse_metric.num_address_created_per_day
+            counts["num_address_created_per_day"]
             >= settings.MAX_ADDRESS_CREATION_PER_DAY
         )
-        hit_max_replies = (
-            abuse_metric.num_replies_per_day >= settings.MAX_REPLIES_PER_DAY
-        )
+        hit_max_replies = counts["num_replies_per_day"] >= settings.MAX_REPLIES_PER_DAY
         hit_max_forwarded = (
-            abuse_metric.num_email_forwarded_per_day >= settings.MAX_FORWARDED_PER_DAY
+            counts["num_email_forwarded_per_day"] >= settings.MAX_FORWARDED_PER_DAY
         )
         hit_max_forwarded_email_size = (
-            abuse_metric.forwarded_email_size_per_day
+            counts["forwarded_email_size_per_day"]
             >= settings.MAX_FORWARDED_EMAIL_SIZE_PER_DAY
         )
         if (
@@ -434,18 +417,44 @@ class Profile(models.Model):
         ):
             self.last_account_flagged = datetime.now(timezone.utc)
             self.save()
+            if ABUSE_COUNTERS.enabled:
+                # secops review needs the counts now, not at the next snapshot
+                ABUSE_COUNTERS.persist_user(self.user_id, counts)
             data = {
                 "uid": self.fxa.uid,
                 "flagged": self.last_account_flagged.timestamp(),
-                "replies": abuse_metric.num_replies_per_day,
-                "addresses": abuse_metric.num_address_created_per_day,
-                "forwarded": abuse_metric.num_email_forwarded_per_day,
-                "forwarded_size_in_bytes": abuse_metric.forwarded_email_size_per_day,
+                "replies": counts["num_replies_per_day"],
+                "addresses": counts["num_address_created_per_day"],
+                "forwarded": counts["num_email_forwarded_per_day"],
+                "forwarded_size_in_bytes": counts["forwarded_email_size_per_day"],
             }
             # log for further secops review
             abuse_logger.info("Abuse flagged", extra=data)
         return self.last_account_flagged
 
+    def _update_abuse_metric_row(self, amounts):
+        """Add to today's AbuseMetrics row, and return the counts."""
+        #  TODO: this should be wrapped in atomic to ensure race conditions are properly handled
+        # look for abuse metrics created on the same UTC date, regardless of time.
+        midnight_utc_today = datetime.combine(
+            datetime.now(timezone.utc).date(), datetime.min.time()
+        ).astimezone(timezone.utc)
+        midnight_utc_tomorow = midnight_utc_today + timedelta(days=1)
+        abuse_metric = self.user.abusemetrics_set.filter(
+            first_recorded__gte=midnight_utc_today,
+            first_recorded__lt=midnight_utc_tomorow,
+        ).first()
+        if not abuse_metric:
+            abuse_metric = AbuseMetrics.objects.create(user=self.user)
+            AbuseMetrics.objects.filter(first_recorded__lt=midnight_utc_today).delete()
+
+        # increment the abuse metric
+        for name, amount in amounts.items():
+            setattr(abuse_metric, name, getattr(abuse_metric, name) + amount)
+        abuse_metric.last_recorded = datetime.now(timezone.utc)
+        abuse_metric.save()
+        return {name: getattr(abuse_metric, name) for name in amounts}
+
     @property
     def is_flagged(self):
         if not self.last_account_flagged:
@@ -504,6 +513,169 @@ def is_blocklisted(value):
     return any(blockedword == value for blockedword in emails_config.blocklist)
 
 
+def increment_counters(instance, counters, **values):
+    """
+    Add to the counters of a saved model instance, with one UPDATE statement.
+
+    The database adds the amounts (SET col = col + n), so concurrent updates
+    are not lost, and the other fields of the row are not written. The
+    instance gets the new values, assuming no other process changed them.
+
+    Arguments:
+    instance - A saved model instance
+    counters - A dict of counter field names to the amounts to add
+    values - Other fields to set in the same statement, like last_used_at
+    """
+    model = type(instance)
+    counters = {name: amount for name, amount in counters.items() if amount}
+    updates = dict(values)
+    for name, amount in counters.items():
+        updates[name] = _counter_column(model, name) + amount
+    if not updates:
+        return
+    model.objects.filter(pk=instance.pk).update(**updates)
+    _apply_counters(instance, counters, values)
+
+
+def _counter_column(model, name):
+    if model._meta.get_field(name).null:
+        return Coalesce(F(name), 0)
+    return F(name)
+
+
+def _apply_counters(instance, counters, values):
+    for name, amount in counters.items():
+        setattr(instance, name, (getattr(instance, name) or 0) + amount)
+    for name, value in values.items():
+        setattr(instance, name, value)
+
+
+class CounterBuffer:
+    """
+    Collect counter increments, to write them later in bulk.
+
+    When enabled, increment() adds up the counters of each row in memory, and
+    keeps the highest of the other values, like last_used_at. flush() writes
+    them with one UPDATE statement per model and MAX_ROWS_PER_UPDATE rows, and
+    keeps rows that failed to write for the next flush. When disabled,
+    increment() writes right away with increment_counters().
+    """
+
+    MAX_ROWS_PER_UPDATE = 500
+
+    def __init__(self):
+        self.enabled = False
+        self.max_increments = 1000
+        self.pending = {}  # (model, pk) -> (counters, values)
+        self.increment_count = 0
+        self.lock = threading.Lock()
+
+    def increment(self, instance, counters, **values):
+        """Buffer increments, and flush if there are max_increments."""
+        if not self.enabled:
+            increment_counters(instance, counters, **values)
+            return
+        with self.lock:
+            self._merge((type(instance), instance.pk), counters, values)
+            self.increment_count += 1
+            full = self.increment_count >= self.max_increments
+        _apply_counters(instance, counters, values)
+        if full:
+            self.flush()
+
+    def _merge(self, key, counters, values):
+        row_counters, row_values = self.pending.setdefault(key, ({}, {}))
+        for name, amount in counters.items():
+            if amount:
+                row_counters[name] = row_counters.get(name, 0) + amount
+        for name, value in values.items():
+            if name not in row_values or value > row_values[name]:
+                row_values[name] = value
+
+    def flush(self):
+        """
+        Write the buffered increments.
+
+        Return is a dict suitable for logging context, empty if nothing was
+        buffered, with these keys:
+        * counter_rows: How many rows were updated
+        * counter_failed_rows: How many rows failed to update, and are kept for
+          the next flush, omitted if 0
+        """
+        with self.lock:
+            rows, self.pending = self.pending, {}
+            self.increment_count = 0
+        if not rows:
+            return {}
+
+        by_model = {}
+        for (model, pk), row in rows.items():
+            by_model.setdefault(model, {})[pk] = row
+        updated_count = 0
+        failed = {}
+        for model, model_rows in by_model.items():
+            pks = list(model_rows)
+            for start in range(0, len(pks), self.MAX_ROWS_PER_UPDATE):
+                batch = {
+                    pk: model_rows[pk]
+                    for pk in pks[start : start + self.MAX_ROWS_PER_UPDATE]
+                }
+                try:
+                    _update_counter_rows(model, batch)
+                except DatabaseError:
+                    logger.exception(
+                        "counter_buffer_flush_failed",
+                        extra={"model": model.__name__, "rows": len(batch)},
+                    )
+                    for pk, row in batch.items():
+                        failed[(model, pk)] = row
+                else:
+                    updated_count += len(batch)
+
+        data = {"counter_rows": updated_count}
+        if failed:
+            with self.lock:
+                for key, (counters, values) in failed.items():
+                    self._merge(key, counters, values)
+            data["counter_failed_rows"] = len(failed)
+        return data
+
+
+def _update_counter_rows(model, rows):
+    """Add different amounts to the counters of several rows, in one UPDATE."""
+    counter_names = {name for counters, _ in rows.values() for name in counters}
+    value_names = {name for _, values in rows.values() for name in values}
+    updates = {}
+    for name in counter_names:
+        field = model._meta.get_field(name)
+        amounts = Case(
+            *(
+                When(pk=pk, then=Value(counters[name]))
+                for pk, (counters, _) in rows.items()
+                if name in counters
+            ),
+            default=Value(0),
+            output_field=field,
+        )
+        updates[name] = _counter_column(model, name) + amounts
+    for name in value_names:
+        field = model._meta.get_field(name)
+        updates[name] = Case(
+            *(
+                When(pk=pk, then=Value(values[name], output_field=field))
+                for pk, (_, values) in rows.items()
+                if name in values
+            ),
+            default=F(name),
+            output_field=field,
+        )
+    if updates:
+        model.objects.filter(pk__in=list(rows)).update(**updates)
+
+
+COUNTER_BUFFER = CounterBuffer()
+
+
 def get_domain_numerical(domain_address):
     # get domain name from the address
     domains = get_domains_from_settings()
@@ -859,9 +1031,9 @@ class Reply(models.Model):
 
     def increment_num_replied(self):
         address = self.relay_address or self.domain_address
-        address.num_replied += 1
-        address.last_used_at = datetime.now(timezone.utc)
-        address.save(update_fields=["num_replied", "last_used_at"])
+        COUNTER_BUFFER.increment(
+            address, {"num_replied": 1}, last_used_at=datetime.now(timezone.utc)
+        )
         return address.num_replied
 
 
@@ -878,3 +1050,118 @@ class AbuseMetrics(models.Model):
 
     class Meta:
         unique_together = ["user", "first_recorded"]
+
+
+class AbuseCounters:
+    """
+    Count the daily abuse metrics of users in a shared cache.
+
+    When enabled by settings.RELAY_ABUSE_METRICS_CACHE, update_abuse_metric
+    adds to counters with atomic cache increments (INCRBY in Redis), in keys
+    for the UTC day, so the email and address paths do not read or write
+    AbuseMetrics rows. The counts of the users that this process updated are
+    saved to AbuseMetrics every RELAY_ABUSE_METRICS_PERSIST_SECONDS, by
+    persist(), and when a user is flagged, for secops reports.
+    """
+
+    FIELDS = (
+        "num_address_created_per_day",
+        "num_replies_per_day",
+        "num_email_forwarded_per_day",
+        "forwarded_email_size_per_day",
+    )
+    # The counters expire after their UTC day, with an hour to spare
+    EXPIRE_SECONDS = 25 * 60 * 60
+
+    def __init__(self):
+        self.updated_users = {}  # user_id -> UTC date of the counts
+        self.persisted_at = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        alias = getattr(settings, "RELAY_ABUSE_METRICS_CACHE", "")
+        return caches[alias] if alias else None
+
+    @property
+    def enabled(self):
+        return self.cache is not None
+
+    def _key(self, day, user_id, name):
+        return f"abuse-metrics:{day.isoformat()}:{user_id}:{name}"
+
+    def increment(self, user_id, amounts):
+        """Add to the user's counters for today, and return the counts."""
+        cache = self.cache
+        day = datetime.now(timezone.utc).date()
+        keys = {name: self._key(day, user_id, name) for name in self.FIELDS}
+        counts = {}
+        for name, amount in amounts.items():
+            if not amount:
+                continue
+            cache.add(keys[name], 0, self.EXPIRE_SECONDS)
+            try:
+                counts[name] = cache.incr(keys[name], amount)
+            except ValueError:
+                # The key was evicted after the add
+                cache.set(keys[name], amount, self.EXPIRE_SECONDS)
+                counts[name] = amount
+        others = [keys[name] for name in self.FIELDS if name not in counts]
+        values = cache.get_many(others) if others else {}
+        for name in self.FIELDS:
+            if name not in counts:
+                counts[name] = values.get(keys[name], 0)
+
+        with self.lock:
+            self.updated_users[user_id] = day
+        self.persist_if_due()
+        return counts
+
+    def persist_if_due(self):
+        """Save the snapshots, if it is time to."""
+        now = time.time()
+        if now - self.persisted_at < settings.RELAY_ABUSE_METRICS_PERSIST_SECONDS:
+            return
+        self.persisted_at = now
+        self.persist()
+
+    def persist(self):
+        """
+        Save today's counts of the updated users to AbuseMetrics.
+
+        The counts of earlier days are not saved, since AbuseMetrics keeps
+        only the current day. Return is the number of snapshots saved.
+        """
+        with self.lock:
+            updated_users, self.updated_users = self.updated_users, {}
+        cache = self.cache
+        if cache is None:
+            return 0
+        today = datetime.now(timezone.utc).date()
+        user_ids = [user_id for user_id, day in updated_users.items() if day == today]
+        for user_id in user_ids:
+            keys = {name: self._key(today, user_id, name) for name in self.FIELDS}
+            values = cache.get_many(keys.values())
+            self.persist_user(
+                user_id, {name: values.get(key, 0) for name, key in keys.items()}
+            )
+        return len(user_ids)
+
+    def persist_user(self, user_id, counts):
+        """Save a user's counts to their AbuseMetrics row for today."""
+        midnight_utc_today = datetime.combine(
+            datetime.now(timezone.utc).date(), datetime.min.time(), tzinfo=timezone.utc
+        )
+        abuse_metric = AbuseMetrics.objects.filter(
+            user_id=user_id, first_recorded__gte=midnight_utc_today
+        ).first()
+        if abuse_metric is None:
+            abuse_metric = AbuseMetrics(user_id=user_id)
+            AbuseMetrics.objects.filter(first_recorded__lt=midnight_utc_today).delete()
+        for name, count in counts.items():
+            setattr(abuse_metric, name, count)
+        abuse_metric.last_recorded = datetime.now(timezone.utc)
+        abuse_metric.save()
+
+
+ABUSE_COUNTERS = AbuseCounters()
@@ -3,10 +3,12 @@ import logging
 
 from django.contrib.auth.models import User
 
-from django.core.exceptions import BadRequest
-from django.db.models.signals import post_save, pre_save
+from django.core.exceptions import BadRequest, ObjectDoesNotExist
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
+from emails.address_filter import add_address_to_filter
+from emails.alias_cache import invalidate_alias
 from emails.models import DomainAddress, Profile, RelayAddress
 from emails.utils import incr_if_enabled, set_user_group
 
@@ -32,6 +34,29 @@ def check_premium_for_block_list_emails(sender, instance, **kwargs):
                 raise BadRequest("Must be premium to set block_list_emails")
 
 
+@receiver(post_save, sender=RelayAddress)
+@receiver(post_save, sender=DomainAddress)
+@receiver(post_delete, sender=RelayAddress)
+@receiver(post_delete, sender=DomainAddress)
+def invalidate_alias_cache(sender, instance, created=True, **kwargs):
+    # Updates do not change the cached identity of an address
+    if not created:
+        return
+    try:
+        full_address = instance.full_address
+    except ObjectDoesNotExist:
+        # The user and profile are being deleted, and the cached address will
+        # fail to load
+        return
+    invalidate_alias(full_address)
+
+
+@receiver(post_save, sender=RelayAddress)
+def add_to_address_filter(sender, instance, created, **kwargs):
+    if created:
+        add_address_to_filter(instance.full_address)
+
+
 @receiver(pre_save, sender=Profile)
 def measure_feature_usage(sender, instance, **kwargs):
     if instance._state.adding:
@@ -1,9 +1,14 @@
 # Inspired by django-bouncy utils:
 # https://github.com/organizerconnect/django-bouncy/blob/master/django_bouncy/utils.py
 
+from collections import OrderedDict
+from datetime import datetime, timezone
 import base64
+import hashlib
 import logging
 import pem
+import threading
+import time
 from urllib.request import urlopen
 
 from OpenSSL import crypto
@@ -16,47 +21,43 @@ from django.utils.encoding import smart_bytes
 
 logger = logging.getLogger("events")
 
-NOTIFICATION_HASH_FORMAT = """Message
-{Message}
-MessageId
-{MessageId}
-Subject
-{Subject}
-Timestamp
-{Timestamp}
-TopicArn
-{TopicArn}
-Type
-{Type}
-"""
-
-NOTIFICATION_WITHOUT_SUBJECT_HASH_FORMAT = """Message
-{Message}
-MessageId
-{MessageId}
-Timestamp
-{Timestamp}
-TopicArn
-{TopicArn}
-Type
-{Type}
-"""
-
-SUBSCRIPTION_HASH_FORMAT = """Message
-{Message}
-MessageId
-{MessageId}
-SubscribeURL
-{SubscribeURL}
-Timestamp
-{Timestamp}
-Token
-{Token}
-TopicArn
-{TopicArn}
-Type
-{Type}
-"""
+# The keys of the signed fields, in the order of the canonical string
+NOTIFICATION_HASH_KEYS = (
+    "Message",
+    "MessageId",
+    "Subject",
+    "Timestamp",
+    "TopicArn",
+    "Type",
+)
+NOTIFICATION_WITHOUT_SUBJECT_HASH_KEYS = (
+    "Message",
+    "MessageId",
+    "Timestamp",
+    "TopicArn",
+    "Type",
+)
+SUBSCRIPTION_HASH_KEYS = (
+    "Message",
+    "MessageId",
+    "SubscribeURL",
+    "Timestamp",
+    "Token",
+    "TopicArn",
+    "Type",
+)
+
+# The number of loaded signing certificates to keep, by URL
+SIGNING_CERT_CACHE_SIZE = 16
+_signing_certs: OrderedDict[str, tuple[crypto.X509, float]] = OrderedDict()
+_signing_certs_lock = threading.Lock()
+
+# Successful verifications are kept for a window, so that a redelivered or
+# reprocessed message is not verified again
+VERIFIED_CACHE_SIZE = 10_000
+VERIFIED_CACHE_SECONDS = 60 * 60
+_verified: OrderedDict[tuple[str, bytes], float] = OrderedDict()
+_verified_lock = threading.Lock()
 
 SUPPORTED_SNS_TYPES = [
     "SubscriptionConfirmation",
@@ -65,26 +66,128 @@ SUPPORTED_SNS_TYPES = [
 
 
 def verify_from_sns(json_body):
-    pemfile = _grab_keyfile(json_body["SigningCertURL"])
-    cert = crypto.load_certificate(crypto.FILETYPE_PEM, pemfile)
-    signature = base64.decodebytes(json_body["Signature"].encode("utf-8"))
+    hash_keys = _get_hash_keys(json_body)
+    canonical = "".join(f"{key}\n{json_body[key]}\n" for key in hash_keys).encode(
+        "utf-8"
+    )
+    verified_key = _get_verified_key(json_body, canonical)
+    if _is_verified(verified_key):
+        return json_body
 
-    hash_format = _get_hash_format(json_body)
+    cert = _get_signing_cert(json_body["SigningCertURL"])
+    signature = base64.decodebytes(json_body["Signature"].encode("utf-8"))
 
-    crypto.verify(
-        cert, signature, hash_format.format(**json_body).encode("utf-8"), "sha1"
-    )
+    crypto.verify(cert, signature, canonical, "sha1")
+    _add_verified(verified_key)
     return json_body
 
 
-def _get_hash_format(json_body):
+def verify_batch_from_sns(json_bodies):
+    """
+    Verify the signatures of a batch of SNS messages.
+
+    Return is a list with an item for each message, the verified message, or
+    the KeyError or crypto.Error if its signature could not be verified, so
+    that a bad signature only fails its message. Other errors, such as a
+    failed certificate download, are raised. Messages verified in the last
+    VERIFIED_CACHE_SECONDS are not verified again.
+    """
+    results = []
+    for json_body in json_bodies:
+        try:
+            results.append(verify_from_sns(json_body))
+        except (KeyError, crypto.Error) as e:
+            results.append(e)
+    return results
+
+
+def _get_verified_key(json_body, canonical):
+    """
+    Get the verification cache key of a message.
+
+    The key is the MessageId and a digest of the signature, the certificate
+    URL, and the signed content, so a cached verification does not match a
+    message with different content.
+    """
+    digest = hashlib.sha256()
+    for value in (json_body["Signature"], json_body["SigningCertURL"]):
+        digest.update(value.encode("utf-8"))
+        digest.update(b"\n")
+    digest.update(canonical)
+    return json_body["MessageId"], digest.digest()
+
+
+def _is_verified(verified_key):
+    with _verified_lock:
+        expires_at = _verified.get(verified_key)
+        if expires_at is None:
+            return False
+        if time.time() >= expires_at:
+            del _verified[verified_key]
+            return False
+        return True
+
+
+def _add_verified(verified_key):
+    with _verified_lock:
+        _verified[verified_key] = time.time() + VERIFIED_CACHE_SECONDS
+        _verified.move_to_end(verified_key)
+        while len(_verified) > VERIFIED_CACHE_SIZE:
+            _verified.popitem(last=False)
+
+
+def _get_hash_keys(json_body):
     message_type = json_body["Type"]
     if message_type == "Notification":
         if "Subject" in json_body.keys():
-            return NOTIFICATION_HASH_FORMAT
-        return NOTIFICATION_WITHOUT_SUBJECT_HASH_FORMAT
+            return NOTIFICATION_HASH_KEYS
+        return NOTIFICATION_WITHOUT_SUBJECT_HASH_KEYS
+
+    return SUBSCRIPTION_HASH_KEYS
+
+
+def _get_signing_cert(cert_url):
+    """
+    Get the loaded signing certificate at a URL.
+
+    Loaded certificates are kept in a bounded in-process cache, so the PEM is
+    not parsed for each message. On a miss, the PEM is loaded from the shared
+    key cache, or downloaded. An expired certificate is dropped from both
+    caches and downloaded again, and is rejected if it is still expired.
+    """
+    with _signing_certs_lock:
+        cached = _signing_certs.get(cert_url)
+        if cached:
+            _signing_certs.move_to_end(cert_url)
+    if cached and time.time() < cached[1]:
+        return cached[0]
+
+    cert, expires_at = _load_signing_cert(cert_url)
+    if time.time() >= expires_at:
+        logger.warning("Expired SNS signing certificate: URL %s", cert_url)
+        _get_key_cache().delete(cert_url)
+        cert, expires_at = _load_signing_cert(cert_url)
+        if time.time() >= expires_at:
+            logger.error("Expired SNS signing certificate: URL %s", cert_url)
+            raise ValueError("Expired Certificate")
+
+    with _signing_certs_lock:
+        _signing_certs[cert_url] = (cert, expires_at)
+        _signing_certs.move_to_end(cert_url)
+        while len(_signing_certs) > SIGNING_CERT_CACHE_SIZE:
+            _signing_certs.popitem(last=False)
+    return cert
+
+
+def _load_signing_cert(cert_url):
+    """Load the signing certificate, and get its expiration as a timestamp."""
+    cert = crypto.load_certificate(crypto.FILETYPE_PEM, _grab_keyfile(cert_url))
+    not_after = datetime.strptime(cert.get_notAfter().decode(), "%Y%m%d%H%M%SZ")
+    return cert, not_after.replace(tzinfo=timezone.utc).timestamp()
+
 
-    return SUBSCRIPTION_HASH_FORMAT
+def _get_key_cache():
+    return caches[getattr(settings, "AWS_SNS_KEY_CACHE", "default")]
 
 
 def _grab_keyfile(cert_url):
@@ -94,7 +197,7 @@ def _grab_keyfile(cert_url):
             f'SNS SigningCertURL "{cert_url}" did not start with "{cert_url_origin}"'
         )
 
-    key_cache = caches[getattr(settings, "AWS_SNS_KEY_CACHE", "default")]
+    key_cache = _get_key_cache()
 
     pemfile = key_cache.get(cert_url)
     if not pemfile:
@@ -0,0 +1,42 @@
+from unittest.mock import patch
+
+from django.test import override_settings
+
+from emails.aws import aws_client_config, create_aws_client
+
+
+@override_settings(
+    AWS_REGION="us-west-2",
+    AWS_MAX_POOL_CONNECTIONS=25,
+    AWS_CONNECT_TIMEOUT=3,
+    AWS_READ_TIMEOUT=30,
+    AWS_TCP_KEEPALIVE=True,
+    AWS_RETRY_MODE="adaptive",
+    AWS_MAX_ATTEMPTS=4,
+)
+def test_aws_client_config_from_settings():
+    config = aws_client_config()
+    assert config.region_name == "us-west-2"
+    assert config.max_pool_connections == 25
+    assert config.connect_timeout == 3
+    assert config.read_timeout == 30
+    assert config.tcp_keepalive is True
+    assert config.retries == {"mode": "adaptive", "max_attempts": 4}
+
+
+@override_settings(AWS_RETRY_MODE="adaptive", AWS_MAX_ATTEMPTS=4)
+def test_aws_client_config_overrides():
+    config = aws_client_config(read_timeout=10, retries={"max_attempts": 1})
+    assert config.read_timeout == 10
+    assert config.retries == {"mode": "adaptive", "max_attempts": 1}
+
+
+@override_settings(AWS_REGION="us-east-1", AWS_MAX_POOL_CONNECTIONS=25)
+def test_create_aws_client():
+    with patch("emails.aws.boto3.client") as mock_client:
+        client = create_aws_client("s3", retries={"max_attempts": 1})
+    assert client == mock_client.return_value
+    (service_name,), kwargs = mock_client.call_args
+    assert service_name == "s3"
+    assert kwargs["config"].max_pool_connections == 25
+    assert kwargs["config"].retries["max_attempts"] == 1
@@ -0,0 +1,54 @@
+import json
+import random
+
+import pytest
+
+from django.core.management import call_command, CommandError
+
+from emails.management.commands.benchmark_trackers import generate_newsletter_html
+from emails.utils import TRACKERS
+
+
+def test_generate_newsletter_html_size():
+    html = generate_newsletter_html(10 * 1024, 0.5, random.Random(0))
+    assert html.startswith("<html>")
+    assert html.endswith("</html>")
+    assert 10 * 1024 <= len(html) < 12 * 1024
+
+
+def test_generate_newsletter_html_no_trackers():
+    html = generate_newsletter_html(10 * 1024, 0, random.Random(0))
+    assert TRACKERS.count(html)["count"] == 0
+    assert TRACKERS.count(html, level="strict")["count"] == 0
+
+
+def test_generate_newsletter_html_is_repeatable():
+    html1 = generate_newsletter_html(5 * 1024, 0.5, random.Random(1))
+    html2 = generate_newsletter_html(5 * 1024, 0.5, random.Random(1))
+    assert html1 == html2
+
+
+def test_benchmark_writes_results(tmp_path, capsys):
+    output = tmp_path / "results.json"
+    call_command(
+        "benchmark_trackers",
+        "--sizes=1,2",
+        "--densities=0,1",
+        "--emails=2",
+        f"--output={output}",
+    )
+    data = json.loads(output.read_text())
+    assert data["general_trackers"] == len(TRACKERS.general)
+    assert len(data["results"]) == 2 * 2 * 3
+    result = data["results"][0]
+    assert result["function"] == "remove_trackers"
+    assert result["size_kb"] == 1
+    assert result["tracker_density"] == 0
+    assert set(result["latency_ms"]) == {"p50", "p90", "p99"}
+    assert result["emails_per_s"] > 0
+    assert capsys.readouterr().out.count("emails/s") == 12
+
+
+def test_benchmark_unknown_function():
+    with pytest.raises(CommandError, match="Unknown functions: fake"):
+        call_command("benchmark_trackers", "--functions=fake")
@@ -64,6 +64,57 @@ def test_check_health_too_old(test_settings, caplog):
     ]
 
 
+def test_check_health_workers_passed(test_settings, caplog):
+    """check health succeeds when all the worker timestamps are recent."""
+    path = test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH
+    timestamp = datetime.now(tz=timezone.utc).isoformat()
+    data = {
+        "timestamp": timestamp,
+        "workers": {"0": {"timestamp": timestamp}, "1": {"timestamp": timestamp}},
+    }
+    with path.open("w", encoding="utf8") as f:
+        json.dump(data, f)
+    call_command("check_health")
+    assert caplog.record_tuples == []
+
+
+def test_check_health_worker_too_old(test_settings, caplog):
+    """check health fails when a worker timestamp is too old."""
+    path = test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH
+    timestamp = datetime.now(tz=timezone.utc).isoformat()
+    old_timestamp = (datetime.now(tz=timezone.utc) - timedelta(seconds=130)).isoformat()
+    data = {
+        "timestamp": timestamp,
+        "workers": {"0": {"timestamp": timestamp}, "1": {"timestamp": old_timestamp}},
+    }
+    with path.open("w", encoding="utf8") as f:
+        json.dump(data, f)
+    with pytest.raises(CommandError) as excinfo:
+        call_command("check_health")
+    assert str(excinfo.value) == "Healthcheck failed: Timestamp is too old for worker 1"
+
+
+def test_check_health_workers_in_numeric_order(test_settings, caplog):
+    """check health reports the lowest numbered worker that is too old."""
+    path = test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH
+    timestamp = datetime.now(tz=timezone.utc).isoformat()
+    old_timestamp = (datetime.now(tz=timezone.utc) - timedelta(seconds=130)).isoformat()
+    data = {
+        "timestamp": timestamp,
+        "workers": {
+            str(worker_num): {
+                "timestamp": old_timestamp if worker_num > 1 else timestamp
+            }
+            for worker_num in range(12)
+        },
+    }
+    with path.open("w", encoding="utf8") as f:
+        json.dump(data, f)
+    with pytest.raises(CommandError) as excinfo:
+        call_command("check_health")
+    assert str(excinfo.value) == "Healthcheck failed: Timestamp is too old for worker 2"
+
+
 def test_check_health_empty_json(test_settings, caplog):
     """check health fails when the JSON is empty."""
     path = test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH
@@ -0,0 +1,147 @@
+from unittest.mock import patch
+import json
+import os
+import signal
+
+import pytest
+
+from django.core.management import call_command
+
+from emails.tests.mgmt_process_emails_from_sqs_tests import (
+    TEST_SNS_MESSAGE,
+    deleted_receipt_handles,
+    fake_queue,
+    fake_sqs_message,
+    log_extra,
+    mock_sns_inbound_logic,
+    mock_sqs_client,
+    mock_verify_from_sns,
+    test_settings,
+)
+
+
+COMMAND_NAME = "process_emails_from_sqs_async"
+MOCK_BASE = "emails.management.commands.process_emails_from_sqs_async"
+
+
+@pytest.fixture(autouse=True)
+def mocked_clocks(test_settings):
+    """
+    Mock time.sleep(), and run until interrupted instead of until max_seconds.
+
+    The asyncio event loop uses time.monotonic(), so it can not be mocked to
+    step forward on each call like the synchronous command tests.
+    """
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    with patch(f"{MOCK_BASE}.time.sleep") as mock_sleep:
+        yield mock_sleep
+
+
+def summary_from_exit_log(caplog_fixture):
+    """Get the extra data from the final log message"""
+    last_log = caplog_fixture.records[-1]
+    assert last_log.message == f"Exiting {COMMAND_NAME}"
+    return log_extra(last_log)
+
+
+def test_no_messages(mock_sqs_client, caplog, test_settings):
+    """The command can exit after processing no messages."""
+    test_settings.PROCESS_EMAIL_ASYNC_MAX_IN_FLIGHT = 20
+    mock_sqs_client.return_value = fake_queue([], KeyboardInterrupt)
+    call_command(COMMAND_NAME)
+
+    start_log = caplog.records[0]
+    assert start_log.getMessage() == "Starting process_emails_from_sqs_async"
+    start_extra = log_extra(start_log)
+    assert start_extra["max_in_flight"] == 20
+    assert "max_workers" not in start_extra
+    assert "prefetch_batches" not in start_extra
+
+    assert caplog.records[1].getMessage() == "Cycle 0: received 0 messages, completed 0"
+    summary = summary_from_exit_log(caplog)
+    assert summary == {
+        "exit_on": "interrupt",
+        "cycles": 1,
+        "total_s": summary["total_s"],
+        "total_messages": 0,
+    }
+
+
+def test_messages_processed_and_deleted(
+    mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """Messages are processed like the synchronous command, then deleted."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs, KeyboardInterrupt)
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    msg_logs = [rec for rec in caplog.records if rec.message == "Message processed"]
+    assert len(msg_logs) == 3
+    assert set(log_extra(msg_logs[0]).keys()) == {
+        "message_process_time_s",
+        "sns_verify_s",
+        "sqs_message_id",
+        "success",
+    }
+    assert mock_sns_inbound_logic.call_count == 3
+    assert sorted(deleted_receipt_handles(queue)) == sorted(
+        msg.receipt_handle for msg in msgs
+    )
+    assert summary_from_exit_log(caplog)["total_messages"] == 3
+
+
+def test_failed_message_not_deleted(mock_sqs_client, caplog):
+    """A failed message is counted and left on the queue."""
+    good_msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    bad_msg = fake_sqs_message("I am a string, not JSON")
+    queue = fake_queue([good_msg, bad_msg], KeyboardInterrupt)
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 2
+    assert summary["failed_messages"] == 1
+    assert deleted_receipt_handles(queue) == [good_msg.receipt_handle]
+
+
+def test_poll_limited_by_room(test_settings, mock_sqs_client, caplog):
+    """The command only asks for as many messages as it has room for."""
+    test_settings.PROCESS_EMAIL_ASYNC_MAX_IN_FLIGHT = 3
+    queue = fake_queue([], KeyboardInterrupt)
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+    assert queue.receive_messages.call_args.kwargs["MaxNumberOfMessages"] == 3
+
+
+def test_max_seconds(mock_sqs_client, caplog, test_settings):
+    """The command exits after the max time."""
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 1
+    call_command(COMMAND_NAME)
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "max_seconds"
+
+
+@pytest.mark.parametrize("signum", (signal.SIGINT, signal.SIGTERM))
+def test_signal_finishes_in_flight_messages(signum, mock_sqs_client, caplog):
+    """A signal stops polling, and the started messages are finished."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(2)]
+    message_lists = [msgs]
+
+    def receive_then_signal(**kwargs):
+        if message_lists:
+            os.kill(os.getpid(), signum)
+            return message_lists.pop()
+        return []
+
+    queue = fake_queue()
+    queue.receive_messages.side_effect = receive_then_signal
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    assert sorted(deleted_receipt_handles(queue)) == sorted(
+        msg.receipt_handle for msg in msgs
+    )
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "interrupt"
+    assert summary["total_messages"] == 2
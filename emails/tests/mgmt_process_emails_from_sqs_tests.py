@@ -1,8 +1,13 @@
 from datetime import datetime, timezone
 from io import StringIO
+from threading import Event
 from unittest.mock import patch, Mock
 from uuid import uuid4, UUID
 import json
+import multiprocessing
+import os
+import pstats
+import signal
 
 from botocore.exceptions import ClientError
 from markus.testing import MetricsMock
@@ -10,9 +15,16 @@ import boto3
 import pytest
 import OpenSSL
 
+from django.conf import settings
 from django.core.management import call_command
+from django.core.exceptions import SuspiciousOperation
 from django.core.management.base import CommandError
 
+from emails.management.commands.process_emails_from_sqs import MessagePrefetcher
+from emails.management.message_profiler import MessageProfiler
+from emails.management.worker_supervisor import WorkerSupervisor
+from emails.models import COUNTER_BUFFER
+from emails.utils import S3_DELETE_QUEUE, time_stage
 from emails.tests.views_tests import EMAIL_SNS_BODIES
 
 
@@ -46,7 +58,7 @@ def mocked_clocks():
 @pytest.fixture(autouse=True)
 def mock_verify_from_sns():
     """Mock verify_from_sns(json_body) to return JSON"""
-    with patch(f"{MOCK_BASE}.verify_from_sns") as mock_verify_from_sns:
+    with patch("emails.sns.verify_from_sns") as mock_verify_from_sns:
         mock_verify_from_sns.side_effect = lambda msg_json: msg_json
         yield mock_verify_from_sns
 
@@ -71,6 +83,17 @@ def test_settings(settings, tmp_path):
     settings.PROCESS_EMAIL_DELETE_FAILED_MESSAGES = False
     settings.PROCESS_EMAIL_HEALTHCHECK_PATH = str(tmp_path / "healthcheck.json")
     settings.PROCESS_EMAIL_MAX_SECONDS = 3
+    settings.PROCESS_EMAIL_MAX_WORKERS = 1
+    settings.PROCESS_EMAIL_WORKER_PROCESSES = 1
+    settings.PROCESS_EMAIL_PREFETCH_BATCHES = 0
+    settings.PROCESS_EMAIL_QUEUE_REFRESH_SECONDS = 0
+    settings.PROCESS_EMAIL_BATCH_S3_DELETES = False
+    settings.PROCESS_EMAIL_BUFFER_COUNTERS = False
+    settings.PROCESS_EMAIL_COUNTER_FLUSH_SECONDS = 10
+    settings.PROCESS_EMAIL_COUNTER_FLUSH_MESSAGES = 1000
+    settings.PROCESS_EMAIL_PROFILE = False
+    settings.PROCESS_EMAIL_PROFILE_EVERY = 100
+    settings.PROCESS_EMAIL_PROFILE_DIR = str(tmp_path / "profiles")
     settings.PROCESS_EMAIL_VERBOSITY = 2
     settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 120
     settings.PROCESS_EMAIL_WAIT_SECONDS = 5
@@ -84,9 +107,10 @@ def mock_sqs_client():
     mock_queue = Mock(spec_set=["Queue"])
     mock_queue.Queue.return_value = fake_queue()
 
-    def validate_call(resource_type, region_name):
+    def validate_call(resource_type, region_name, config):
         nonlocal mock_queue
         assert resource_type == "sqs"
+        assert config.max_pool_connections == settings.AWS_MAX_POOL_CONNECTIONS
         mock_queue.Queue._mock_region = region_name
         return mock_queue
 
@@ -102,12 +126,13 @@ def fake_queue(*message_lists):
     Arguments:
     message_lists: A list of lists of messages, None if no messages
     """
-    queue = Mock(spec_set=("receive_messages", "load", "attributes"))
+    queue = Mock(spec_set=("receive_messages", "load", "attributes", "delete_messages"))
     queue.attributes = {
         "ApproximateNumberOfMessages": 1,
         "ApproximateNumberOfMessagesDelayed": 2,
         "ApproximateNumberOfMessagesNotVisible": 3,
     }
+    queue.delete_messages.side_effect = delete_all_messages
     if message_lists:
         queue.receive_messages.side_effect = message_lists
     else:
@@ -115,6 +140,55 @@ def fake_queue(*message_lists):
     return queue
 
 
+def delete_all_messages(Entries):
+    """Return a batch response, like DeleteMessageBatch, where every entry succeeds."""
+    return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+def deleted_receipt_handles(queue):
+    """Return the receipt handles passed to queue.delete_messages()"""
+    return [
+        entry["ReceiptHandle"]
+        for call in queue.delete_messages.call_args_list
+        for entry in call.kwargs["Entries"]
+    ]
+
+
+def fake_prefetch_queue(*message_lists):
+    """
+    Return a mock SQS Queue for prefetching tests.
+
+    The message lists are returned first, then empty lists after a short
+    real-time wait, like a long poll on an empty queue.
+    """
+    queue = Mock(
+        spec_set=(
+            "receive_messages",
+            "load",
+            "attributes",
+            "change_message_visibility_batch",
+            "delete_messages",
+        )
+    )
+    queue.attributes = {
+        "ApproximateNumberOfMessages": 1,
+        "ApproximateNumberOfMessagesDelayed": 2,
+        "ApproximateNumberOfMessagesNotVisible": 3,
+    }
+    queue.delete_messages.side_effect = delete_all_messages
+    queue.change_message_visibility_batch.side_effect = delete_all_messages
+    pending = list(message_lists)
+
+    def receive_messages(**kwargs):
+        if pending:
+            return pending.pop(0)
+        Event().wait(0.01)
+        return []
+
+    queue.receive_messages.side_effect = receive_messages
+    return queue
+
+
 def fake_sqs_message(body):
     """
     Create a fake SQS message
@@ -122,7 +196,7 @@ def fake_sqs_message(body):
     Only includes some attributes. For full spec, see:
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#message
     """
-    msg = Mock(spec_set=("queue_url", "receipt_handle", "body", "message_id", "delete"))
+    msg = Mock(spec_set=("queue_url", "receipt_handle", "body", "message_id"))
     msg.queue_url = (
         "https://sqs.us-east-1.amazonaws.example.com/123456789012/queue-name"
     )
@@ -191,6 +265,17 @@ def test_no_messages(caplog, test_settings):
         "delete_failed_messages": False,
         "healthcheck_path": test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH,
         "max_seconds": 3,
+        "max_workers": 1,
+        "worker_processes": 1,
+        "prefetch_batches": 0,
+        "queue_refresh_seconds": 0,
+        "batch_s3_deletes": False,
+        "buffer_counters": False,
+        "counter_flush_seconds": 10,
+        "counter_flush_messages": 1000,
+        "profile": False,
+        "profile_every": 100,
+        "profile_dir": test_settings.PROCESS_EMAIL_PROFILE_DIR,
         "sqs_url": "https://sqs.us-east-1.amazonaws.example.com/111222333/queue-name",
         "verbosity": 2,
         "visibility_seconds": 120,
@@ -245,6 +330,7 @@ def test_one_message(
     msg_extra = log_extra(msg_log)
     assert set(msg_extra.keys()) == {
         "message_process_time_s",
+        "sns_verify_s",
         "sqs_message_id",
         "success",
     }
@@ -260,6 +346,438 @@ def test_one_message(
     )
 
 
+def test_stage_timings_logged(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """The times of the email processing stages are in the message log."""
+    test_settings.STATSD_ENABLED = True
+
+    def timed_stages(*args):
+        for stage in ("address_lookup", "ses_send", "ses_send"):
+            with time_stage(stage):
+                pass
+
+    mock_sns_inbound_logic.side_effect = timed_stages
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    mock_sqs_client.return_value = fake_queue([msg], [])
+    with MetricsMock() as mm:
+        call_command(COMMAND_NAME)
+
+    msg_log = caplog.records[1]
+    assert msg_log.getMessage() == "Message processed"
+    msg_extra = log_extra(msg_log)
+    assert {key for key in msg_extra if key.endswith("_s")} == {
+        "address_lookup_s",
+        "message_process_time_s",
+        "ses_send_s",
+        "sns_verify_s",
+    }
+    assert msg_extra["ses_send_s"] <= msg_extra["message_process_time_s"]
+    ses_send_timings = mm.filter_records(
+        "timing", stat="fx.private.relay.email_stage", tags=["stage:ses_send"]
+    )
+    assert len(ses_send_timings) == 2
+
+
+def test_profile_messages(test_settings, mock_sqs_client, caplog):
+    """With profiling on, every Nth message is profiled, and stats are written."""
+    test_settings.PROCESS_EMAIL_PROFILE = True
+    test_settings.PROCESS_EMAIL_PROFILE_EVERY = 2
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+    call_command(COMMAND_NAME)
+
+    profile_logs = [
+        rec for rec in caplog.records if rec.message == "Profile stats written"
+    ]
+    assert len(profile_logs) == 1
+    profile_extra = log_extra(profile_logs[0])
+    assert profile_extra["profiled_messages"] == 2
+    stats = pstats.Stats(profile_extra["path"])
+    assert any(func[2] == "process_message" for func in stats.stats)
+
+
+def test_profile_toggled_off(test_settings, tmp_path):
+    """When profiling is turned off, the profiles so far are written."""
+    profiler = MessageProfiler(1, str(tmp_path), enabled=True)
+    with profiler.profile():
+        json.dumps(TEST_SNS_MESSAGE)
+    assert profiler.profiled_count == 1
+    profiler.toggle()
+    with profiler.profile():
+        pass
+    assert profiler.profiled_count == 0
+    assert len(list(tmp_path.glob("process_emails_*.prof"))) == 1
+
+
+def test_concurrent_messages(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """The command can process the messages of a batch on a thread pool."""
+    test_settings.PROCESS_EMAIL_MAX_WORKERS = 4
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs, [])
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    msg_logs = [rec for rec in caplog.records if rec.message == "Message processed"]
+    assert len(msg_logs) == 3
+    assert {log_extra(rec)["sqs_message_id"] for rec in msg_logs} == {
+        msg.message_id for msg in msgs
+    }
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 3
+    assert "failed_messages" not in summary
+    assert mock_sns_inbound_logic.call_count == 3
+    assert sorted(deleted_receipt_handles(queue)) == sorted(
+        msg.receipt_handle for msg in msgs
+    )
+
+
+def test_concurrent_messages_with_failure(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """Failed messages are counted and kept when processed concurrently."""
+    test_settings.PROCESS_EMAIL_MAX_WORKERS = 2
+    good_msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    bad_msg = fake_sqs_message("I am a string, not JSON")
+    queue = fake_queue([good_msg, bad_msg], [])
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 2
+    assert summary["failed_messages"] == 1
+    assert deleted_receipt_handles(queue) == [good_msg.receipt_handle]
+
+
+def test_prefetch_messages(test_settings, mock_sqs_client, caplog):
+    """The command can receive batches on a background thread."""
+    test_settings.PROCESS_EMAIL_PREFETCH_BATCHES = 2
+    test_settings.PROCESS_EMAIL_WAIT_SECONDS = 1
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 4
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(2)]
+    queue = fake_prefetch_queue(msgs)
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 2
+    assert sorted(deleted_receipt_handles(queue)) == sorted(
+        msg.receipt_handle for msg in msgs
+    )
+    cycle_log = next(
+        rec for rec in caplog.records if rec.message.endswith("processed 2 messages")
+    )
+    cycle_extra = log_extra(cycle_log)
+    assert cycle_extra["message_count"] == 2
+    assert "prefetch_wait_s" in cycle_extra
+    assert "prefetch_age_s" in cycle_extra
+    assert "visibility_extended" not in cycle_extra
+
+
+def test_prefetch_extends_visibility(test_settings, mock_sqs_client, caplog):
+    """A prefetched batch that waited too long gets a new visibility timeout."""
+    test_settings.PROCESS_EMAIL_PREFETCH_BATCHES = 1
+    test_settings.PROCESS_EMAIL_WAIT_SECONDS = 1
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 4
+    test_settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 1
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_prefetch_queue()
+    prefetch_queue = fake_prefetch_queue([msg])
+    mock_sqs_client.side_effect = [queue, prefetch_queue]
+    call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["total_messages"] == 1
+    # The visibility is extended on the main thread, with its own queue
+    queue.change_message_visibility_batch.assert_called_once_with(
+        Entries=[
+            {"Id": "0", "ReceiptHandle": msg.receipt_handle, "VisibilityTimeout": 1}
+        ]
+    )
+
+
+def test_prefetch_visibility_failed_not_processed(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """A prefetched message that could not be extended is not processed."""
+    test_settings.PROCESS_EMAIL_PREFETCH_BATCHES = 1
+    test_settings.PROCESS_EMAIL_WAIT_SECONDS = 1
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 4
+    test_settings.PROCESS_EMAIL_VISIBILITY_SECONDS = 1
+    lost_msg, msg = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(2)]
+    queue = fake_prefetch_queue()
+    queue.change_message_visibility_batch.side_effect = None
+    queue.change_message_visibility_batch.return_value = {
+        "Successful": [{"Id": "1"}],
+        "Failed": [{"Id": "0", "SenderFault": True, "Code": "ReceiptHandleIsInvalid"}],
+    }
+    mock_sqs_client.side_effect = [queue, fake_prefetch_queue([lost_msg, msg])]
+    call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["total_messages"] == 1
+    mock_sns_inbound_logic.assert_called_once()
+    assert deleted_receipt_handles(queue) == [msg.receipt_handle]
+    cycle_log = next(
+        rec for rec in caplog.records if rec.message.endswith("processed 1 message")
+    )
+    assert log_extra(cycle_log)["visibility_failed_count"] == 1
+
+
+def test_prefetcher_extends_buffered_messages():
+    """Buffered messages are extended before their visibility runs out."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(2)]
+    queue = fake_prefetch_queue(msgs)
+    queue.change_message_visibility_batch.side_effect = None
+    queue.change_message_visibility_batch.return_value = {
+        "Successful": [{"Id": "0"}],
+        "Failed": [{"Id": "1", "SenderFault": False, "Code": "InternalError"}],
+    }
+    prefetcher = MessagePrefetcher(
+        queue, batch_size=10, wait_seconds=1, visibility_seconds=4, max_batches=1
+    )
+    prefetcher.start()
+    while not queue.change_message_visibility_batch.called:
+        Event().wait(0.01)
+    batch = prefetcher.get_batch(timeout=1)
+    prefetcher.stop()
+
+    assert queue.change_message_visibility_batch.call_args_list[0].kwargs == {
+        "Entries": [
+            {
+                "Id": str(num),
+                "ReceiptHandle": msg.receipt_handle,
+                "VisibilityTimeout": 4,
+            }
+            for num, msg in enumerate(msgs)
+        ]
+    }
+    # The message that could not be extended is dropped
+    assert batch.messages == [msgs[0]]
+    assert batch.received_count == 2
+
+
+def test_prefetcher_stop_releases_buffered_messages():
+    """Stopping the prefetcher makes buffered messages visible again."""
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_prefetch_queue([msg])
+    prefetcher = MessagePrefetcher(
+        queue, batch_size=10, wait_seconds=1, visibility_seconds=120, max_batches=1
+    )
+    prefetcher.start()
+    while prefetcher.buffer.empty():
+        Event().wait(0.01)
+    prefetcher.stop()
+
+    assert not prefetcher.thread.is_alive()
+    queue.change_message_visibility_batch.assert_called_once_with(
+        Entries=[
+            {"Id": "0", "ReceiptHandle": msg.receipt_handle, "VisibilityTimeout": 0}
+        ]
+    )
+
+
+def test_queue_refresh_interval(test_settings, mock_sqs_client, caplog):
+    """The queue attributes can be reloaded less often than every cycle."""
+    test_settings.PROCESS_EMAIL_QUEUE_REFRESH_SECONDS = 60
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = 6
+    call_command(COMMAND_NAME)
+    assert summary_from_exit_log(caplog)["cycles"] > 1
+    mock_sqs_client.return_value.load.assert_called_once_with()
+
+
+def test_batch_s3_deletes(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """Processed emails can be deleted from S3 in one call at the end of a cycle."""
+    test_settings.PROCESS_EMAIL_BATCH_S3_DELETES = True
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+    object_keys = iter(["key1", "key2", "key3"])
+
+    def queue_s3_delete(*args):
+        assert S3_DELETE_QUEUE.enabled
+        S3_DELETE_QUEUE.add("bucket", next(object_keys))
+
+    mock_sns_inbound_logic.side_effect = queue_s3_delete
+    with patch("emails.utils.apps.get_app_config") as mock_get_app_config:
+        mock_s3_client = mock_get_app_config.return_value.s3_client
+        mock_s3_client.delete_objects.return_value = {}
+        call_command(COMMAND_NAME)
+
+    assert not S3_DELETE_QUEUE.enabled
+    mock_s3_client.delete_objects.assert_called_once_with(
+        Bucket="bucket",
+        Delete={
+            "Objects": [{"Key": "key1"}, {"Key": "key2"}, {"Key": "key3"}],
+            "Quiet": True,
+        },
+    )
+    cycle_extra = log_extra(caplog.records[4])
+    assert cycle_extra["s3_delete_count"] == 3
+    assert cycle_extra["s3_delete_pending"] == 0
+
+
+def test_sigterm_finishes_s3_deletes(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """SIGTERM exits after the cycle, and the queued S3 deletes are retried."""
+    test_settings.PROCESS_EMAIL_BATCH_S3_DELETES = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))]
+    message_lists = [msgs]
+
+    def receive_then_signal(**kwargs):
+        if message_lists:
+            os.kill(os.getpid(), signal.SIGTERM)
+            return message_lists.pop()
+        return []
+
+    queue = fake_queue()
+    queue.receive_messages.side_effect = receive_then_signal
+    mock_sqs_client.return_value = queue
+    mock_sns_inbound_logic.side_effect = lambda *args: S3_DELETE_QUEUE.add(
+        "bucket", "key1"
+    )
+    old_sigterm = signal.getsignal(signal.SIGTERM)
+    with patch("emails.utils.apps.get_app_config") as mock_get_app_config:
+        mock_s3_client = mock_get_app_config.return_value.s3_client
+        mock_s3_client.delete_objects.side_effect = [
+            {"Errors": [{"Key": "key1", "Code": "InternalError"}]},
+            {},
+        ]
+        call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "interrupt"
+    assert summary["cycles"] == 1
+    assert mock_s3_client.delete_objects.call_count == 2
+    assert not S3_DELETE_QUEUE.pending
+    assert not S3_DELETE_QUEUE.enabled
+    assert signal.getsignal(signal.SIGTERM) == old_sigterm
+
+
+def test_buffer_counters(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """Buffered address counters are written at the end of the cycle and exit."""
+    test_settings.PROCESS_EMAIL_BUFFER_COUNTERS = True
+    test_settings.PROCESS_EMAIL_COUNTER_FLUSH_SECONDS = 0
+    test_settings.PROCESS_EMAIL_COUNTER_FLUSH_MESSAGES = 50
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+
+    def buffer_counters(*args):
+        assert COUNTER_BUFFER.enabled
+        assert COUNTER_BUFFER.max_increments == 50
+
+    mock_sns_inbound_logic.side_effect = buffer_counters
+    with patch.object(
+        COUNTER_BUFFER, "flush", return_value={"counter_rows": 3}
+    ) as mock_flush:
+        call_command(COMMAND_NAME)
+
+    assert not COUNTER_BUFFER.enabled
+    # Each cycle, and at exit
+    assert mock_flush.call_count == summary_from_exit_log(caplog)["cycles"] + 1
+    assert log_extra(caplog.records[4])["counter_rows"] == 3
+
+
+def test_sigterm_flushes_counter_buffer(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """SIGTERM exits after the cycle, and the buffered counters are written."""
+    test_settings.PROCESS_EMAIL_BUFFER_COUNTERS = True
+    test_settings.PROCESS_EMAIL_COUNTER_FLUSH_SECONDS = 3600
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    message_lists = [msgs]
+
+    def receive_then_signal(**kwargs):
+        if message_lists:
+            os.kill(os.getpid(), signal.SIGTERM)
+            return message_lists.pop()
+        return []
+
+    queue = fake_queue()
+    queue.receive_messages.side_effect = receive_then_signal
+    mock_sqs_client.return_value = queue
+    with patch.object(
+        COUNTER_BUFFER, "flush", return_value={"counter_rows": 3}
+    ) as mock_flush:
+        call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "interrupt"
+    assert summary["total_messages"] == 3
+    # Not due during the cycle, only at exit
+    mock_flush.assert_called_once_with()
+    assert not COUNTER_BUFFER.enabled
+
+
+def test_batch_delete(mock_sqs_client, caplog):
+    """Processed messages are deleted with one call per cycle."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs, [])
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    queue.delete_messages.assert_called_once_with(
+        Entries=[
+            {"Id": str(num), "ReceiptHandle": msg.receipt_handle}
+            for num, msg in enumerate(msgs)
+        ]
+    )
+    cycle_extra = log_extra(caplog.records[4])
+    assert cycle_extra["delete_count"] == 3
+    assert "delete_failed_count" not in cycle_extra
+
+
+def test_batch_delete_partial_failure(mock_sqs_client, caplog):
+    """Deletes that fail on the SQS side are retried, others are reported."""
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(3)]
+    queue = fake_queue(msgs, [])
+    queue.delete_messages.side_effect = [
+        {
+            "Successful": [{"Id": "0"}],
+            "Failed": [
+                {"Id": "1", "SenderFault": False, "Code": "InternalError"},
+                {"Id": "2", "SenderFault": True, "Code": "ReceiptHandleIsInvalid"},
+            ],
+        },
+        {"Successful": [{"Id": "1"}], "Failed": []},
+    ]
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    assert queue.delete_messages.call_count == 2
+    assert queue.delete_messages.call_args.kwargs["Entries"] == [
+        {"Id": "1", "ReceiptHandle": msgs[1].receipt_handle}
+    ]
+    cycle_extra = log_extra(caplog.records[4])
+    assert cycle_extra["delete_count"] == 2
+    assert cycle_extra["delete_failed_count"] == 1
+    assert cycle_extra["delete_failed_codes"] == ["ReceiptHandleIsInvalid"]
+
+
+def test_batch_delete_client_error(mock_sqs_client, caplog):
+    """A failing DeleteMessageBatch call is retried, then reported."""
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    queue = fake_queue([msg], [])
+    queue.delete_messages.side_effect = make_client_error(code="InternalError")
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    assert queue.delete_messages.call_count == 3
+    cycle_log = next(
+        rec for rec in caplog.records if rec.message == "Cycle 0: processed 1 message"
+    )
+    cycle_extra = log_extra(cycle_log)
+    assert "delete_count" not in cycle_extra
+    assert cycle_extra["delete_failed_count"] == 1
+    assert cycle_extra["delete_failed_codes"] == ["InternalError"]
+
+
 def test_keyboard_interrupt(mock_sqs_client, caplog, test_settings):
     """The command halts on Ctrl-C."""
     test_settings.PROCESS_EMAIL_MAX_SECONDS = None
@@ -273,24 +791,26 @@ def test_keyboard_interrupt(mock_sqs_client, caplog, test_settings):
 def test_no_body(mock_sqs_client, caplog):
     """The command skips a message without a JSON body."""
     msg = fake_sqs_message("I am a string, not JSON")
-    mock_sqs_client.return_value = fake_queue([msg], [])
+    queue = fake_queue([msg], [])
+    mock_sqs_client.return_value = queue
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["failed_messages"] == 1
     assert summary["cycles"] == 2
-    msg.delete.assert_not_called()
+    assert deleted_receipt_handles(queue) == []
 
 
 def test_no_body_deleted(mock_sqs_client, caplog, test_settings):
     """The command deletes a message without a JSON body."""
     test_settings.PROCESS_EMAIL_DELETE_FAILED_MESSAGES = True
     msg = fake_sqs_message("I am a string, not JSON")
-    mock_sqs_client.return_value = fake_queue([msg], [])
+    queue = fake_queue([msg], [])
+    mock_sqs_client.return_value = queue
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["failed_messages"] == 1
     assert summary["cycles"] == 2
-    msg.delete.assert_called_once_with()
+    assert deleted_receipt_handles(queue) == [msg.receipt_handle]
 
 
 def test_ses_temp_failure_retry(
@@ -306,12 +826,13 @@ def test_ses_temp_failure_retry(
     )
     mock_sns_inbound_logic.side_effect = (temp_error, None)
     msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
-    mock_sqs_client.return_value = fake_queue([msg], [])
+    queue = fake_queue([msg], [])
+    mock_sqs_client.return_value = queue
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["pause_count"] == 1
-    msg.delete.assert_called_once_with()
+    assert deleted_receipt_handles(queue) == [msg.receipt_handle]
 
 
 def test_ses_temp_failure_twice(
@@ -324,13 +845,14 @@ def test_ses_temp_failure_twice(
     )
     mock_sns_inbound_logic.side_effect = (temp_error, temp_error)
     msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
-    mock_sqs_client.return_value = fake_queue([msg], [])
+    queue = fake_queue([msg], [])
+    mock_sqs_client.return_value = queue
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["failed_messages"] == 1
     assert summary["pause_count"] == 1
-    msg.delete.assert_not_called()
+    assert deleted_receipt_handles(queue) == []
 
 
 def test_ses_generic_failure(mock_sns_inbound_logic, mock_sqs_client, caplog):
@@ -338,12 +860,13 @@ def test_ses_generic_failure(mock_sns_inbound_logic, mock_sqs_client, caplog):
     internal_error = make_client_error(code="InternalError")
     mock_sns_inbound_logic.side_effect = (internal_error, None)
     msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
-    mock_sqs_client.return_value = fake_queue([msg], [])
+    queue = fake_queue([msg], [])
+    mock_sqs_client.return_value = queue
     call_command(COMMAND_NAME)
     summary = summary_from_exit_log(caplog)
     assert summary["total_messages"] == 1
     assert summary["failed_messages"] == 1
-    msg.delete.assert_not_called()
+    assert deleted_receipt_handles(queue) == []
 
 
 def test_verify_from_sns_raises_openssl_error(
@@ -370,6 +893,56 @@ def test_verify_from_sns_raises_keyerror(mock_verify_from_sns, mock_sqs_client,
     assert summary["failed_messages"] == 1
 
 
+def test_verify_error_fails_only_its_message(
+    mock_verify_from_sns, mock_sns_inbound_logic, mock_sqs_client, caplog
+):
+    """A bad signature on a message of a batch does not stop the other messages."""
+    bad_message = dict(TEST_SNS_MESSAGE, Signature="bad")
+
+    def verify(json_body):
+        if json_body == bad_message:
+            raise OpenSSL.crypto.Error([])
+        return json_body
+
+    mock_verify_from_sns.side_effect = verify
+    msgs = [
+        fake_sqs_message(json.dumps(bad_message)),
+        fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)),
+    ]
+    mock_sqs_client.return_value = fake_queue(msgs, [])
+    call_command(COMMAND_NAME)
+    summary = summary_from_exit_log(caplog)
+    assert summary["total_messages"] == 2
+    assert summary["failed_messages"] == 1
+    mock_sns_inbound_logic.assert_called_once()
+
+
+def test_verify_unexpected_error_keeps_batch(
+    test_settings, mock_verify_from_sns, mock_sns_inbound_logic, mock_sqs_client
+):
+    """An unexpected verification error is raised, and no message is deleted."""
+    test_settings.PROCESS_EMAIL_DELETE_FAILED_MESSAGES = True
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    bad_message = dict(TEST_SNS_MESSAGE, SigningCertURL="https://example.com/")
+
+    def verify(json_body):
+        if json_body == bad_message:
+            raise SuspiciousOperation("SNS SigningCertURL did not start with...")
+        return json_body
+
+    mock_verify_from_sns.side_effect = verify
+    msgs = [
+        fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)),
+        fake_sqs_message(json.dumps(bad_message)),
+    ]
+    queue = fake_queue(msgs)
+    mock_sqs_client.return_value = queue
+    with pytest.raises(SuspiciousOperation):
+        call_command(COMMAND_NAME)
+    mock_sns_inbound_logic.assert_not_called()
+    queue.delete_messages.assert_not_called()
+
+
 def test_verify_sns_header_fails(test_settings, mock_sqs_client, caplog):
     """Invalid SNS headers fail."""
     test_settings.AWS_SNS_TOPIC = {"arn:aws:sns:us-east-1:111122223333:not-relay"}
@@ -402,6 +975,111 @@ def test_writes_healthcheck_file(test_settings):
     assert 0.0 < duration < 0.5
 
 
+def test_worker_processes(test_settings, caplog):
+    """The command can run and supervise several worker processes."""
+    test_settings.PROCESS_EMAIL_WORKER_PROCESSES = 2
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary == {
+        "exit_on": "max_seconds",
+        "worker_processes": 2,
+        "cycles": 4,
+        "total_messages": 0,
+        "total_s": summary["total_s"],
+    }
+    healthcheck_path = test_settings.PROCESS_EMAIL_HEALTHCHECK_PATH
+    with open(healthcheck_path, "r", encoding="utf-8") as healthcheck_file:
+        content = json.load(healthcheck_file)
+    assert content["queue_count"] == 1
+    assert set(content["workers"].keys()) <= {"0", "1"}
+    for worker_data in content["workers"].values():
+        assert worker_data["cycles"] == 2
+        assert worker_data["pid"]
+
+
+def test_worker_processes_halted_totals(test_settings, mock_sqs_client, caplog):
+    """The totals include the last cycle of workers halted by SIGTERM."""
+    test_settings.PROCESS_EMAIL_WORKER_PROCESSES = 2
+    test_settings.PROCESS_EMAIL_MAX_SECONDS = None
+    msgs = [fake_sqs_message(json.dumps(TEST_SNS_MESSAGE)) for _ in range(2)]
+    message_lists = [msgs]
+
+    def receive_then_halt(**kwargs):
+        # The last worker gets the messages, and halts the supervisor
+        if multiprocessing.current_process().name != "process_emails_worker_1":
+            return []
+        if message_lists:
+            os.kill(os.getppid(), signal.SIGTERM)
+            return message_lists.pop()
+        return []
+
+    queue = fake_queue()
+    queue.receive_messages.side_effect = receive_then_halt
+    mock_sqs_client.return_value = queue
+    call_command(COMMAND_NAME)
+
+    summary = summary_from_exit_log(caplog)
+    assert summary["exit_on"] == "interrupt"
+    assert summary["total_messages"] == 2
+    assert summary["cycles"] >= 1
+
+
+def test_worker_processes_sigusr1_forwarded(test_settings, caplog):
+    """SIGUSR1 to the supervisor is sent on to the worker processes."""
+    test_settings.PROCESS_EMAIL_WORKER_PROCESSES = 2
+    original_supervise = WorkerSupervisor.supervise
+    worker_pids = []
+
+    def supervise_after_signal(supervisor):
+        if not worker_pids:
+            worker_pids.extend(process.pid for process in supervisor.processes.values())
+            os.kill(os.getpid(), signal.SIGUSR1)
+        original_supervise(supervisor)
+
+    old_sigusr1 = signal.getsignal(signal.SIGUSR1)
+    with patch.object(
+        WorkerSupervisor, "supervise", autospec=True
+    ) as mock_supervise, patch(
+        "emails.management.worker_supervisor.os.kill", wraps=os.kill
+    ) as mock_kill:
+        mock_supervise.side_effect = supervise_after_signal
+        call_command(COMMAND_NAME)
+
+    assert summary_from_exit_log(caplog)["exit_on"] == "max_seconds"
+    forwarded = [
+        call.args[0] for call in mock_kill.call_args_list if call.args[0] in worker_pids
+    ]
+    assert sorted(forwarded) == sorted(worker_pids)
+    assert signal.getsignal(signal.SIGUSR1) == old_sigusr1
+
+
+def test_worker_process_restarted_after_crash(
+    test_settings, mock_sns_inbound_logic, mock_sqs_client, caplog, tmp_path
+):
+    """A crashed worker process is restarted."""
+    test_settings.PROCESS_EMAIL_WORKER_PROCESSES = 2
+    crashed_flag = tmp_path / "crashed"
+
+    def crash_once(*args):
+        if not crashed_flag.exists():
+            crashed_flag.touch()
+            raise RuntimeError("Worker crash")
+
+    mock_sns_inbound_logic.side_effect = crash_once
+    msg = fake_sqs_message(json.dumps(TEST_SNS_MESSAGE))
+    mock_sqs_client.return_value = fake_queue([msg], [], [])
+    call_command(COMMAND_NAME)
+
+    crash_log = next(
+        rec for rec in caplog.records if rec.message == "Worker process crashed"
+    )
+    assert log_extra(crash_log)["exitcode"] == 1
+    summary = summary_from_exit_log(caplog)
+    assert summary["restarts"] == 1
+    assert summary["exit_on"] == "max_seconds"
+
+
 def test_command_sqs_client_error(mock_sqs_client, test_settings):
     """The command fails early on a client error."""
     mock_sqs_client.side_effect = make_client_error(code="InternalError")
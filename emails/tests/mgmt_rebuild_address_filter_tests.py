@@ -0,0 +1,84 @@
+from unittest.mock import patch
+
+import pytest
+
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+
+from model_bakery import baker
+
+from emails.address_filter import (
+    FILTER_KEY,
+    BloomFilter,
+    address_is_absent,
+    clear_local_filter,
+)
+from emails.models import RelayAddress
+
+
+@pytest.fixture()
+def address_filter_cache(settings):
+    settings.RELAY_ADDRESS_FILTER_CACHE = "default"
+    cache.clear()
+    clear_local_filter()
+    yield cache
+    cache.clear()
+    clear_local_filter()
+
+
+def test_bloom_filter_has_added_items():
+    bloom_filter = BloomFilter.for_capacity(1000, 0.01)
+    items = [f"address{i}@test.com" for i in range(1000)]
+    for item in items:
+        bloom_filter.add(item)
+    assert all(item in bloom_filter for item in items)
+    false_positives = sum(f"other{i}@test.com" in bloom_filter for i in range(1000))
+    assert false_positives < 50
+
+
+def test_bloom_filter_for_capacity():
+    bloom_filter = BloomFilter.for_capacity(1000, 0.01)
+    assert bloom_filter.size_bits == 9586
+    assert bloom_filter.hash_count == 7
+    assert len(bloom_filter.bits) == 1199
+
+
+@pytest.mark.django_db
+def test_rebuild_address_filter(address_filter_cache, capsys):
+    relay_address = baker.make(RelayAddress, address="known")
+    call_command("rebuild_address_filter")
+    assert address_filter_cache.get(FILTER_KEY)["count"] == 1
+    assert "Rebuilt address filter with 1 addresses" in capsys.readouterr().out
+
+    assert not address_is_absent(relay_address.full_address)
+    assert address_is_absent(f"unknown@{relay_address.domain_value}")
+
+
+@pytest.mark.django_db
+def test_address_created_after_rebuild_is_not_absent(address_filter_cache):
+    call_command("rebuild_address_filter")
+    assert address_is_absent("newaddress@test.com")
+    relay_address = baker.make(RelayAddress, address="newaddress")
+    assert relay_address.full_address == "newaddress@test.com"
+    assert not address_is_absent("newaddress@test.com")
+
+
+@pytest.mark.django_db
+def test_old_address_filter_is_not_used(address_filter_cache, settings):
+    call_command("rebuild_address_filter")
+    assert address_is_absent("unknown@test.com")
+    clear_local_filter()
+    with patch(
+        "emails.address_filter.time.time",
+        return_value=address_filter_cache.get(FILTER_KEY)["built_at"]
+        + settings.RELAY_ADDRESS_FILTER_MAX_AGE_SECONDS,
+    ):
+        assert not address_is_absent("unknown@test.com")
+
+
+@pytest.mark.django_db
+def test_address_filter_turned_off(settings):
+    settings.RELAY_ADDRESS_FILTER_CACHE = ""
+    with pytest.raises(CommandError):
+        call_command("rebuild_address_filter")
+    assert not address_is_absent("unknown@test.com")
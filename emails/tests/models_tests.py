@@ -1,12 +1,15 @@
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256
 import random
+import time
 from unittest import skip
 from unittest.mock import patch
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.core.exceptions import BadRequest
+from django.db import DatabaseError
 from django.test import (
     override_settings,
     TestCase,
@@ -18,16 +21,19 @@ import pytest
 from model_bakery import baker
 
 from ..models import (
+    ABUSE_COUNTERS,
     AbuseMetrics,
     address_hash,
     CannotMakeAddressException,
     CannotMakeSubdomainException,
+    CounterBuffer,
     DeletedAddress,
     DomainAddress,
     get_domains_from_settings,
     get_domain_numerical,
     has_bad_words,
     hash_subdomain,
+    increment_counters,
     is_blocklisted,
     Profile,
     RegisteredSubdomain,
@@ -165,6 +171,110 @@ class MiscEmailModelsTest(TestCase):
         assert not valid_address_pattern("foo bar")
         assert not valid_address_pattern("Foo")
 
+    def test_increment_counters_adds_in_database(self):
+        relay_address = baker.make(RelayAddress, num_forwarded=2, num_blocked=1)
+        # Another process updates the same address
+        stale_address = RelayAddress.objects.get(id=relay_address.id)
+        increment_counters(relay_address, {"num_forwarded": 1})
+        stale_address.description = "updated"
+        increment_counters(stale_address, {"num_forwarded": 3, "num_blocked": 1})
+
+        assert stale_address.num_forwarded == 5
+        relay_address.refresh_from_db()
+        assert relay_address.num_forwarded == 6
+        assert relay_address.num_blocked == 2
+        # Only the counters are written
+        assert relay_address.description == ""
+
+    def test_increment_counters_nullable_and_values(self):
+        relay_address = baker.make(RelayAddress, num_level_one_trackers_blocked=None)
+        last_used_at = datetime.now(timezone.utc)
+        with self.assertNumQueries(1):
+            increment_counters(
+                relay_address,
+                {"num_level_one_trackers_blocked": 3, "num_replied": 0},
+                last_used_at=last_used_at,
+            )
+        assert relay_address.num_level_one_trackers_blocked == 3
+        relay_address.refresh_from_db()
+        assert relay_address.num_level_one_trackers_blocked == 3
+        assert relay_address.num_replied == 0
+        assert relay_address.last_used_at == last_used_at
+
+    def test_increment_counters_nothing_to_update(self):
+        relay_address = baker.make(RelayAddress)
+        with self.assertNumQueries(0):
+            increment_counters(relay_address, {"num_forwarded": 0})
+
+    def test_counter_buffer_disabled_writes_now(self):
+        relay_address = baker.make(RelayAddress)
+        with self.assertNumQueries(1):
+            CounterBuffer().increment(relay_address, {"num_forwarded": 1})
+        relay_address.refresh_from_db()
+        assert relay_address.num_forwarded == 1
+
+    def test_counter_buffer_flush(self):
+        buffer = CounterBuffer()
+        buffer.enabled = True
+        relay_address = baker.make(RelayAddress, num_forwarded=1)
+        other_address = baker.make(RelayAddress, num_level_one_trackers_blocked=None)
+        user = make_premium_test_user()
+        profile = user.profile_set.get()
+        profile.subdomain = "buffered"
+        profile.save()
+        domain_address = baker.make(DomainAddress, user=user, address="buffered")
+        first_used_at = datetime.now(timezone.utc)
+        last_used_at = first_used_at + timedelta(seconds=1)
+        with self.assertNumQueries(0):
+            buffer.increment(
+                relay_address, {"num_forwarded": 1}, last_used_at=last_used_at
+            )
+            buffer.increment(
+                relay_address, {"num_forwarded": 1}, last_used_at=first_used_at
+            )
+            buffer.increment(other_address, {"num_level_one_trackers_blocked": 2})
+            buffer.increment(domain_address, {"num_replied": 1})
+        assert relay_address.num_forwarded == 3
+
+        # One UPDATE for each model
+        with self.assertNumQueries(2):
+            assert buffer.flush() == {"counter_rows": 3}
+        relay_address.refresh_from_db()
+        assert relay_address.num_forwarded == 3
+        assert relay_address.last_used_at == last_used_at
+        other_address.refresh_from_db()
+        assert other_address.num_forwarded == 0
+        assert other_address.num_level_one_trackers_blocked == 2
+        assert other_address.last_used_at is None
+        domain_address.refresh_from_db()
+        assert domain_address.num_replied == 1
+        assert buffer.flush() == {}
+
+    def test_counter_buffer_flushes_when_full(self):
+        buffer = CounterBuffer()
+        buffer.enabled = True
+        buffer.max_increments = 2
+        relay_address = baker.make(RelayAddress)
+        buffer.increment(relay_address, {"num_blocked": 1})
+        buffer.increment(relay_address, {"num_blocked": 1})
+        assert not buffer.pending
+        relay_address.refresh_from_db()
+        assert relay_address.num_blocked == 2
+
+    def test_counter_buffer_keeps_failed_rows(self):
+        buffer = CounterBuffer()
+        buffer.enabled = True
+        relay_address = baker.make(RelayAddress)
+        buffer.increment(relay_address, {"num_blocked": 1})
+        with patch(
+            "emails.models._update_counter_rows", side_effect=DatabaseError("down")
+        ):
+            assert buffer.flush() == {"counter_rows": 0, "counter_failed_rows": 1}
+        buffer.increment(relay_address, {"num_blocked": 1})
+        assert buffer.flush() == {"counter_rows": 1}
+        relay_address.refresh_from_db()
+        assert relay_address.num_blocked == 2
+
 
 class RelayAddressTest(TestCase):
     def setUp(self):
@@ -998,6 +1108,77 @@ class ProfileTest(TestCase):
         assert abuse_metrics.forwarded_email_size_per_day == 100
         assert profile.last_account_flagged == expected_now
 
+    def use_abuse_counters(self):
+        override = override_settings(
+            RELAY_ABUSE_METRICS_CACHE="default",
+            RELAY_ABUSE_METRICS_PERSIST_SECONDS=300,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+        self.addCleanup(cache.clear)
+        ABUSE_COUNTERS.updated_users.clear()
+        ABUSE_COUNTERS.persisted_at = time.time()
+
+    def test_update_abuse_metric_with_abuse_counters(self):
+        self.use_abuse_counters()
+        user = make_premium_test_user()
+        profile = user.profile_set.get()
+
+        with self.assertNumQueries(0):
+            profile.update_abuse_metric(email_forwarded=True, forwarded_email_size=10)
+            profile.update_abuse_metric(email_forwarded=True, forwarded_email_size=20)
+            profile.update_abuse_metric(replied=True)
+        assert not AbuseMetrics.objects.filter(user=user).exists()
+        assert profile.last_account_flagged is None
+
+        assert ABUSE_COUNTERS.persist() == 1
+        abuse_metrics = AbuseMetrics.objects.get(user=user)
+        assert abuse_metrics.num_email_forwarded_per_day == 2
+        assert abuse_metrics.forwarded_email_size_per_day == 30
+        assert abuse_metrics.num_replies_per_day == 1
+        assert abuse_metrics.num_address_created_per_day == 0
+        assert ABUSE_COUNTERS.persist() == 0
+
+    def test_abuse_counters_persist_when_due(self):
+        self.use_abuse_counters()
+        user = make_premium_test_user()
+        profile = user.profile_set.get()
+        profile.update_abuse_metric(address_created=True)
+        ABUSE_COUNTERS.persisted_at -= 300
+
+        profile.update_abuse_metric(address_created=True)
+        abuse_metrics = AbuseMetrics.objects.get(user=user)
+        assert abuse_metrics.num_address_created_per_day == 2
+
+    @patch("emails.models.abuse_logger.info")
+    @override_settings(MAX_REPLIES_PER_DAY=2)
+    def test_abuse_counters_flag_profile(self, mocked_abuse_info):
+        self.use_abuse_counters()
+        user = make_premium_test_user()
+        profile = user.profile_set.get()
+
+        profile.update_abuse_metric(replied=True)
+        mocked_abuse_info.assert_not_called()
+        flagged = profile.update_abuse_metric(replied=True)
+
+        assert flagged is not None
+        profile.refresh_from_db()
+        assert profile.last_account_flagged == flagged
+        mocked_abuse_info.assert_called_once_with(
+            "Abuse flagged",
+            extra={
+                "uid": profile.fxa.uid,
+                "flagged": flagged.timestamp(),
+                "replies": 2,
+                "addresses": 0,
+                "forwarded": 0,
+                "forwarded_size_in_bytes": 0,
+            },
+        )
+        # The counts are saved when the profile is flagged
+        assert AbuseMetrics.objects.get(user=user).num_replies_per_day == 2
+
 
 class DomainAddressTest(TestCase):
     def setUp(self):
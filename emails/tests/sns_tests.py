@@ -1,9 +1,58 @@
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
+import base64
+import time
 
+from OpenSSL import crypto
+
+from django.core.cache import caches
 from django.core.exceptions import SuspiciousOperation
 from django.test import TestCase
 
-from ..sns import _grab_keyfile
+from ..sns import (
+    SIGNING_CERT_CACHE_SIZE,
+    _grab_keyfile,
+    _signing_certs,
+    _verified,
+    verify_batch_from_sns,
+    verify_from_sns,
+)
+
+
+def make_signing_cert(not_after):
+    """Return a signing key and a self-signed PEM certificate."""
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = "sns.us-east-1.amazonaws.com"
+    cert.set_serial_number(1)
+    cert.set_notBefore(b"20200101000000Z")
+    cert.set_notAfter(not_after.strftime("%Y%m%d%H%M%SZ").encode())
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    return key, crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+
+def signed_notification(key, cert_url, **fields):
+    """Return an SNS notification signed with the key."""
+    json_body = {
+        "Type": "Notification",
+        "MessageId": "a-message-id",
+        "TopicArn": "arn:aws:sns:us-east-1:111222333:topic",
+        "Message": '{"notificationType": "Received", "braces": "{Message}"}',
+        "Timestamp": "2022-09-01T12:00:00.000Z",
+        "SignatureVersion": "1",
+        "SigningCertURL": cert_url,
+    }
+    json_body.update(fields)
+    keys = ["Message", "MessageId", "Subject", "Timestamp", "TopicArn", "Type"]
+    canonical = "".join(
+        f"{key}\n{json_body[key]}\n" for key in keys if key in json_body
+    )
+    signature = crypto.sign(key, canonical.encode("utf-8"), "sha1")
+    json_body["Signature"] = base64.b64encode(signature).decode()
+    return json_body
 
 
 class GrabKeyfileTest(TestCase):
@@ -15,3 +64,107 @@ class GrabKeyfileTest(TestCase):
         with self.assertRaises(SuspiciousOperation):
             cert_url = "https://attacker.com/cert.pem"
             _grab_keyfile(cert_url)
+
+
+class VerifyFromSnsTest(TestCase):
+    cert_url = "https://sns.us-east-1.amazonaws.com/SimpleNotificationService-test.pem"
+
+    def setUp(self):
+        _signing_certs.clear()
+        self.addCleanup(_signing_certs.clear)
+        _verified.clear()
+        self.addCleanup(_verified.clear)
+        next_year = datetime.now(tz=timezone.utc) + timedelta(days=365)
+        self.key, self.pemfile = make_signing_cert(next_year)
+        patcher = patch("emails.sns._grab_keyfile", return_value=self.pemfile)
+        self.mock_grab_keyfile = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_verified(self):
+        json_body = signed_notification(self.key, self.cert_url)
+        assert verify_from_sns(json_body) == json_body
+
+    def test_verified_with_subject(self):
+        json_body = signed_notification(self.key, self.cert_url, Subject="Hi")
+        assert verify_from_sns(json_body) == json_body
+
+    def test_bad_signature(self):
+        json_body = signed_notification(self.key, self.cert_url)
+        json_body["Message"] += " "
+        with self.assertRaises(crypto.Error):
+            verify_from_sns(json_body)
+
+    def test_cert_loaded_once(self):
+        for message_id in ("first", "second"):
+            json_body = signed_notification(
+                self.key, self.cert_url, MessageId=message_id
+            )
+            verify_from_sns(json_body)
+        self.mock_grab_keyfile.assert_called_once_with(self.cert_url)
+
+    def test_cert_cache_is_bounded(self):
+        for num in range(SIGNING_CERT_CACHE_SIZE + 1):
+            cert_url = self.cert_url.replace("test", f"test{num}")
+            verify_from_sns(signed_notification(self.key, cert_url))
+        assert len(_signing_certs) == SIGNING_CERT_CACHE_SIZE
+        assert self.cert_url.replace("test", "test0") not in _signing_certs
+
+    def test_expired_cert_is_downloaded_again(self):
+        _, expired_pemfile = make_signing_cert(datetime(2021, 1, 1))
+        self.mock_grab_keyfile.side_effect = [expired_pemfile, self.pemfile]
+        caches["default"].set(self.cert_url, expired_pemfile)
+        json_body = signed_notification(self.key, self.cert_url)
+        with self.assertLogs("events", "WARNING"):
+            assert verify_from_sns(json_body) == json_body
+        assert caches["default"].get(self.cert_url) is None
+        assert self.mock_grab_keyfile.call_count == 2
+
+    def test_expired_cert_rejected(self):
+        _, expired_pemfile = make_signing_cert(datetime(2021, 1, 1))
+        self.mock_grab_keyfile.return_value = expired_pemfile
+        json_body = signed_notification(self.key, self.cert_url)
+        with self.assertLogs("events", "WARNING"):
+            with self.assertRaises(ValueError):
+                verify_from_sns(json_body)
+        assert _signing_certs == {}
+
+    def test_verification_cached(self):
+        json_body = signed_notification(self.key, self.cert_url)
+        verify_from_sns(json_body)
+        with patch("emails.sns.crypto.verify") as mock_verify:
+            assert verify_from_sns(dict(json_body)) == json_body
+        mock_verify.assert_not_called()
+
+    def test_verification_cache_checks_content(self):
+        json_body = signed_notification(self.key, self.cert_url)
+        verify_from_sns(json_body)
+        json_body["Message"] += " "
+        with self.assertRaises(crypto.Error):
+            verify_from_sns(json_body)
+
+    def test_verification_cache_expires(self):
+        json_body = signed_notification(self.key, self.cert_url)
+        verify_from_sns(json_body)
+        with patch("emails.sns.time.time", return_value=time.time() + 2 * 60 * 60):
+            with patch("emails.sns.crypto.verify") as mock_verify:
+                verify_from_sns(json_body)
+        mock_verify.assert_called_once()
+
+    def test_verify_batch(self):
+        good = signed_notification(self.key, self.cert_url, MessageId="good")
+        bad = signed_notification(self.key, self.cert_url, MessageId="bad")
+        bad["MessageId"] = "changed"
+        missing = signed_notification(self.key, self.cert_url, MessageId="missing")
+        del missing["Signature"]
+        results = verify_batch_from_sns([good, bad, missing])
+        assert results[0] == good
+        assert isinstance(results[1], crypto.Error)
+        assert isinstance(results[2], KeyError)
+
+    def test_verify_batch_raises_other_errors(self):
+        json_body = signed_notification(self.key, self.cert_url, MessageId="new")
+        with patch(
+            "emails.sns._get_signing_cert", side_effect=OSError("Download failed")
+        ):
+            with self.assertRaises(OSError):
+                verify_batch_from_sns([json_body])
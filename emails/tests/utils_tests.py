@@ -1,4 +1,18 @@
+from email import message_from_bytes, policy
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 from email.utils import parseaddr
+from tempfile import TemporaryDirectory
+import base64
+import io
+import json
+import os
+import random
+import re
+import time
+
+from botocore.exceptions import ClientError
 
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -9,7 +23,17 @@ from waffle.models import Flag
 
 from emails.models import get_domains_from_settings
 from emails.utils import (
+    _build_raw_message,
+    _write_text_base64,
     NEW_FROM_ADDRESS_FLAG_NAME,
+    S3DeleteQueue,
+    TRACKERS,
+    TrackerList,
+    TrackerMatcher,
+    analyze_trackers,
+    convert_domains_to_regex_patterns,
+    count_all_trackers,
+    count_tracker,
     generate_relay_From,
     get_email_domain_from_settings,
     remove_trackers,
@@ -176,8 +200,10 @@ class FormattingToolsTest(TestCase):
 
 
 @override_settings(SITE_ORIGIN="https://test.com")
-@patch("emails.utils.GENERAL_TRACKERS", ["trckr.com", "open.tracker.com"])
-@patch("emails.utils.STRICT_TRACKERS", ["strict.tracker.com"])
+@patch(
+    "emails.utils.TRACKERS",
+    TrackerList(["trckr.com", "open.tracker.com"], ["strict.tracker.com"]),
+)
 class RemoveTrackers(TestCase):
     def setUp(self):
         self.expected_content = (
@@ -275,3 +301,359 @@ class RemoveTrackers(TestCase):
         assert changed_content == content
         assert general_removed == 0
         assert general_count == 0
+
+    def test_analyze_trackers(self):
+        content = (
+            '<a href="https://open.tracker.com/foo/bar.html">A link</a>\n'
+            + '<img src="https://strict.tracker.com/foo/bar.jpg">An image</img>'
+        )
+        analysis = analyze_trackers(content)
+        assert analysis.changed_content == (
+            '<a href="https://test.com/faq">A link</a>\n'
+            + '<img src="https://strict.tracker.com/foo/bar.jpg">An image</img>'
+        )
+        assert analysis.tracker_removed == 1
+        assert analysis.level_one == {
+            "count": 1,
+            "trackers": {"open.tracker.com": 1},
+        }
+        assert analysis.level_two == {
+            "count": 1,
+            "trackers": {"strict.tracker.com": 1},
+        }
+        assert remove_trackers(content, analysis=analysis) == (
+            analysis.changed_content,
+            {"tracker_removed": 1, "level_one": analysis.level_one},
+        )
+
+    def test_analyze_trackers_without_remove(self):
+        content = '<a href="https://open.tracker.com/foo/bar.html">A link</a>'
+        analysis = analyze_trackers(content, remove=False)
+        assert analysis.changed_content == content
+        assert analysis.tracker_removed == 0
+        assert analysis.level_one["count"] == 1
+
+    @patch("emails.utils.incr_if_enabled")
+    def test_count_all_trackers_uses_analysis(self, mock_incr):
+        content = '<a href="https://open.tracker.com/foo/bar.html">A link</a>'
+        analysis = analyze_trackers(content)
+        with patch("emails.utils.TRACKERS.find") as mock_find:
+            count_all_trackers(content, analysis=analysis)
+        mock_find.assert_not_called()
+        mock_incr.assert_any_call("tracker.general_count", 1)
+        mock_incr.assert_any_call("tracker.strict_count", 0)
+
+
+class TrackerMatcherTest(TestCase):
+    def test_finds_trackers_in_content(self):
+        matcher = TrackerMatcher(["trckr.com", "open.tracker.com"])
+        content = "<img src='https://foo.open.tracker.com/bar.jpg'>"
+        assert matcher.find(content) == {"open.tracker.com"}
+
+    def test_finds_no_trackers(self):
+        matcher = TrackerMatcher(["trckr.com", "open.tracker.com"])
+        assert matcher.find("<p>Hello, tracker.com</p>") == set()
+
+    def test_finds_overlapping_trackers(self):
+        matcher = TrackerMatcher(["open.tracker.com", "tracker.com", "er.co"])
+        content = "<img src='https://open.tracker.com/bar.jpg'>"
+        assert matcher.find(content) == {"open.tracker.com", "tracker.com", "er.co"}
+
+    def test_finds_tracker_that_prefixes_another(self):
+        matcher = TrackerMatcher(["maillist-manage.com", "maillist-manage.com.au"])
+        content = "<img src='https://maillist-manage.com.au/bar.jpg'>"
+        assert matcher.find(content) == {
+            "maillist-manage.com",
+            "maillist-manage.com.au",
+        }
+
+    def test_no_trackers(self):
+        assert TrackerMatcher([]).find("<img src='https://trckr.com/'>") == set()
+
+
+@override_settings(SITE_ORIGIN="https://test.com")
+class TrackerMatcherEquivalenceTest(TestCase):
+    """The single-pass matcher gives the same results as a loop over all trackers."""
+
+    def setUp(self):
+        general_trackers = TRACKERS.general
+        strict_trackers = TRACKERS.strict
+        self.content = "\n".join(
+            [
+                "<a href='https://www.%s/click?id=1'>Link</a>" % general_trackers[10],
+                '<img src="https://img.%s/open.gif">' % general_trackers[-1],
+                '<img src="https://%s/pixel.png">' % strict_trackers[5],
+                "<a href='https://maillist-manage.com.au/ua/Open'>Link</a>",
+                "<p>Text about %s that is not a link</p>" % strict_trackers[0],
+                "<a href='https://example.com/?next=%s'>Link</a>" % general_trackers[0],
+            ]
+        )
+
+    def count_with_loop(self, trackers):
+        content = self.content
+        details = {}
+        for tracker in trackers:
+            pattern = convert_domains_to_regex_patterns(tracker)
+            content, count = re.subn(pattern, "", content)
+            if count:
+                details[tracker] = count
+        return {"count": sum(details.values()), "trackers": details}
+
+    def test_count_tracker(self):
+        general_trackers = TRACKERS.general
+        strict_trackers = TRACKERS.strict
+        general_detail = count_tracker(self.content, general_trackers)
+        strict_detail = count_tracker(self.content, strict_trackers)
+        assert general_detail == self.count_with_loop(general_trackers)
+        assert strict_detail == self.count_with_loop(strict_trackers)
+        assert general_detail["count"] == 2
+        assert strict_detail["count"] == 4
+        assert strict_detail["trackers"]["maillist-manage.com"] == 1
+
+    def test_remove_trackers(self):
+        expected_content = self.content
+        for tracker in TRACKERS.general:
+            pattern = convert_domains_to_regex_patterns(tracker)
+            expected_content = re.sub(
+                pattern, r"\g<1>https://test.com/faq\g<1>", expected_content
+            )
+
+        changed_content, tracker_details = remove_trackers(self.content)
+        assert changed_content == expected_content
+        assert tracker_details["tracker_removed"] == 2
+        assert tracker_details["level_one"] == self.count_with_loop(TRACKERS.general)
+
+
+@override_settings(SITE_ORIGIN="https://test.com")
+class TrackerListTest(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.general_path = os.path.join(self.tmpdir.name, "general.json")
+        self.strict_path = os.path.join(self.tmpdir.name, "strict.json")
+        self.write_list(self.general_path, ["trckr.com"])
+        self.write_list(self.strict_path, ["strict.tracker.com"])
+        self.trackers = TrackerList.from_files(
+            self.general_path, self.strict_path, check_seconds=0
+        )
+        self.content = (
+            "<a href='https://trckr.com/a'>A</a>"
+            "<a href='https://open.tracker.com/b'>B</a>"
+            "<img src='https://strict.tracker.com/c.gif'>"
+        )
+
+    def write_list(self, path, trackers, mtime_ns=None):
+        with open(path, "w") as f:
+            json.dump(trackers, f)
+        if mtime_ns:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_count(self):
+        assert self.trackers.count(self.content) == {
+            "count": 1,
+            "trackers": {"trckr.com": 1},
+        }
+        assert self.trackers.count(self.content, level="strict") == {
+            "count": 1,
+            "trackers": {"strict.tracker.com": 1},
+        }
+
+    def test_remove(self):
+        changed_content, removed = self.trackers.remove(self.content)
+        assert removed == 1
+        assert changed_content == (
+            "<a href='https://test.com/faq'>A</a>"
+            "<a href='https://open.tracker.com/b'>B</a>"
+            "<img src='https://strict.tracker.com/c.gif'>"
+        )
+
+    def test_reload_if_changed_unchanged(self):
+        assert not self.trackers.reload_if_changed()
+        assert self.trackers.general == ["trckr.com"]
+
+    def test_reload_if_changed(self):
+        mtime_ns = os.stat(self.general_path).st_mtime_ns + 1_000_000_000
+        self.write_list(self.general_path, ["trckr.com", "open.tracker.com"], mtime_ns)
+        assert self.trackers.reload_if_changed()
+        assert self.trackers.general == ["trckr.com", "open.tracker.com"]
+        assert self.trackers.count(self.content)["count"] == 2
+        assert not self.trackers.reload_if_changed()
+
+    def test_reload_if_changed_invalid_file_keeps_lists(self):
+        mtime_ns = os.stat(self.general_path).st_mtime_ns + 1_000_000_000
+        with open(self.general_path, "w") as f:
+            f.write("not JSON")
+        os.utime(self.general_path, ns=(mtime_ns, mtime_ns))
+        with self.assertLogs("events", "ERROR"):
+            assert not self.trackers.reload_if_changed()
+        assert self.trackers.general == ["trckr.com"]
+        # The failure is only logged once per change
+        assert not self.trackers.reload_if_changed()
+
+    def test_reload_if_changed_throttled(self):
+        trackers = TrackerList.from_files(
+            self.general_path, self.strict_path, check_seconds=60
+        )
+        mtime_ns = os.stat(self.general_path).st_mtime_ns + 1_000_000_000
+        self.write_list(self.general_path, ["trckr.com", "open.tracker.com"], mtime_ns)
+        with patch("emails.utils.os.stat") as mock_stat:
+            assert not trackers.reload_if_changed()
+        mock_stat.assert_not_called()
+        with patch("emails.utils.time.time", return_value=time.time() + 60):
+            assert trackers.reload_if_changed()
+        assert trackers.general == ["trckr.com", "open.tracker.com"]
+
+
+class BuildRawMessageTest(TestCase):
+    def setUp(self):
+        self.args = (
+            "Héllo wörld",
+            '"sender@example.com [via Relay]" <relay@example.com>',
+            "user@example.com",
+            "replies@example.com",
+            {
+                "Text": {"Charset": "UTF-8", "Data": "Hello, wörld\n" * 100},
+                "Html": {"Charset": "UTF-8", "Data": "<p>Hello, wörld</p>" * 100},
+            },
+        )
+        self.attachments = [
+            ("report.pdf", bytes(range(256)) * 1_000),
+            ("ünïcode.txt", b"Some text\n"),
+        ]
+
+    def attachment_files(self):
+        return [(name, io.BytesIO(data)) for name, data in self.attachments]
+
+    def test_same_as_mime_multipart(self):
+        """The raw message is the same as the MIMEMultipart version."""
+        boundaries = iter(["=" * 15 + "1" * 19 + "==", "=" * 15 + "2" * 19 + "=="])
+        with patch("emails.utils._make_mime_boundary", lambda: next(boundaries)):
+            raw_message = _build_raw_message(*self.args, self.attachment_files())
+
+        subject, from_address, to_address, reply_address, message_body = self.args
+        msg = MIMEMultipart("mixed")
+        msg["Subject"] = subject
+        msg["From"] = from_address
+        msg["To"] = to_address
+        msg["Reply-To"] = reply_address
+        msg_body = MIMEMultipart("alternative")
+        for key, subtype in (("Text", "plain"), ("Html", "html")):
+            content = message_body[key]["Data"].encode("UTF-8")
+            msg_body.attach(MIMEText(content, subtype, "UTF-8"))
+        msg.attach(msg_body)
+        for name, data in self.attachments:
+            att = MIMEApplication(data)
+            att.add_header("Content-Disposition", "attachment", filename=name)
+            msg.attach(att)
+        msg.set_boundary("=" * 15 + "1" * 19 + "==")
+        msg_body.set_boundary("=" * 15 + "2" * 19 + "==")
+        assert raw_message == msg.as_string().encode()
+
+    def test_parsed_contents(self):
+        attachment_files = self.attachment_files()
+        raw_message = _build_raw_message(*self.args, attachment_files)
+        assert all(attachment.closed for _, attachment in attachment_files)
+
+        message = message_from_bytes(raw_message, policy=policy.default)
+        assert message["Subject"] == "Héllo wörld"
+        assert message["Reply-To"] == "replies@example.com"
+        body = message.get_body(("plain",))
+        assert body.get_content() == "Hello, wörld\n" * 100
+        attachments = [
+            (part.get_filename(), part.get_content())
+            for part in message.iter_attachments()
+        ]
+        assert attachments == self.attachments
+
+    def test_body_parts(self):
+        """A body can be a list of strings, encoded as if joined."""
+        subject, from_address, to_address, reply_address, message_body = self.args
+        html = message_body["Html"]["Data"]
+        parts_body = {"Html": {"Charset": "UTF-8", "Data": [html[:7], "", html[7:]]}}
+        raw_messages = []
+        for body in ({"Html": message_body["Html"]}, parts_body):
+            random.seed(1)
+            raw_messages.append(
+                _build_raw_message(
+                    subject, from_address, to_address, reply_address, body, []
+                )
+            )
+        assert raw_messages[0] == raw_messages[1]
+
+    def test_write_text_base64_chunks(self):
+        """Multi-byte characters can span encoded chunks."""
+        parts = ["ü" * 50, "€ abc " * 30, "", "🦊" * 40]
+        buffer = io.BytesIO()
+        with patch("emails.utils._BASE64_CHUNK_SIZE", 10):
+            size = _write_text_base64(buffer, parts)
+        content = "".join(parts).encode("utf-8")
+        assert size == len(content)
+        assert buffer.getvalue() == base64.encodebytes(content)
+
+    def test_no_body_or_attachments(self):
+        raw_message = _build_raw_message(*self.args[:4], {}, [])
+        message = message_from_bytes(raw_message, policy=policy.default)
+        assert message.get_content_type() == "multipart/mixed"
+        (body,) = message.get_payload()
+        assert body.get_content_type() == "multipart/alternative"
+        assert list(message.iter_attachments()) == []
+
+
+class S3DeleteQueueTest(TestCase):
+    def setUp(self):
+        patcher = patch("emails.utils.apps.get_app_config")
+        self.s3_client = patcher.start().return_value.s3_client
+        self.s3_client.delete_objects.return_value = {}
+        self.addCleanup(patcher.stop)
+        self.queue = S3DeleteQueue()
+
+    def test_flush_nothing_queued(self):
+        assert self.queue.flush() == {}
+        self.s3_client.delete_objects.assert_not_called()
+
+    def test_flush_by_bucket(self):
+        self.queue.add("bucket1", "key1")
+        self.queue.add("bucket2", "key2")
+        self.queue.add("bucket1", "key3")
+        self.queue.add(None, "key4")
+        assert self.queue.flush() == {"s3_delete_count": 3, "s3_delete_pending": 0}
+        assert self.s3_client.delete_objects.call_count == 2
+        self.s3_client.delete_objects.assert_any_call(
+            Bucket="bucket1",
+            Delete={"Objects": [{"Key": "key1"}, {"Key": "key3"}], "Quiet": True},
+        )
+        assert self.queue.flush() == {}
+
+    def test_full_batch_flushed_on_add(self):
+        self.queue.MAX_KEYS_PER_CALL = 2
+        self.queue.add("bucket", "key1")
+        self.s3_client.delete_objects.assert_not_called()
+        self.queue.add("bucket", "key2")
+        self.s3_client.delete_objects.assert_called_once()
+        assert self.queue.pending == {}
+
+    def test_failed_keys_retried(self):
+        self.queue.add("bucket", "key1")
+        self.queue.add("bucket", "key2")
+        self.s3_client.delete_objects.return_value = {
+            "Errors": [{"Key": "key2", "Code": "InternalError", "Message": "Oops"}]
+        }
+        assert self.queue.flush() == {"s3_delete_count": 1, "s3_delete_pending": 1}
+        with self.assertLogs("events", "ERROR") as logs:
+            assert self.queue.flush() == {"s3_delete_count": 0, "s3_delete_pending": 1}
+            assert self.queue.flush() == {
+                "s3_delete_count": 0,
+                "s3_delete_failed_count": 1,
+                "s3_delete_pending": 0,
+            }
+        assert logs.records[0].getMessage() == "s3_delete_objects_failed"
+
+    def test_client_error_retried(self):
+        self.queue.add("bucket", "key1")
+        self.s3_client.delete_objects.side_effect = [
+            ClientError({"Error": {"Code": "SlowDown"}}, "delete_objects"),
+            {},
+        ]
+        with self.assertLogs("events", "ERROR"):
+            assert self.queue.flush() == {"s3_delete_count": 0, "s3_delete_pending": 1}
+        assert self.queue.flush() == {"s3_delete_count": 1, "s3_delete_pending": 0}
@@ -1,17 +1,23 @@
 from copy import deepcopy
 from datetime import datetime, timezone
+from email import message_from_bytes, policy
 from email.message import EmailMessage
 from unittest.mock import patch, Mock
+import binascii
 import glob
 import io
 import json
 import os
 import re
+import time
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
 from django.http import HttpResponse
 from django.test import override_settings, Client, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.html import escape
 
 from allauth.socialaccount.models import SocialAccount
 from botocore.exceptions import ClientError
@@ -20,21 +26,29 @@ from markus.testing import MetricsMock
 from model_bakery import baker
 import pytest
 
+from emails import alias_cache
+from emails.alias_cache import clear_alias_cache
 from emails.models import (
     address_hash,
     DeletedAddress,
     DomainAddress,
+    increment_counters,
     Profile,
     RelayAddress,
     Reply,
 )
+from emails.utils import EncodedAttachment, _build_raw_message, _write_base64
 from emails.views import (
     _get_address,
     _get_attachment,
+    _get_text_html_attachments,
+    _get_wrapped_email_fragments,
+    _record_html_body_size,
     _record_receipt_verdicts,
     _sns_message,
     _sns_notification,
     validate_sns_arn_and_type,
+    wrap_html_email,
     wrapped_email_test,
     InReplyToNotFound,
 )
@@ -191,6 +205,18 @@ class SNSNotificationTest(TestCase):
         assert self.ra.num_forwarded == 1
         assert self.ra.last_used_at.date() == datetime.today().date()
 
+    @patch("emails.views.S3_DELETE_QUEUE")
+    @patch("emails.views.ses_relay_email")
+    def test_successful_email_relay_message_queued_for_s3_delete(
+        self, mock_ses_relay_email, mock_s3_delete_queue
+    ):
+        mock_ses_relay_email.return_value = HttpResponse("Relayed email", status=200)
+        mock_s3_delete_queue.enabled = True
+        _sns_notification(EMAIL_SNS_BODIES["single_recipient"])
+
+        mock_s3_delete_queue.add.assert_called_once()
+        self.mock_remove_message_from_s3.assert_not_called()
+
     @patch("emails.views.ses_relay_email")
     def test_unsuccessful_email_relay_message_not_removed_from_s3(
         self, mock_ses_relay_email
@@ -718,6 +744,8 @@ class GetAddressTest(TestCase):
     def setUp(self):
         self.service_domain = "test.com"
         self.local_portion = "foo"
+        clear_alias_cache()
+        self.addCleanup(clear_alias_cache)
 
     @patch("emails.views._get_domain_address")
     def test_get_address_with_domain_address(self, _get_domain_address_mocked):
@@ -789,6 +817,153 @@ class GetAddressTest(TestCase):
             assert e.args[0] == "RelayAddress matching query does not exist."
             incr_mocked.assert_called_once_with("email_for_deleted_address_multiple", 1)
 
+    def get_relay_address(self):
+        return _get_address(
+            to_address=f"{self.local_portion}@{self.service_domain}",
+            local_portion=self.local_portion,
+            domain_portion=self.service_domain,
+        )
+
+    def test_get_address_cached_relay_address(self):
+        relay_address = baker.make(RelayAddress, address=self.local_portion)
+        assert self.get_relay_address() == relay_address
+
+        relay_address.enabled = False
+        relay_address.save()
+        with self.assertNumQueries(1):
+            cached = self.get_relay_address()
+        assert cached == relay_address
+        assert not cached.enabled
+
+    def test_get_address_cached_deleted_relay_address(self):
+        relay_address = baker.make(RelayAddress, address=self.local_portion)
+        assert self.get_relay_address() == relay_address
+        relay_address.delete()
+
+        with pytest.raises(RelayAddress.DoesNotExist):
+            self.get_relay_address()
+        with self.assertNumQueries(0), pytest.raises(RelayAddress.DoesNotExist):
+            self.get_relay_address()
+
+    def test_get_address_unknown_relay_address_not_cached(self):
+        with pytest.raises(RelayAddress.DoesNotExist):
+            self.get_relay_address()
+        relay_address = baker.make(RelayAddress, address=self.local_portion)
+        assert self.get_relay_address() == relay_address
+
+    @patch("emails.views.incr_if_enabled")
+    @patch("emails.address_filter.address_is_absent", return_value=True)
+    def test_get_address_absent_from_address_filter(self, absent_mocked, incr_mocked):
+        with self.assertNumQueries(0), pytest.raises(RelayAddress.DoesNotExist):
+            self.get_relay_address()
+        absent_mocked.assert_called_once_with(
+            f"{self.local_portion}@{self.service_domain}"
+        )
+        incr_mocked.assert_called_once_with("email_for_absent_address", 1)
+
+    @override_settings(RELAY_ALIAS_CACHE="default")
+    def test_get_address_shared_cache(self):
+        relay_address = baker.make(RelayAddress, address=self.local_portion)
+        self.addCleanup(
+            alias_cache.invalidate_alias, f"{self.local_portion}@{self.service_domain}"
+        )
+        self.get_relay_address()
+
+        # Another process finds the address in the shared cache
+        clear_alias_cache()
+        with self.assertNumQueries(1):
+            assert self.get_relay_address() == relay_address
+
+    @override_settings(RELAY_ALIAS_CACHE_SECONDS=0)
+    def test_get_address_cache_disabled(self):
+        baker.make(RelayAddress, address=self.local_portion)
+        self.get_relay_address()
+        with self.assertNumQueries(1):
+            self.get_relay_address()
+        assert (
+            alias_cache.get_alias(f"{self.local_portion}@{self.service_domain}") is None
+        )
+
+    def test_get_address_cached_domain_address(self):
+        user = make_premium_test_user()
+        profile = user.profile_set.get()
+        profile.subdomain = "subdomain"
+        profile.save()
+        kwargs = {
+            "to_address": f"{self.local_portion}@subdomain.{self.service_domain}",
+            "local_portion": self.local_portion,
+            "domain_portion": f"subdomain.{self.service_domain}",
+        }
+        domain_address = _get_address(**kwargs)
+        assert domain_address.user == user
+        clear_alias_cache()
+        with CaptureQueriesContext(connection) as uncached_queries:
+            assert _get_address(**kwargs) == domain_address
+        first_used_at = DomainAddress.objects.get(id=domain_address.id).last_used_at
+
+        # The cached address is loaded and saved, without locking the profile
+        with CaptureQueriesContext(connection) as cached_queries:
+            cached = _get_address(**kwargs)
+        assert cached == domain_address
+        assert cached.last_used_at > first_used_at
+        assert len(cached_queries) < len(uncached_queries)
+
+        domain_address.delete()
+        assert alias_cache.get_alias(kwargs["to_address"]) is None
+
+    def test_get_address_cached_domain_address_keeps_counters(self):
+        user = make_premium_test_user()
+        profile = user.profile_set.get()
+        profile.subdomain = "subdomain"
+        profile.save()
+        kwargs = {
+            "to_address": f"{self.local_portion}@subdomain.{self.service_domain}",
+            "local_portion": self.local_portion,
+            "domain_portion": f"subdomain.{self.service_domain}",
+        }
+        domain_address = _get_address(**kwargs)
+        original_filter = DomainAddress.objects.filter
+        loaded = []
+
+        def filter_then_forward(*args, **filter_kwargs):
+            queryset = original_filter(*args, **filter_kwargs)
+            if loaded:
+                return queryset
+            # Another worker forwards an email after the address is loaded
+            loaded.append(queryset.first())
+            increment_counters(domain_address, {"num_forwarded": 1})
+            return Mock(first=Mock(return_value=loaded[0]))
+
+        with patch.object(DomainAddress.objects, "filter", filter_then_forward):
+            cached = _get_address(**kwargs)
+        assert cached.num_forwarded == 0
+        domain_address.refresh_from_db()
+        assert domain_address.num_forwarded == 1
+        assert domain_address.last_used_at == cached.last_used_at
+
+
+@override_settings(STATSD_ENABLED=True)
+class RecordHtmlBodySizeTest(TestCase):
+    def test_size_in_utf8_bytes_like_encoded_stage(self):
+        """Every stage of the HTML body size is in the same unit."""
+        parts = ["<p>", "Grüße, ☃ 日本", "</p>"]
+        html = "".join(parts)
+        with MetricsMock() as mm:
+            _record_html_body_size("wrapped", *parts)
+            _build_raw_message(
+                "Subject",
+                "from@example.com",
+                "to@example.com",
+                "reply@example.com",
+                {"Html": {"Charset": "UTF-8", "Data": parts}},
+                [],
+            )
+        size = len(html.encode("utf-8"))
+        for stage in ("wrapped", "encoded"):
+            mm.assert_histogram(
+                "fx.private.relay.html_body.size", value=size, tags=[f"stage:{stage}"]
+            )
+
 
 class GetAttachmentTests(TestCase):
     def setUp(self):
@@ -865,6 +1040,211 @@ class GetAttachmentTests(TestCase):
         assert name is None
         assert isinstance(stream._file, io.BufferedRandom)
 
+    def test_attachment_content(self):
+        """A base64 attachment is decoded into the stream"""
+        data = bytes(range(256)) * 1_000
+        message = self.create_message(data, "application/octet-stream", "data.bin")
+        name, stream = self.get_name_and_stream(message)
+        stream.seek(0)
+        assert stream.read() == data
+
+    @patch("emails.views.EMAIL_PARSE_CHUNK_SIZE", 1000)
+    def test_attachment_content_in_chunks(self):
+        """A base64 attachment is decoded a chunk of lines at a time"""
+        data = bytes(range(256)) * 100
+        message = self.create_message(data, "application/octet-stream", "data.bin")
+        with patch.object(binascii, "a2b_base64", wraps=binascii.a2b_base64) as a2b:
+            name, stream = self.get_name_and_stream(message)
+        assert a2b.call_count == 38
+        stream.seek(0)
+        assert stream.read() == data
+
+    @patch("emails.views.EMAIL_PARSE_CHUNK_SIZE", 1000)
+    def test_attachment_lines_not_in_groups_of_4(self):
+        """A base64 payload that can not be split into chunks is decoded"""
+        data = bytes(range(256)) * 100
+        message = self.create_message(data, "application/octet-stream", "data.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        encoded = part.get_payload().replace("\n", "")
+        part.set_payload(
+            "".join(
+                encoded[start : start + 75] + "\n"
+                for start in range(0, len(encoded), 75)
+            )
+        )
+        name, stream = _get_attachment(part)
+        self.addCleanup(stream.close)
+        stream.seek(0)
+        assert stream.read() == data
+
+    def test_attachment_padding_in_middle(self):
+        """A base64 payload with padding before the end is decoded like before"""
+        message = self.create_message(b"x", "application/octet-stream", "x.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        part.set_payload("eA==\neA==\n")
+        expected = part.get_payload(decode=True)
+        name, stream = _get_attachment(part)
+        self.addCleanup(stream.close)
+        stream.seek(0)
+        assert stream.read() == expected
+
+    @override_settings(STATSD_ENABLED=True)
+    def test_keep_encoded_attachment(self):
+        """A base64 attachment can be kept encoded, to forward as is"""
+        data = bytes(range(256)) * 1_000
+        message = self.create_message(data, "application/octet-stream", "data.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        with MetricsMock() as mm:
+            name, stream = _get_attachment(part, keep_encoded=True)
+        self.addCleanup(stream.close)
+        assert name == "data.bin"
+        assert isinstance(stream, EncodedAttachment)
+        stream.seek(0)
+        assert stream.read() == part.get_payload().encode()
+        mm.assert_histogram("fx.private.relay.attachment.size", value=len(data))
+
+    def test_keep_encoded_attachment_crlf(self):
+        """An attachment with CRLF line endings is kept with LF line endings"""
+        message = self.create_message(b"A" * 100, "application/octet-stream", "a.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        part.set_payload(part.get_payload().replace("\n", "\r\n").rstrip())
+        name, stream = _get_attachment(part, keep_encoded=True)
+        self.addCleanup(stream.close)
+        stream.seek(0)
+        assert (
+            stream.read() == part.get_payload().replace("\r\n", "\n").encode() + b"\n"
+        )
+
+    def test_keep_encoded_malformed_attachment(self):
+        """A base64 attachment with unexpected characters is decoded"""
+        message = self.create_message(b"A" * 100, "application/octet-stream", "a.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        part.set_payload("*" + part.get_payload())
+        name, stream = _get_attachment(part, keep_encoded=True)
+        self.addCleanup(stream.close)
+        assert not isinstance(stream, EncodedAttachment)
+        stream.seek(0)
+        assert stream.read() == b"A" * 100
+
+    def test_keep_encoded_long_lines(self):
+        """A base64 attachment with lines over 76 characters is decoded"""
+        message = self.create_message(b"A" * 100, "application/octet-stream", "a.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        part.set_payload(part.get_payload().replace("\n", "") + "\n")
+        name, stream = _get_attachment(part, keep_encoded=True)
+        self.addCleanup(stream.close)
+        assert not isinstance(stream, EncodedAttachment)
+        stream.seek(0)
+        assert stream.read() == b"A" * 100
+
+    @patch("emails.views.EMAIL_PARSE_CHUNK_SIZE", 1000)
+    def test_keep_encoded_attachment_in_chunks(self):
+        """A base64 attachment is checked and kept a chunk of lines at a time"""
+        data = bytes(range(256)) * 100
+        message = self.create_message(data, "application/octet-stream", "data.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+        assert part.get_payload().endswith("==\n")
+        name, stream = _get_attachment(part, keep_encoded=True)
+        self.addCleanup(stream.close)
+        assert isinstance(stream, EncodedAttachment)
+        stream.seek(0)
+        assert binascii.a2b_base64(stream.read()) == data
+
+    def test_keep_encoded_attachment_is_cheaper(self):
+        """Keeping an attachment encoded costs less than decoding and encoding it"""
+        data = os.urandom(2 * 1024 * 1024)
+        message = self.create_message(data, "application/octet-stream", "data.bin")
+        part = next(part for part in message.walk() if part.is_attachment())
+
+        def keep_encoded():
+            name, stream = _get_attachment(part, keep_encoded=True)
+            assert isinstance(stream, EncodedAttachment)
+            stream.close()
+
+        def decode_and_encode():
+            name, stream = _get_attachment(part)
+            stream.seek(0)
+            _write_base64(io.BytesIO(), stream)
+            stream.close()
+
+        def cpu_time(function):
+            times = []
+            for _ in range(3):
+                start = time.process_time()
+                function()
+                times.append(time.process_time() - start)
+            return min(times)
+
+        assert cpu_time(keep_encoded) < cpu_time(decode_and_encode)
+
+
+class GetTextHtmlAttachmentsTests(TestCase):
+    def setUp(self):
+        message = EmailMessage()
+        message["Subject"] = "A Test Message"
+        message["From"] = "test sender <sender@example.com>"
+        message["To"] = "test receiver <receiver@example.com>"
+        message.set_content("Hello, world")
+        message.add_alternative("<p>Hello, world</p>", subtype="html")
+        message.add_attachment(
+            b"0123456789" * 20_000,
+            maintype="application",
+            subtype="octet-stream",
+            filename="data.bin",
+        )
+        self.message_bytes = message.as_bytes()
+
+    def check_contents(self, result):
+        text_content, html_content, attachments, email_size = result
+        assert text_content == "Hello, world\n"
+        assert html_content == "<p>Hello, world</p>\n"
+        assert email_size == len(self.message_bytes)
+        assert len(attachments) == 1
+        name, stream = attachments[0]
+        self.addCleanup(stream.close)
+        assert name == "data.bin"
+        stream.seek(0)
+        assert stream.read() == b"0123456789" * 20_000
+
+    @override_settings(RELAY_FORWARD_ENCODED_ATTACHMENTS=False)
+    def test_content_in_message(self):
+        message_json = {"content": self.message_bytes.decode("utf-8")}
+        self.check_contents(_get_text_html_attachments(message_json))
+
+    @override_settings(RELAY_FORWARD_ENCODED_ATTACHMENTS=True)
+    def test_forward_encoded_attachments(self):
+        """Attachments kept encoded are forwarded with the same content"""
+        message_json = {"content": self.message_bytes.decode("utf-8")}
+        _, _, attachments, _ = _get_text_html_attachments(message_json)
+        assert isinstance(attachments[0][1], EncodedAttachment)
+        raw_message = _build_raw_message(
+            "Subject",
+            "from@example.com",
+            "to@example.com",
+            "reply@example.com",
+            {},
+            attachments,
+        )
+        forwarded = message_from_bytes(raw_message, policy=policy.default)
+        assert [
+            (part.get_filename(), part.get_content())
+            for part in forwarded.iter_attachments()
+        ] == [("data.bin", b"0123456789" * 20_000)]
+
+    @override_settings(RELAY_FORWARD_ENCODED_ATTACHMENTS=False)
+    @patch("emails.views.EMAIL_PARSE_CHUNK_SIZE", 1000)
+    @patch("emails.views.get_message_stream_from_s3")
+    def test_content_streamed_from_s3(self, mock_get_stream):
+        chunks = [
+            self.message_bytes[start : start + 1000]
+            for start in range(0, len(self.message_bytes), 1000)
+        ]
+        mock_get_stream.return_value.iter_chunks.return_value = iter(chunks)
+        message_json = EMAIL_SNS_BODIES["s3_stored"]["Message"]
+        self.check_contents(_get_text_html_attachments(json.loads(message_json)))
+        mock_get_stream.return_value.iter_chunks.assert_called_once_with(1000)
+        mock_get_stream.return_value.close.assert_called_once_with()
+
 
 TEST_AWS_SNS_TOPIC = "arn:aws:sns:us-east-1:111222333:relay"
 TEST_AWS_SNS_TOPIC2 = TEST_AWS_SNS_TOPIC + "-alt"
@@ -1046,6 +1426,52 @@ class RecordReceiptVerdictsTests(SimpleTestCase):
         assert mm.get_records() == self.expected_records("a_state", overrides)
 
 
+def fake_wrapped_email_render(template_name, context):
+    """Render the wrapped_email.html values that wrap_html_email substitutes."""
+    return (
+        f"<p>{context['display_email']} {context['num_level_one_email_trackers_removed']}"
+        f" <a href=\"{escape(context['tracker_report_link'])}\">report</a></p>"
+        f"{context['original_html']}<p>{context['language']}</p>"
+    )
+
+
+@patch("emails.views.render_to_string", side_effect=fake_wrapped_email_render)
+def test_wrap_html_email_renders_fragments_once(mock_render):
+    _get_wrapped_email_fragments.cache_clear()
+    args = {
+        "language": "en",
+        "has_premium": False,
+        "in_premium_country": True,
+        "has_attachment": False,
+        "num_level_one_email_trackers_removed": 2,
+        "tracker_report_link": 'https://test.com/tracker-report/#{"a": "<b>"}',
+    }
+    first = wrap_html_email(
+        original_html="<b>First</b>", display_email="one@test.com", **args
+    )
+    second = wrap_html_email(
+        original_html="<i>Second</i>", display_email="two@test.com", **args
+    )
+    mock_render.assert_called_once()
+    assert first == (
+        "<p>one@test.com 2 <a"
+        ' href="https://test.com/tracker-report/#{&quot;a&quot;: &quot;&lt;b&gt;&quot;}"'
+        ">report</a></p><b>First</b><p>en</p>"
+    )
+    assert second == (
+        "<p>two@test.com 2 <a"
+        ' href="https://test.com/tracker-report/#{&quot;a&quot;: &quot;&lt;b&gt;&quot;}"'
+        ">report</a></p><i>Second</i><p>en</p>"
+    )
+
+    wrap_html_email(
+        original_html="<b>Third</b>",
+        display_email="one@test.com",
+        **{**args, "language": "de"},
+    )
+    assert mock_render.call_count == 2
+
+
 @pytest.mark.django_db
 def test_wrapped_email_test_from_profile(rf):
     user = baker.make(User)
@@ -1,13 +1,23 @@
+from collections import namedtuple
 import base64
 import contextlib
+from email import policy
 from email.header import Header
 from email.headerregistry import Address
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+from email.message import Message
 from email.utils import parseaddr
+from functools import lru_cache
+from itertools import chain
+import io
 import json
+import os
+import random
 import re
+import shutil
+import sys
+import threading
+import time
+from tempfile import SpooledTemporaryFile
 
 from botocore.exceptions import ClientError
 from cryptography.hazmat.primitives import hashes
@@ -15,6 +25,7 @@ from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
 import jwcrypto.jwe
 import jwcrypto.jwk
 import markus
+from markus.utils import generate_tag
 import logging
 from waffle.models import Flag
 
@@ -41,9 +52,14 @@ info_logger = logging.getLogger("eventsinfo")
 study_logger = logging.getLogger("studymetrics")
 metrics = markus.get_metrics("fx-private-relay")
 
-with open("emails/tracker_lists/level-one-tracker.json", "r") as f:
+GENERAL_TRACKERS_PATH = "emails/tracker_lists/level-one-tracker.json"
+STRICT_TRACKERS_PATH = "emails/tracker_lists/level-two-tracker.json"
+
+# The tracker lists as loaded at startup. TRACKERS holds them with their
+# compiled patterns, and has the current lists if the files are reloaded.
+with open(GENERAL_TRACKERS_PATH, "r") as f:
     GENERAL_TRACKERS = json.load(f)
-with open("emails/tracker_lists/level-two-tracker.json", "r") as f:
+with open(STRICT_TRACKERS_PATH, "r") as f:
     STRICT_TRACKERS = json.load(f)
 
 
@@ -63,6 +79,63 @@ def time_if_enabled(name):
     return timing_decorator
 
 
+# The stage timings being collected on this thread, see collect_stage_timings
+_stage_timings = threading.local()
+
+
+@contextlib.contextmanager
+def collect_stage_timings():
+    """
+    Collect the times of the email processing stages run on this thread.
+
+    The yielded dict maps the names of the stages run in the block to their
+    total times in seconds, for logging with the processed message.
+    """
+    timings = {}
+    outer_timings = getattr(_stage_timings, "timings", None)
+    _stage_timings.timings = timings
+    try:
+        yield timings
+    finally:
+        _stage_timings.timings = outer_timings
+
+
+@contextlib.contextmanager
+def time_stage(stage):
+    """
+    Time a stage of processing an email.
+
+    The time is sent as the timing email_stage, tagged with the stage, and is
+    added to the stage timings being collected, if any. A stage that runs more
+    than once, such as on a retry, is added up.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if settings.STATSD_ENABLED:
+            metrics.timing(
+                "email_stage", value=elapsed * 1000, tags=[generate_tag("stage", stage)]
+            )
+        timings = getattr(_stage_timings, "timings", None)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def add_stage_timings(stage_timings):
+    """
+    Add stage times collected earlier to the stage timings being collected.
+
+    This is for stages that run before the message is processed, such as
+    verifying the messages of a batch.
+    """
+    timings = getattr(_stage_timings, "timings", None)
+    if timings is not None:
+        for stage, elapsed in stage_timings.items():
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
 def incr_if_enabled(name, value=1, tags=None):
     if settings.STATSD_ENABLED:
         metrics.incr(name, value, tags)
@@ -99,26 +172,27 @@ def ses_send_raw_email(
     address,
 ):
 
-    msg_with_headers = _start_message_with_headers(
-        subject, from_address, to_address, reply_address
-    )
-    msg_with_body = _add_body_to_message(msg_with_headers, message_body)
-    msg_with_attachments = _add_attachments_to_message(msg_with_body, attachments)
+    with time_stage("mime_build"):
+        raw_message = _build_raw_message(
+            subject, from_address, to_address, reply_address, message_body, attachments
+        )
 
     try:
         # Provide the contents of the email.
         emails_config = apps.get_app_config("emails")
-        ses_response = emails_config.ses_client.send_raw_email(
-            Source=from_address,
-            Destinations=[to_address],
-            RawMessage={
-                "Data": msg_with_attachments.as_string(),
-            },
-            ConfigurationSetName=settings.AWS_SES_CONFIGSET,
-        )
+        with time_stage("ses_send"):
+            ses_response = emails_config.ses_client.send_raw_email(
+                Source=from_address,
+                Destinations=[to_address],
+                RawMessage={
+                    "Data": raw_message,
+                },
+                ConfigurationSetName=settings.AWS_SES_CONFIGSET,
+            )
         incr_if_enabled("ses_send_raw_email", 1)
 
-        _store_reply_record(mail, ses_response, address)
+        with time_stage("reply_record"):
+            _store_reply_record(mail, ses_response, address)
     except ClientError as e:
         logger.error("ses_client_error_raw_email", extra=e.response["Error"])
         # 503 service unavailable reponse to SNS so it can retry
@@ -126,54 +200,152 @@ def ses_send_raw_email(
     return HttpResponse("Sent email to final recipient.", status=200)
 
 
-def _start_message_with_headers(subject, from_address, to_address, reply_address):
-    # Create a multipart/mixed parent container.
-    msg = MIMEMultipart("mixed")
-    # Add subject, from and to lines.
-    msg["Subject"] = subject
-    msg["From"] = from_address
-    msg["To"] = to_address
-    msg["Reply-To"] = reply_address
-    return msg
-
-
-def _add_body_to_message(msg, message_body):
-    charset = "UTF-8"
-    # Create a multipart/alternative child container.
-    msg_body = MIMEMultipart("alternative")
-
-    # Encode the text and HTML content and set the character encoding.
-    # This step is necessary if you're sending a message with characters
-    # outside the ASCII range.
-    if "Text" in message_body:
-        body_text = message_body["Text"]["Data"]
-        textpart = MIMEText(body_text.encode(charset), "plain", charset)
-        msg_body.attach(textpart)
-    if "Html" in message_body:
-        body_html = message_body["Html"]["Data"]
-        htmlpart = MIMEText(body_html.encode(charset), "html", charset)
-        msg_body.attach(htmlpart)
-
-    # Attach the multipart/alternative child container to the multipart/mixed
-    # parent container.
-    msg.attach(msg_body)
-    return msg
-
-
-def _add_attachments_to_message(msg, attachments):
-    # attach attachments
+class EncodedAttachment(SpooledTemporaryFile):
+    """
+    An attachment file with base64 encoded content, instead of the decoded content.
+
+    The content is the encoded payload from the inbound email, with "\\n" line
+    endings, so it can be forwarded without decoding and encoding it again.
+    """
+
+
+# Header folding of Message.as_string(), which does not wrap long lines
+_RAW_EMAIL_POLICY = policy.compat32.clone(max_line_length=0)
+# Bytes of attachment read and base64 encoded at a time, a whole number of
+# 57-byte input lines that encode to 76-character output lines
+_BASE64_CHUNK_SIZE = 57 * 1024
+
+
+def _build_raw_message(
+    subject, from_address, to_address, reply_address, message_body, attachments
+):
+    """
+    Build the raw bytes of an email to send with SES.
+
+    The email is a multipart/mixed message, with a multipart/alternative part
+    for the text and HTML bodies, and a part for each attachment. It is
+    written into one buffer a part at a time, and attachments are base64
+    encoded a chunk at a time, instead of building a tree of MIME objects and
+    serializing it to a string. The output is the same as as_string() for the
+    equivalent MIMEMultipart tree. The attachment files are closed.
+
+    The "Data" of a body is a string, or a list of strings that are written
+    in order, so a wrapped body is encoded without joining it into a copy.
+    """
+    buffer = io.BytesIO()
+    mixed_boundary = _make_mime_boundary()
+    _write_mime_headers(
+        buffer,
+        [
+            ("Content-Type", f'multipart/mixed; boundary="{mixed_boundary}"'),
+            ("MIME-Version", "1.0"),
+            ("Subject", subject),
+            ("From", from_address),
+            ("To", to_address),
+            ("Reply-To", reply_address),
+        ],
+    )
+    buffer.write(f"--{mixed_boundary}\n".encode())
+
+    alternative_boundary = _make_mime_boundary()
+    _write_mime_headers(
+        buffer,
+        [
+            (
+                "Content-Type",
+                f'multipart/alternative; boundary="{alternative_boundary}"',
+            ),
+            ("MIME-Version", "1.0"),
+        ],
+    )
+    body_parts = [
+        (subtype, message_body[key]["Data"])
+        for key, subtype in (("Text", "plain"), ("Html", "html"))
+        if key in message_body
+    ]
+    buffer.write(f"--{alternative_boundary}\n".encode())
+    for num, (subtype, content) in enumerate(body_parts):
+        if num:
+            buffer.write(f"\n--{alternative_boundary}\n".encode())
+        _write_mime_headers(
+            buffer,
+            [
+                ("MIME-Version", "1.0"),
+                ("Content-Type", f'text/{subtype}; charset="utf-8"'),
+                ("Content-Transfer-Encoding", "base64"),
+            ],
+        )
+        encoded_size = _write_text_base64(
+            buffer, [content] if isinstance(content, str) else content
+        )
+        if subtype == "html":
+            histogram_if_enabled(
+                "html_body.size", encoded_size, [generate_tag("stage", "encoded")]
+            )
+    buffer.write(f"\n--{alternative_boundary}--\n".encode())
+
     for actual_att_name, attachment in attachments:
-        # Define the attachment part and encode it using MIMEApplication.
+        buffer.write(f"\n--{mixed_boundary}\n".encode())
+        disposition = Message()
+        disposition.add_header(
+            "Content-Disposition", "attachment", filename=actual_att_name
+        )
+        _write_mime_headers(
+            buffer,
+            [
+                ("Content-Type", "application/octet-stream"),
+                ("MIME-Version", "1.0"),
+                ("Content-Transfer-Encoding", "base64"),
+                ("Content-Disposition", disposition["Content-Disposition"]),
+            ],
+        )
         attachment.seek(0)
-        att = MIMEApplication(attachment.read())
-
-        # Add a header to tell the email client to treat this
-        # part as an attachment, and to give the attachment a name.
-        att.add_header("Content-Disposition", "attachment", filename=actual_att_name)
-        # Add the attachment to the parent container.
-        msg.attach(att)
+        if isinstance(attachment, EncodedAttachment):
+            shutil.copyfileobj(attachment, buffer)
+        else:
+            _write_base64(buffer, attachment)
         attachment.close()
-    return msg
+    buffer.write(f"\n--{mixed_boundary}--\n".encode())
+    return buffer.getvalue()
+
+
+def _make_mime_boundary():
+    """Return a random MIME boundary, in the format used by the email package."""
+    return "=" * 15 + "%019d" % random.randrange(sys.maxsize) + "=="
+
+
+def _write_mime_headers(buffer, headers):
+    """Write MIME headers and the blank line after them."""
+    for name, value in headers:
+        buffer.write(_RAW_EMAIL_POLICY.fold(name, value).encode("utf-8"))
+    buffer.write(b"\n")
+
+
+def _write_base64(buffer, source):
+    """Write the content of a binary file as base64 lines."""
+    while chunk := source.read(_BASE64_CHUNK_SIZE):
+        buffer.write(base64.encodebytes(chunk))
+
+
+def _write_text_base64(buffer, parts):
+    """
+    Write strings as the base64 lines of their UTF-8 encoding.
+
+    The strings are encoded a chunk at a time, and the bytes that do not fill
+    a 57-byte line are carried to the next chunk, so the lines are the same as
+    encoding the joined strings at once. Return is the size of the UTF-8 bytes.
+    """
+    size = 0
+    carry = b""
+    for part in parts:
+        for start in range(0, len(part), _BASE64_CHUNK_SIZE):
+            chunk = carry + part[start : start + _BASE64_CHUNK_SIZE].encode("utf-8")
+            size += len(chunk) - len(carry)
+            split = len(chunk) - len(chunk) % 57
+            buffer.write(base64.encodebytes(chunk[:split]))
+            carry = chunk[split:]
+    buffer.write(base64.encodebytes(carry))
+    return size
 
 
 def _store_reply_record(mail, ses_response, address):
@@ -326,14 +498,18 @@ def _get_bucket_and_key_from_s3_json(message_json):
     return bucket, object_key
 
 
-@time_if_enabled("s3_get_message_content")
-def get_message_content_from_s3(bucket, object_key):
+@time_if_enabled("s3_get_message_stream")
+def get_message_stream_from_s3(bucket, object_key):
+    """
+    Return a stream of the email content in S3, or None if not in S3.
+
+    The stream is a botocore StreamingBody, and can be read in chunks with
+    iter_chunks().
+    """
     if bucket and object_key:
         s3_client = apps.get_app_config("emails").s3_client
-        streamed_s3_object = s3_client.get_object(Bucket=bucket, Key=object_key).get(
-            "Body"
-        )
-        return streamed_s3_object.read()
+        return s3_client.get_object(Bucket=bucket, Key=object_key).get("Body")
+    return None
 
 
 @time_if_enabled("s3_remove_message_from")
@@ -353,6 +529,105 @@ def remove_message_from_s3(bucket, object_key):
     return False
 
 
+class S3DeleteQueue:
+    """
+    Collect S3 objects to delete later, in batches.
+
+    When enabled, processed emails are added to the queue instead of deleted
+    right away. flush() deletes them with one delete_objects call per 1000
+    keys, and keeps objects that failed to delete for the next flush, up to
+    MAX_ATTEMPTS tries.
+    """
+
+    MAX_KEYS_PER_CALL = 1000
+    MAX_ATTEMPTS = 3
+
+    def __init__(self):
+        self.enabled = False
+        self.pending = {}  # (bucket, object_key) -> failed attempts
+        self.lock = threading.Lock()
+
+    def add(self, bucket, object_key):
+        """Queue an object to delete, and flush if there is a full batch."""
+        if bucket is None or object_key is None:
+            return
+        with self.lock:
+            self.pending.setdefault((bucket, object_key), 0)
+            full = len(self.pending) >= self.MAX_KEYS_PER_CALL
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Delete the queued objects.
+
+        Return is a dict suitable for logging context, empty if nothing was
+        queued, with these keys:
+        * s3_delete_count: How many objects were deleted
+        * s3_delete_failed_count: How many objects failed for the last time,
+          omitted if 0
+        * s3_delete_pending: How many objects are queued for the next flush
+        """
+        with self.lock:
+            objects, self.pending = self.pending, {}
+        if not objects:
+            return {}
+
+        by_bucket = {}
+        for bucket, object_key in objects:
+            by_bucket.setdefault(bucket, []).append(object_key)
+        deleted_count = 0
+        failed_count = 0
+        retry = {}
+        s3_client = apps.get_app_config("emails").s3_client
+        for bucket, object_keys in by_bucket.items():
+            for start in range(0, len(object_keys), self.MAX_KEYS_PER_CALL):
+                batch = object_keys[start : start + self.MAX_KEYS_PER_CALL]
+                try:
+                    response = s3_client.delete_objects(
+                        Bucket=bucket,
+                        Delete={
+                            "Objects": [{"Key": object_key} for object_key in batch],
+                            "Quiet": True,
+                        },
+                    )
+                    errors = response.get("Errors", [])
+                except ClientError as e:
+                    logger.error(
+                        "s3_client_error_delete_objects", extra=e.response["Error"]
+                    )
+                    errors = [{"Key": object_key} for object_key in batch]
+                deleted_count += len(batch) - len(errors)
+                for error in errors:
+                    attempts = objects[(bucket, error["Key"])] + 1
+                    if attempts < self.MAX_ATTEMPTS:
+                        retry[(bucket, error["Key"])] = attempts
+                        continue
+                    failed_count += 1
+                    logger.error(
+                        "s3_delete_objects_failed",
+                        extra={
+                            "code": error.get("Code", ""),
+                            "error_message": error.get("Message", ""),
+                        },
+                    )
+                    incr_if_enabled("message_not_removed_from_s3", 1)
+
+        with self.lock:
+            for object_id, attempts in retry.items():
+                self.pending.setdefault(object_id, attempts)
+            pending_count = len(self.pending)
+        gauge_if_enabled("s3_delete_pending", pending_count)
+        data = {"s3_delete_count": deleted_count}
+        if failed_count:
+            data["s3_delete_failed_count"] = failed_count
+        data["s3_delete_pending"] = pending_count
+        return data
+
+
+S3_DELETE_QUEUE = S3DeleteQueue()
+
+
 def set_user_group(user):
     if "@" not in user.email:
         return None
@@ -376,22 +651,260 @@ def convert_domains_to_regex_patterns(domain_pattern):
     return r"""(["'])(\S*://(\S*\.)*""" + re.escape(domain_pattern) + r"\S*)\1"
 
 
+def _trie_regex_pattern(words):
+    """
+    Return a regex pattern that matches any of the words.
+
+    The alternatives are nested by common prefix, like a trie, so the regex
+    engine checks a character at a time instead of each word in turn. The
+    longest word is preferred when several match at the same position.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _trie_node_pattern(trie)
+
+
+def _trie_node_pattern(node):
+    branches = [
+        re.escape(char) + _trie_node_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:%s)" % "|".join(branches)
+    if "" in node:
+        pattern = "(?:%s)?" % pattern
+    return pattern
+
+
+class TrackerMatcher:
+    """
+    Find which tracker domains occur in content, in a single scan.
+
+    A tracker pattern from convert_domains_to_regex_patterns can only match if
+    its domain occurs in the content, so the per-tracker patterns only need to
+    run for the domains found by the scan, which is none or a few for most
+    emails.
+    """
+
+    def __init__(self, trackers):
+        domains = set(trackers)
+        self.scan_regex = (
+            re.compile("(?=(%s))" % _trie_regex_pattern(domains)) if domains else None
+        )
+        # The scan finds the longest domain at a position. Any shorter domain
+        # that is a prefix of it also occurs there.
+        self.prefixes = {
+            domain: [other for other in domains if domain.startswith(other)]
+            for domain in domains
+        }
+
+    def find(self, content):
+        """Return the set of tracker domains that occur in the content."""
+        found = set()
+        if self.scan_regex is None:
+            return found
+        for match in self.scan_regex.finditer(content):
+            domain = match.group(1)
+            if domain not in found:
+                found.update(self.prefixes[domain])
+        return found
+
+
+class TrackerList:
+    """
+    The general (level one) and strict (level two) tracker domains.
+
+    The regex pattern for each tracker is compiled once, when the lists are
+    loaded. If the lists were loaded from files, reload_if_changed() loads
+    them again when a file changes, so the lists can be updated without a
+    restart. The files are checked at most every check_seconds.
+    """
+
+    # Check the files for changes at most this often
+    RELOAD_CHECK_SECONDS = 60
+
+    def __init__(self, general, strict, paths=None, check_seconds=None):
+        self.paths = paths
+        self.mtimes = self.get_mtimes()
+        if check_seconds is None:
+            check_seconds = self.RELOAD_CHECK_SECONDS
+        self.check_seconds = check_seconds
+        self.checked_at = time.time()
+        self.set_trackers(general, strict)
+
+    @classmethod
+    def from_files(cls, general_path, strict_path, check_seconds=None):
+        paths = (general_path, strict_path)
+        return cls(*cls.load_files(paths), paths=paths, check_seconds=check_seconds)
+
+    @staticmethod
+    def load_files(paths):
+        lists = []
+        for path in paths:
+            with open(path, "r") as f:
+                lists.append(json.load(f))
+        return lists
+
+    def get_mtimes(self):
+        if not self.paths:
+            return None
+        return tuple(os.stat(path).st_mtime_ns for path in self.paths)
+
+    def set_trackers(self, general, strict):
+        patterns = {
+            tracker: re.compile(convert_domains_to_regex_patterns(tracker))
+            for tracker in chain(general, strict)
+        }
+        matcher = TrackerMatcher(patterns.keys())
+        # Replace the lists in one assignment, for threads using the old ones
+        self.state = (list(general), list(strict), patterns, matcher)
+
+    @property
+    def general(self):
+        return self.state[0]
+
+    @property
+    def strict(self):
+        return self.state[1]
+
+    def reload_if_changed(self):
+        """
+        Reload the lists if the files changed. Return True if reloaded.
+
+        The files are only checked if check_seconds passed since the last
+        check, so the check is not an os.stat() of each file for every email.
+        """
+        if not self.paths:
+            return False
+        now = time.time()
+        if 0 <= now - self.checked_at < self.check_seconds:
+            return False
+        self.checked_at = now
+        try:
+            mtimes = self.get_mtimes()
+            if mtimes == self.mtimes:
+                return False
+            # Don't try again until the files change again
+            self.mtimes = mtimes
+            general, strict = self.load_files(self.paths)
+        except (OSError, ValueError):
+            logger.exception("tracker_list_reload_failed")
+            return False
+        self.set_trackers(general, strict)
+        info_logger.info(
+            "tracker_list_reloaded",
+            extra={"general_count": len(general), "strict_count": len(strict)},
+        )
+        return True
+
+    def find(self, html_content):
+        """
+        Return the general and strict trackers whose domain occurs in the content.
+
+        The lists keep the original order, which decides which tracker gets
+        credit for a URL that matches more than one.
+        """
+        general, strict, _, matcher = self.state
+        found = matcher.find(html_content)
+        return (
+            [tracker for tracker in general if tracker in found],
+            [tracker for tracker in strict if tracker in found],
+        )
+
+    def count(self, html_content, level="general"):
+        """Count the trackers of a level in the content."""
+        general_found, strict_found = self.find(html_content)
+        trackers = general_found if level == "general" else strict_found
+        return self.count_found(html_content, trackers)
+
+    def count_found(self, html_content, trackers):
+        patterns = self.state[2]
+        tracker_total = 0
+        details = {}
+        # html_content needs to be str for count()
+        for tracker in trackers:
+            html_content, count = patterns[tracker].subn("", html_content)
+            if count:
+                tracker_total += count
+                details[tracker] = count
+        return {"count": tracker_total, "trackers": details}
+
+    def remove(self, html_content, level="general"):
+        """
+        Replace the tracker links of a level with a link to the Relay FAQ.
+
+        Return is the changed content and the number of links replaced.
+        """
+        general_found, strict_found = self.find(html_content)
+        trackers = general_found if level == "general" else strict_found
+        return self.remove_found(html_content, trackers)
+
+    def remove_found(self, html_content, trackers):
+        patterns = self.state[2]
+        tracker_removed = 0
+        for tracker in trackers:
+            html_content, matched = patterns[tracker].subn(
+                rf"\g<1>{settings.SITE_ORIGIN}/faq\g<1>", html_content
+            )
+            tracker_removed += matched
+        return html_content, tracker_removed
+
+
+TRACKERS = TrackerList(
+    GENERAL_TRACKERS,
+    STRICT_TRACKERS,
+    paths=(GENERAL_TRACKERS_PATH, STRICT_TRACKERS_PATH),
+)
+
+
+@lru_cache(maxsize=8)
+def _get_tracker_list(trackers):
+    return TrackerList(trackers, [])
+
+
 def count_tracker(html_content, trackers):
-    tracker_total = 0
-    details = {}
-    # html_content needs to be str for count()
-    for tracker in trackers:
-        pattern = convert_domains_to_regex_patterns(tracker)
-        html_content, count = re.subn(pattern, "", html_content)
-        if count:
-            tracker_total += count
-            details[tracker] = count
-    return {"count": tracker_total, "trackers": details}
-
-
-def count_all_trackers(html_content):
-    general_detail = count_tracker(html_content, GENERAL_TRACKERS)
-    strict_detail = count_tracker(html_content, STRICT_TRACKERS)
+    return _get_tracker_list(tuple(trackers)).count(html_content)
+
+
+TrackerAnalysis = namedtuple(
+    "TrackerAnalysis", "level_one level_two changed_content tracker_removed"
+)
+
+
+def analyze_trackers(html_content, level="general", remove=True):
+    """
+    Count the trackers of both levels, and replace the trackers of one level.
+
+    The content is scanned once for all the tracker domains. The counts are
+    dicts with "count" and "trackers" keys, like count_tracker. If remove is
+    False, changed_content is the original content and tracker_removed is 0.
+    """
+    TRACKERS.reload_if_changed()
+    general_found, strict_found = TRACKERS.find(html_content)
+    if remove:
+        trackers = general_found if level == "general" else strict_found
+        changed_content, tracker_removed = TRACKERS.remove_found(html_content, trackers)
+    else:
+        changed_content, tracker_removed = html_content, 0
+    return TrackerAnalysis(
+        level_one=TRACKERS.count_found(html_content, general_found),
+        level_two=TRACKERS.count_found(html_content, strict_found),
+        changed_content=changed_content,
+        tracker_removed=tracker_removed,
+    )
+
+
+def count_all_trackers(html_content, analysis=None):
+    if analysis is None:
+        analysis = analyze_trackers(html_content, remove=False)
+    general_detail = analysis.level_one
+    strict_detail = analysis.level_two
 
     incr_if_enabled("tracker.general_count", general_detail["count"])
     incr_if_enabled("tracker.strict_count", strict_detail["count"])
@@ -401,29 +914,18 @@ def count_all_trackers(html_content):
     )
 
 
-def remove_trackers(html_content, level="general"):
-    trackers = GENERAL_TRACKERS if level == "general" else STRICT_TRACKERS
-    tracker_removed = 0
-    changed_content = html_content
-
-    for tracker in trackers:
-        pattern = convert_domains_to_regex_patterns(tracker)
-        changed_content, matched = re.subn(
-            pattern, rf"\g<1>{settings.SITE_ORIGIN}/faq\g<1>", changed_content
-        )
-        tracker_removed += matched
-
-    level_one_detail = count_tracker(html_content, GENERAL_TRACKERS)
-    level_two_detail = count_tracker(html_content, STRICT_TRACKERS)
+def remove_trackers(html_content, level="general", analysis=None):
+    if analysis is None:
+        analysis = analyze_trackers(html_content, level)
 
     tracker_details = {
-        "tracker_removed": tracker_removed,
-        "level_one": level_one_detail,
+        "tracker_removed": analysis.tracker_removed,
+        "level_one": analysis.level_one,
     }
-    logger_details = {"level": level, "level_two": level_two_detail}
+    logger_details = {"level": level, "level_two": analysis.level_two}
     logger_details.update(tracker_details)
     info_logger.info(
         "email_tracker_summary",
         extra=logger_details,
     )
-    return changed_content, tracker_details
+    return analysis.changed_content, tracker_details
@@ -1,6 +1,9 @@
 from datetime import datetime, timezone
-from email import message_from_bytes, policy
+from email import policy
+from email.feedparser import BytesFeedParser
 from email.utils import parseaddr
+from functools import lru_cache
+import binascii
 import html
 import json
 from json import JSONDecodeError
@@ -30,23 +33,30 @@ from django.template.loader import render_to_string
 from django.utils.html import escape
 from django.views.decorators.csrf import csrf_exempt
 
+from . import address_filter, alias_cache
 from .models import (
     address_hash,
     CannotMakeAddressException,
+    COUNTER_BUFFER,
     get_domain_numerical,
     get_domains_from_settings,
     DeletedAddress,
     DomainAddress,
+    increment_counters,
     Profile,
     RelayAddress,
     Reply,
 )
 from .utils import (
+    S3_DELETE_QUEUE,
     _get_bucket_and_key_from_s3_json,
     b64_lookup_key,
+    analyze_trackers,
     remove_trackers,
     count_all_trackers,
-    get_message_content_from_s3,
+    get_message_stream_from_s3,
+    time_stage,
+    EncodedAttachment,
     incr_if_enabled,
     histogram_if_enabled,
     ses_relay_email,
@@ -64,6 +74,13 @@ from .sns import verify_from_sns, SUPPORTED_SNS_TYPES
 logger = logging.getLogger("events")
 info_logger = logging.getLogger("eventsinfo")
 
+# Size of the chunks when parsing an email and decoding attachments
+EMAIL_PARSE_CHUNK_SIZE = 64 * 1024
+# The characters of a base64 payload that is kept encoded, with LF line endings
+_BASE64_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\n"
+# The longest line of a base64 payload that is kept encoded
+_BASE64_MAX_LINE_LENGTH = 76
+
 
 class InReplyToNotFound(Exception):
     def __init__(self, message="No In-Reply-To header."):
@@ -81,20 +98,113 @@ def wrap_html_email(
     tracker_report_link=0,
 ):
     """Add Relay banners, surveys, etc. to an HTML email"""
-    email_context = {
+    return "".join(
+        wrap_html_email_parts(
+            original_html,
+            language,
+            has_premium,
+            in_premium_country,
+            display_email,
+            has_attachment,
+            num_level_one_email_trackers_removed,
+            tracker_report_link,
+        )
+    )
+
+
+def wrap_html_email_parts(
+    original_html,
+    language,
+    has_premium,
+    in_premium_country,
+    display_email,
+    has_attachment,
+    num_level_one_email_trackers_removed=None,
+    tracker_report_link=0,
+):
+    """
+    Add Relay banners, surveys, etc. to an HTML email, as a list of strings.
+
+    The original HTML is one of the strings, rather than copied into a joined
+    string, and the list can be used as the "Data" of a message body.
+    """
+    fragments = _get_wrapped_email_fragments(
+        language,
+        bool(has_premium),
+        bool(in_premium_country),
+        bool(has_attachment),
+        bool(tracker_report_link),
+        num_level_one_email_trackers_removed,
+        settings.SITE_ORIGIN,
+        settings.RECRUITMENT_EMAIL_BANNER_TEXT,
+        settings.RECRUITMENT_EMAIL_BANNER_LINK,
+    )
+    values = {
         "original_html": original_html,
+        "display_email": display_email,
+        "tracker_report_link": escape(tracker_report_link),
+    }
+    parts = list(fragments)
+    for i in range(1, len(parts), 2):
+        parts[i] = values[parts[i]]
+    return parts
+
+
+# Stand-ins for the per-email values when rendering the wrapper fragments
+_WRAPPED_EMAIL_MARKERS = {
+    name: f"relaywrappedemailmarker{name.replace('_', '')}"
+    for name in ("original_html", "display_email", "tracker_report_link")
+}
+_WRAPPED_EMAIL_MARKER_RE = re.compile(
+    "(" + "|".join(_WRAPPED_EMAIL_MARKERS.values()) + ")"
+)
+
+
+@lru_cache(maxsize=512)
+def _get_wrapped_email_fragments(
+    language,
+    has_premium,
+    in_premium_country,
+    has_attachment,
+    has_tracker_report_link,
+    num_level_one_email_trackers_removed,
+    site_origin,
+    survey_text,
+    survey_link,
+):
+    """
+    Render wrapped_email.html into fragments around the per-email values.
+
+    The template is rendered with markers in place of the original HTML, the
+    display email, and the tracker report link, which are output unchanged
+    or HTML-escaped. Everything else depends only on the arguments, so the
+    banners, header, and footer are rendered and translated once for each
+    combination. The return is a tuple of rendered fragments, with the names
+    of the per-email values at the odd indexes.
+    """
+    email_context = {
+        "original_html": _WRAPPED_EMAIL_MARKERS["original_html"],
         "language": language,
         "has_premium": has_premium,
         "in_premium_country": in_premium_country,
-        "display_email": display_email,
+        "display_email": _WRAPPED_EMAIL_MARKERS["display_email"],
         "has_attachment": has_attachment,
-        "tracker_report_link": tracker_report_link,
+        "tracker_report_link": (
+            _WRAPPED_EMAIL_MARKERS["tracker_report_link"]
+            if has_tracker_report_link
+            else ""
+        ),
         "num_level_one_email_trackers_removed": num_level_one_email_trackers_removed,
-        "SITE_ORIGIN": settings.SITE_ORIGIN,
-        "survey_text": settings.RECRUITMENT_EMAIL_BANNER_TEXT,
-        "survey_link": settings.RECRUITMENT_EMAIL_BANNER_LINK,
+        "SITE_ORIGIN": site_origin,
+        "survey_text": survey_text,
+        "survey_link": survey_link,
     }
-    return render_to_string("emails/wrapped_email.html", email_context)
+    rendered = render_to_string("emails/wrapped_email.html", email_context)
+    names = {marker: name for name, marker in _WRAPPED_EMAIL_MARKERS.items()}
+    fragments = _WRAPPED_EMAIL_MARKER_RE.split(rendered)
+    for i in range(1, len(fragments), 2):
+        fragments[i] = names[fragments[i]]
+    return tuple(fragments)
 
 
 def wrapped_email_test(request):
@@ -196,7 +306,8 @@ def sns_inbound(request):
     incr_if_enabled("sns_inbound", 1)
     # First thing we do is verify the signature
     json_body = json.loads(request.body)
-    verified_json_body = verify_from_sns(json_body)
+    with time_stage("sns_verify"):
+        verified_json_body = verify_from_sns(json_body)
 
     # Validate ARN and message type
     topic_arn = verified_json_body.get("TopicArn", None)
@@ -298,7 +409,10 @@ def _sns_notification(json_body):
     response = _sns_message(message_json)
     bucket, object_key = _get_bucket_and_key_from_s3_json(message_json)
     if response.status_code < 500:
-        remove_message_from_s3(bucket, object_key)
+        if S3_DELETE_QUEUE.enabled:
+            S3_DELETE_QUEUE.add(bucket, object_key)
+        else:
+            remove_message_from_s3(bucket, object_key)
 
     return response
 
@@ -368,9 +482,10 @@ def _sns_message(message_json):
         # FIXME: this ambiguous return of either
         # RelayAddress or DomainAddress types makes the Rustacean in me throw
         # up a bit.
-        address = _get_address(to_address, to_local_portion, to_domain_portion)
-        prefetch_related_objects([address.user], "socialaccount_set", "profile_set")
-        user_profile = address.user.profile_set.get()
+        with time_stage("address_lookup"):
+            address = _get_address(to_address, to_local_portion, to_domain_portion)
+            prefetch_related_objects([address.user], "socialaccount_set", "profile_set")
+            user_profile = address.user.profile_set.get()
     except (
         ObjectDoesNotExist,
         CannotMakeAddressException,
@@ -382,68 +497,69 @@ def _sns_message(message_json):
             response = HttpResponse("Address does not exist", status=404)
         return response
 
-    _record_receipt_verdicts(receipt, "valid_user")
-    # if this is spam and the user is set to auto-block spam, early return
-    if user_profile.auto_block_spam and _get_verdict(receipt, "spam") == "FAIL":
-        incr_if_enabled("email_auto_suppressed_for_spam", 1)
-        return HttpResponse("Address rejects spam.")
-
-    if _get_verdict(receipt, "dmarc") == "FAIL":
-        policy = receipt.get("dmarcPolicy", "none")
-        # TODO: determine action on dmarcPolicy "quarantine"
-        if policy == "reject":
-            incr_if_enabled(
-                "email_suppressed_for_dmarc_failure",
-                1,
-                tags=["dmarcPolicy:reject", "dmarcVerdict:FAIL"],
-            )
-            return HttpResponse("DMARC failure, policy is reject", status=400)
+    with time_stage("profile_checks"):
+        _record_receipt_verdicts(receipt, "valid_user")
+        # if this is spam and the user is set to auto-block spam, early return
+        if user_profile.auto_block_spam and _get_verdict(receipt, "spam") == "FAIL":
+            incr_if_enabled("email_auto_suppressed_for_spam", 1)
+            return HttpResponse("Address rejects spam.")
+
+        if _get_verdict(receipt, "dmarc") == "FAIL":
+            policy = receipt.get("dmarcPolicy", "none")
+            # TODO: determine action on dmarcPolicy "quarantine"
+            if policy == "reject":
+                incr_if_enabled(
+                    "email_suppressed_for_dmarc_failure",
+                    1,
+                    tags=["dmarcPolicy:reject", "dmarcVerdict:FAIL"],
+                )
+                return HttpResponse("DMARC failure, policy is reject", status=400)
 
-    # if this user is over bounce limits, early return
-    bounce_paused, bounce_type = user_profile.check_bounce_pause()
-    if bounce_paused:
-        _record_receipt_verdicts(receipt, "user_bounce_paused")
-        incr_if_enabled("email_suppressed_for_%s_bounce" % bounce_type, 1)
-        return HttpResponse("Address is temporarily disabled.")
+        # if this user is over bounce limits, early return
+        bounce_paused, bounce_type = user_profile.check_bounce_pause()
+        if bounce_paused:
+            _record_receipt_verdicts(receipt, "user_bounce_paused")
+            incr_if_enabled("email_suppressed_for_%s_bounce" % bounce_type, 1)
+            return HttpResponse("Address is temporarily disabled.")
 
-    # check if this is a reply from an external sender to a Relay user
-    try:
-        (lookup_key, encryption_key) = _get_keys_from_headers(mail["headers"])
-        reply_record = _get_reply_record_from_lookup_key(lookup_key)
-        address = reply_record.address
-        # make sure the relay user is premium
-        if not _reply_allowed(from_address, to_address, reply_record):
+        # check if this is a reply from an external sender to a Relay user
+        try:
+            (lookup_key, encryption_key) = _get_keys_from_headers(mail["headers"])
+            reply_record = _get_reply_record_from_lookup_key(lookup_key)
+            address = reply_record.address
+            # make sure the relay user is premium
+            if not _reply_allowed(from_address, to_address, reply_record):
+                # TODO: Add metrics
+                return HttpResponse(
+                    "Relay replies require a premium account", status=403
+                )
+        except (InReplyToNotFound, Reply.DoesNotExist):
+            # if there's no In-Reply-To header, or the In-Reply-To value doesn't
+            # match a Reply record, continue to treat this as a regular email from
+            # an external sender to a relay user
+            pass
+
+        # if account flagged for abuse, early return
+        if user_profile.is_flagged:
+            return HttpResponse("Address is temporarily disabled.")
+
+        # if address is set to block, early return
+        if not address.enabled:
+            incr_if_enabled("email_for_disabled_address", 1)
+            COUNTER_BUFFER.increment(address, {"num_blocked": 1})
+            _record_receipt_verdicts(receipt, "disabled_alias")
             # TODO: Add metrics
-            return HttpResponse("Relay replies require a premium account", status=403)
-    except (InReplyToNotFound, Reply.DoesNotExist):
-        # if there's no In-Reply-To header, or the In-Reply-To value doesn't
-        # match a Reply record, continue to treat this as a regular email from
-        # an external sender to a relay user
-        pass
-
-    # if account flagged for abuse, early return
-    if user_profile.is_flagged:
-        return HttpResponse("Address is temporarily disabled.")
-
-    # if address is set to block, early return
-    if not address.enabled:
-        incr_if_enabled("email_for_disabled_address", 1)
-        address.num_blocked += 1
-        address.save(update_fields=["num_blocked"])
-        _record_receipt_verdicts(receipt, "disabled_alias")
-        # TODO: Add metrics
-        return HttpResponse("Address is temporarily disabled.")
-
-    _record_receipt_verdicts(receipt, "active_alias")
-    incr_if_enabled("email_for_active_address", 1)
-
-    # if address is blocking list emails, and email is from list, early return
-    email_is_from_list = _check_email_from_list(mail["headers"])
-    if address and address.block_list_emails and email_is_from_list:
-        incr_if_enabled("list_email_for_address_blocking_lists", 1)
-        address.num_blocked += 1
-        address.save(update_fields=["num_blocked"])
-        return HttpResponse("Address is not accepting list emails.")
+            return HttpResponse("Address is temporarily disabled.")
+
+        _record_receipt_verdicts(receipt, "active_alias")
+        incr_if_enabled("email_for_active_address", 1)
+
+        # if address is blocking list emails, and email is from list, early return
+        email_is_from_list = _check_email_from_list(mail["headers"])
+        if address and address.block_list_emails and email_is_from_list:
+            incr_if_enabled("list_email_for_address_blocking_lists", 1)
+            COUNTER_BUFFER.increment(address, {"num_blocked": 1})
+            return HttpResponse("Address is not accepting list emails.")
 
     subject = common_headers.get("subject", "")
 
@@ -462,9 +578,9 @@ def _sns_message(message_json):
         # we are returning a 503 so that SNS can retry the email processing
         return HttpResponse("Cannot fetch the message content from S3", status=503)
 
-    # sample tracker numbers
-    if sample_is_active("tracker-sample") and html_content:
-        count_all_trackers(html_content)
+    # sample tracker numbers after removing trackers, to share the analysis
+    sample_trackers = sample_is_active("tracker-sample") and bool(html_content)
+    tracker_analysis = None
 
     # scramble alias so that clients don't recognize it
     # and apply default link styles
@@ -475,13 +591,18 @@ def _sns_message(message_json):
     removed_count = 0
     if html_content:
         incr_if_enabled("email_with_html_content", 1)
+        _record_html_body_size("decoded", html_content)
         tracker_removal_flag = Flag.objects.filter(name="tracker_removal").first()
         tracker_removal_flag_active = (
             tracker_removal_flag
             and tracker_removal_flag.is_active_for_user(address.user)
         )
         if tracker_removal_flag_active and user_profile.remove_level_one_email_trackers:
-            html_content, tracker_details = remove_trackers(html_content)
+            with time_stage("tracker_removal"):
+                tracker_analysis = analyze_trackers(html_content)
+                html_content, tracker_details = remove_trackers(
+                    html_content, analysis=tracker_analysis
+                )
             removed_count = tracker_details["tracker_removed"]
             datetime_now = int(
                 datetime.now(timezone.utc).timestamp() * 1000
@@ -495,23 +616,26 @@ def _sns_message(message_json):
                 f"{settings.SITE_ORIGIN}/tracker-report/#"
                 + json.dumps(tracker_report_details)
             )
-            address.num_level_one_trackers_blocked = (
-                address.num_level_one_trackers_blocked or 0
-            ) + removed_count
-            address.save()
-
-        wrapped_html = wrap_html_email(
-            original_html=html_content,
-            language=user_profile.language,
-            has_premium=user_profile.has_premium,
-            in_premium_country=user_profile.fxa_locale_in_premium_country,
-            display_email=display_email,
-            has_attachment=bool(attachments),
-            tracker_report_link=tracker_report_link,
-            num_level_one_email_trackers_removed=removed_count,
-        )
+            _record_html_body_size("rewritten", html_content)
+
+        with time_stage("html_wrap"):
+            wrapped_html = wrap_html_email_parts(
+                original_html=html_content,
+                language=user_profile.language,
+                has_premium=user_profile.has_premium,
+                in_premium_country=user_profile.fxa_locale_in_premium_country,
+                display_email=display_email,
+                has_attachment=bool(attachments),
+                tracker_report_link=tracker_report_link,
+                num_level_one_email_trackers_removed=removed_count,
+            )
+        _record_html_body_size("wrapped", *wrapped_html)
         message_body["Html"] = {"Charset": "UTF-8", "Data": wrapped_html}
 
+    if sample_trackers:
+        # With tracker removal, the analysis has the counts for the original
+        count_all_trackers(html_content, analysis=tracker_analysis)
+
     if text_content:
         incr_if_enabled("email_with_text_content", 1)
         attachment_msg = (
@@ -542,12 +666,16 @@ def _sns_message(message_json):
         # early return the response to trigger SNS to re-attempt
         return response
 
-    user_profile.update_abuse_metric(
-        email_forwarded=True, forwarded_email_size=email_size
-    )
-    address.num_forwarded += 1
-    address.last_used_at = datetime.now(timezone.utc)
-    address.save(update_fields=["num_forwarded", "last_used_at"])
+    with time_stage("counter_updates"):
+        user_profile.update_abuse_metric(
+            email_forwarded=True, forwarded_email_size=email_size
+        )
+        # One statement for the forwarded and removed tracker counts
+        COUNTER_BUFFER.increment(
+            address,
+            {"num_forwarded": 1, "num_level_one_trackers_blocked": removed_count},
+            last_used_at=datetime.now(timezone.utc),
+        )
     return response
 
 
@@ -715,15 +843,53 @@ def _get_domain_address(local_portion, domain_portion):
                 domain_address = DomainAddress.make_domain_address(
                     locked_profile, local_portion, True
                 )
-            domain_address.last_used_at = datetime.now(timezone.utc)
-            domain_address.save()
+            # Only write the timestamp, not the counters of a loaded row
+            increment_counters(
+                domain_address, {}, last_used_at=datetime.now(timezone.utc)
+            )
+            alias_cache.set_alias(
+                f"{local_portion}@{domain_portion}",
+                alias_cache.DOMAIN,
+                domain_address.id,
+                domain_address.user_id,
+            )
             return domain_address
     except Profile.DoesNotExist as e:
         incr_if_enabled("email_for_dne_subdomain", 1)
         raise e
 
 
+def _get_cached_address(to_address, local_portion):
+    """
+    Return the address from the alias cache, or None if it is not cached.
+
+    Raises RelayAddress.DoesNotExist if the address was deleted.
+    """
+    entry = alias_cache.get_alias(to_address)
+    if entry is None:
+        return None
+    if entry.address_type == alias_cache.DELETED:
+        incr_if_enabled("email_for_deleted_address", 1)
+        raise RelayAddress.DoesNotExist("RelayAddress matching query does not exist.")
+
+    model = DomainAddress if entry.address_type == alias_cache.DOMAIN else RelayAddress
+    address = model.objects.filter(
+        id=entry.id, user_id=entry.user_id, address=local_portion
+    ).first()
+    if address is None:
+        # The address was deleted or replaced since it was cached
+        alias_cache.invalidate_alias(to_address)
+        return None
+    if entry.address_type == alias_cache.DOMAIN:
+        increment_counters(address, {}, last_used_at=datetime.now(timezone.utc))
+    return address
+
+
 def _get_address(to_address, local_portion, domain_portion):
+    address = _get_cached_address(to_address, local_portion)
+    if address is not None:
+        return address
+
     # if the domain is not the site's 'top' relay domain,
     # it may be for a user's subdomain
     email_domains = get_domains_from_settings().values()
@@ -731,11 +897,18 @@ def _get_address(to_address, local_portion, domain_portion):
         return _get_domain_address(local_portion, domain_portion)
 
     # the domain is the site's 'top' relay domain, so look up the RelayAddress
+    if address_filter.address_is_absent(to_address):
+        # Unknown or deleted, without a query to tell which
+        incr_if_enabled("email_for_absent_address", 1)
+        raise RelayAddress.DoesNotExist("RelayAddress matching query does not exist.")
     try:
         domain_numerical = get_domain_numerical(domain_portion)
         relay_address = RelayAddress.objects.get(
             address=local_portion, domain=domain_numerical
         )
+        alias_cache.set_alias(
+            to_address, alias_cache.RELAY, relay_address.id, relay_address.user_id
+        )
         return relay_address
     except RelayAddress.DoesNotExist as e:
         try:
@@ -743,12 +916,16 @@ def _get_address(to_address, local_portion, domain_portion):
                 address_hash=address_hash(local_portion, domain=domain_portion)
             )
             incr_if_enabled("email_for_deleted_address", 1)
+            # Deleted addresses can not be reused, so this never goes stale
+            alias_cache.set_alias(to_address, alias_cache.DELETED)
             # TODO: create a hard bounce receipt rule in SES
         except DeletedAddress.DoesNotExist:
+            # Not cached, since the address could be created at any time
             incr_if_enabled("email_for_unknown_address", 1)
         except DeletedAddress.MultipleObjectsReturned:
             # not sure why this happens on stage but let's handle it
             incr_if_enabled("email_for_deleted_address_multiple", 1)
+            alias_cache.set_alias(to_address, alias_cache.DELETED)
         raise e
 
 
@@ -821,28 +998,93 @@ def _handle_complaint(message_json):
 
 
 def _get_text_html_attachments(message_json):
+    """
+    Get the text and HTML bodies and the attachments of an inbound email.
+
+    The email is fed to the parser in chunks, so the raw bytes are not held in
+    memory next to the parsed email. The parser still keeps the encoded text
+    of every part, so peak memory is about the size of the encoded email, plus
+    a chunk of an attachment being decoded. Attachments are spooled to disk
+    above 150 KB.
+    """
+    parser = BytesFeedParser(policy=policy.default)
+    email_size = 0
     if "content" in message_json:
         # email content in sns message
         message_content = message_json["content"].encode("utf-8")
+        email_size = len(message_content)
+        with time_stage("mime_parse"):
+            parser.feed(message_content)
+        del message_content
     else:
-        # assume email content in S3
+        # assume email content in S3, and parse it as it is downloaded, so
+        # the mime_parse stage includes reading the S3 object
         bucket, object_key = _get_bucket_and_key_from_s3_json(message_json)
-        message_content = get_message_content_from_s3(bucket, object_key)
-    email_size = len(message_content)
+        with time_stage("s3_fetch"):
+            message_stream = get_message_stream_from_s3(bucket, object_key)
+        if message_stream is None:
+            raise ValueError("Email content is not in the message or in S3")
+        with time_stage("mime_parse"):
+            try:
+                for chunk in message_stream.iter_chunks(EMAIL_PARSE_CHUNK_SIZE):
+                    email_size += len(chunk)
+                    parser.feed(chunk)
+            finally:
+                message_stream.close()
     histogram_if_enabled("relayed_email.size", email_size)
-    bytes_email_message = message_from_bytes(message_content, policy=policy.default)
-
-    text_content, html_content, attachments = _get_all_contents(bytes_email_message)
-    # TODO add logs on the entire size of the email and the time it takes to download/process
+    with time_stage("mime_parse"):
+        bytes_email_message = parser.close()
+        text_content, html_content, attachments = _get_all_contents(bytes_email_message)
     return text_content, html_content, attachments, email_size
 
 
-def _get_attachment(part):
+def _get_attachment(part, keep_encoded=False):
+    """
+    Get the filename and content of an attachment part.
+
+    If keep_encoded is True and the payload is well-formed base64, the content
+    is an EncodedAttachment with the original encoded payload, so it can be
+    forwarded without decoding it. Otherwise, it is the decoded content.
+    """
     incr_if_enabled("email_with_attachment", 1)
     fn = part.get_filename()
     ct = part.get_content_type()
-    payload = part.get_payload(decode=True)
-    payload_size = len(payload)
+    encoding = part.get("content-transfer-encoding", "").strip().lower()
+    if keep_encoded and encoding == "base64":
+        attachment = EncodedAttachment(max_size=150 * 1000, prefix="relay_attachment_")
+        payload_size = _copy_base64_to_file(part.get_payload(), attachment)
+        if payload_size is not None:
+            _record_attachment_size(fn, ct, payload_size)
+            return fn, attachment
+        attachment.close()
+
+    attachment = SpooledTemporaryFile(
+        max_size=150 * 1000, prefix="relay_attachment_"  # 150KB max from SES
+    )
+    if encoding != "base64" or not _decode_base64_to_file(
+        part.get_payload(), attachment
+    ):
+        attachment.seek(0)
+        attachment.truncate()
+        attachment.write(part.get_payload(decode=True))
+    _record_attachment_size(fn, ct, attachment.tell())
+    return fn, attachment
+
+
+def _record_html_body_size(stage, *parts):
+    """Record the size in UTF-8 bytes of the HTML body at a processing stage."""
+    if not settings.STATSD_ENABLED:
+        return
+    histogram_if_enabled(
+        "html_body.size",
+        sum(
+            len(part) if part.isascii() else len(part.encode("utf-8")) for part in parts
+        ),
+        [generate_tag("stage", stage)],
+    )
+
+
+def _record_attachment_size(fn, ct, payload_size):
     if fn:
         extension = os.path.splitext(fn)[1]
     else:
@@ -856,11 +1098,94 @@ def _get_attachment(part):
         [attachment_extension_tag, attachment_content_type_tag],
     )
 
-    attachment = SpooledTemporaryFile(
-        max_size=150 * 1000, prefix="relay_attachment_"  # 150KB max from SES
-    )
-    attachment.write(payload)
-    return fn, attachment
+
+def _iter_line_chunks(text, chunk_size):
+    """Yield pieces of text of about chunk_size characters, ending at a line end."""
+    start = 0
+    while start < len(text):
+        if start + chunk_size >= len(text):
+            end = len(text)
+        else:
+            end = text.rfind("\n", start, start + chunk_size) + 1
+            if end <= start:
+                end = text.find("\n", start + chunk_size) + 1 or len(text)
+        yield text[start:end]
+        start = end
+
+
+def _decode_base64_to_file(encoded, output_file):
+    """
+    Decode a base64 payload into a file, a line-aligned chunk at a time.
+
+    This avoids holding a decoded copy of a large attachment in memory. The
+    encoded payload is still in memory, as part of the parsed email. Like
+    get_payload(decode=True), binascii.a2b_base64 skips line endings and other
+    characters that are not base64. Return is False if the payload could not
+    be decoded this way, such as padding before the end, missing padding, or a
+    chunk that is not whole groups of 4 characters. The file then has partial
+    content.
+    """
+    padded = False
+    try:
+        for chunk in _iter_line_chunks(encoded, EMAIL_PARSE_CHUNK_SIZE):
+            if padded and chunk.strip():
+                return False
+            if "=" in chunk:
+                if "=" in chunk.rstrip("=\r\n"):
+                    return False
+                padded = True
+            output_file.write(binascii.a2b_base64(chunk))
+    except ValueError:
+        # binascii.Error, or characters that are not ASCII
+        return False
+    return True
+
+
+def _copy_base64_to_file(encoded, output_file):
+    """
+    Copy a well-formed base64 payload into a file, with LF line endings.
+
+    Well-formed means lines of at most 76 characters of the base64 alphabet,
+    whole groups of 4 characters, and padding only at the end. The payload is
+    checked a line-aligned chunk at a time with bytes methods, without
+    decoding it. Return is the decoded size, or None if the payload is not
+    well-formed. The file then has partial content.
+    """
+    chars = 0
+    padding = 0
+    data = b""
+    for chunk in _iter_line_chunks(encoded, EMAIL_PARSE_CHUNK_SIZE):
+        if padding:
+            return None
+        try:
+            data = chunk.encode("ascii")
+        except UnicodeEncodeError:
+            return None
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+        if data.translate(None, _BASE64_CHARS) or not _has_short_lines(data):
+            return None
+        if b"=" in data:
+            padding = data.count(b"=")
+            if padding > 2 or b"=" in data.rstrip(b"=\n"):
+                return None
+        chars += len(data) - data.count(b"\n")
+        output_file.write(data)
+    if chars % 4:
+        return None
+    if data and not data.endswith(b"\n"):
+        output_file.write(b"\n")
+    return chars // 4 * 3 - padding
+
+
+def _has_short_lines(data):
+    """Return True if no line of the data is longer than _BASE64_MAX_LINE_LENGTH."""
+    # Most encoders write lines of the maximum length, so first check for line
+    # endings at those positions, which means that no line is longer
+    line_ends = data[_BASE64_MAX_LINE_LENGTH :: _BASE64_MAX_LINE_LENGTH + 1]
+    if line_ends.count(b"\n") == len(line_ends):
+        return True
+    return max(map(len, data.split(b"\n"))) <= _BASE64_MAX_LINE_LENGTH
 
 
 def _get_all_contents(email_message):
@@ -871,7 +1196,9 @@ def _get_all_contents(email_message):
         for part in email_message.walk():
             try:
                 if part.is_attachment():
-                    att_name, att = _get_attachment(part)
+                    att_name, att = _get_attachment(
+                        part, settings.RELAY_FORWARD_ENCODED_ATTACHMENTS
+                    )
                     attachments.append((att_name, att))
                     continue
                 if part.get_content_type() == "text/plain":
@@ -167,7 +167,39 @@ AWS_SQS_EMAIL_DLQ_URL = config("AWS_SQS_EMAIL_DLQ_URL", None)
 # Dead-Letter Queue (DLQ) for SNS push subscription
 AWS_SQS_QUEUE_URL = config("AWS_SQS_QUEUE_URL", None)
 
+# Settings for the AWS clients (boto3). The connection pool should be at least
+# as large as the number of threads using a client at the same time.
+AWS_MAX_POOL_CONNECTIONS = config("AWS_MAX_POOL_CONNECTIONS", 50, cast=int)
+AWS_CONNECT_TIMEOUT = config("AWS_CONNECT_TIMEOUT", 5, cast=int)
+AWS_READ_TIMEOUT = config("AWS_READ_TIMEOUT", 60, cast=int)
+AWS_TCP_KEEPALIVE = config("AWS_TCP_KEEPALIVE", True, cast=bool)
+AWS_RETRY_MODE = config("AWS_RETRY_MODE", "adaptive")
+AWS_MAX_ATTEMPTS = config("AWS_MAX_ATTEMPTS", 3, cast=int)
+
 RELAY_FROM_ADDRESS = config("RELAY_FROM_ADDRESS", None)
+# Cache the addresses that inbound emails resolve to, for this many seconds.
+# 0 turns off the cache. RELAY_ALIAS_CACHE names a Django cache, like the Redis
+# cache, to share the entries between processes. Empty is in-process only.
+RELAY_ALIAS_CACHE_SECONDS = config("RELAY_ALIAS_CACHE_SECONDS", 300, cast=int)
+RELAY_ALIAS_CACHE = config("RELAY_ALIAS_CACHE", "")
+# A Bloom filter of the relay addresses, to reject emails for unknown addresses
+# without a query. RELAY_ADDRESS_FILTER_CACHE names a Django cache shared by all
+# processes, like the Redis cache. Empty turns off the filter. Rebuild it more
+# often than the max age with "manage.py rebuild_address_filter".
+RELAY_ADDRESS_FILTER_CACHE = config("RELAY_ADDRESS_FILTER_CACHE", "")
+RELAY_ADDRESS_FILTER_ERROR_RATE = config(
+    "RELAY_ADDRESS_FILTER_ERROR_RATE", 0.01, cast=float
+)
+RELAY_ADDRESS_FILTER_MAX_AGE_SECONDS = config(
+    "RELAY_ADDRESS_FILTER_MAX_AGE_SECONDS", 7200, cast=int
+)
+RELAY_ADDRESS_FILTER_REFRESH_SECONDS = config(
+    "RELAY_ADDRESS_FILTER_REFRESH_SECONDS", 60, cast=int
+)
+# Forward base64 attachments with their original encoding, without decoding them
+RELAY_FORWARD_ENCODED_ATTACHMENTS = config(
+    "RELAY_FORWARD_ENCODED_ATTACHMENTS", True, cast=bool
+)
 NEW_RELAY_FROM_ADDRESS = config("NEW_RELAY_FROM_ADDRESS")
 GOOGLE_ANALYTICS_ID = config("GOOGLE_ANALYTICS_ID", None)
 INTRO_PRICING_END = datetime.fromisoformat(
@@ -750,6 +782,13 @@ SUBSCRIPTIONS_WITH_VPN = config("SUBSCRIPTIONS_WITH_VPN", default="")
 
 MAX_ONBOARDING_AVAILABLE = config("MAX_ONBOARDING_AVAILABLE", 0, cast=int)
 
+# Count the daily abuse metrics in this Django cache, like the Redis cache,
+# instead of AbuseMetrics rows. The counts are saved to AbuseMetrics every
+# RELAY_ABUSE_METRICS_PERSIST_SECONDS. Empty keeps the counts in the rows.
+RELAY_ABUSE_METRICS_CACHE = config("RELAY_ABUSE_METRICS_CACHE", "")
+RELAY_ABUSE_METRICS_PERSIST_SECONDS = config(
+    "RELAY_ABUSE_METRICS_PERSIST_SECONDS", 300, cast=int
+)
 MAX_ADDRESS_CREATION_PER_DAY = config("MAX_ADDRESS_CREATION_PER_DAY", 100, cast=int)
 MAX_REPLIES_PER_DAY = config("MAX_REPLIES_PER_DAY", 100, cast=int)
 MAX_FORWARDED_PER_DAY = config("MAX_FORWARDED_PER_DAY", 1000, cast=int)
@@ -1085,6 +1124,33 @@ PROCESS_EMAIL_HEALTHCHECK_PATH = config(
     "PROCESS_EMAIL_HEALTHCHECK_PATH", os.path.join(TMP_DIR, "healthcheck.json")
 )
 PROCESS_EMAIL_MAX_SECONDS = config("PROCESS_EMAIL_MAX_SECONDS", 0, cast=int) or None
+PROCESS_EMAIL_MAX_WORKERS = config("PROCESS_EMAIL_MAX_WORKERS", 1, cast=int)
+PROCESS_EMAIL_WORKER_PROCESSES = config("PROCESS_EMAIL_WORKER_PROCESSES", 1, cast=int)
+PROCESS_EMAIL_PREFETCH_BATCHES = config("PROCESS_EMAIL_PREFETCH_BATCHES", 0, cast=int)
+PROCESS_EMAIL_QUEUE_REFRESH_SECONDS = config(
+    "PROCESS_EMAIL_QUEUE_REFRESH_SECONDS", 0, cast=int
+)
+PROCESS_EMAIL_BATCH_S3_DELETES = config(
+    "PROCESS_EMAIL_BATCH_S3_DELETES", False, cast=bool
+)
+PROCESS_EMAIL_BUFFER_COUNTERS = config(
+    "PROCESS_EMAIL_BUFFER_COUNTERS", False, cast=bool
+)
+PROCESS_EMAIL_COUNTER_FLUSH_SECONDS = config(
+    "PROCESS_EMAIL_COUNTER_FLUSH_SECONDS", 10, cast=int
+)
+PROCESS_EMAIL_COUNTER_FLUSH_MESSAGES = config(
+    "PROCESS_EMAIL_COUNTER_FLUSH_MESSAGES", 1000, cast=int
+)
+PROCESS_EMAIL_PROFILE = config("PROCESS_EMAIL_PROFILE", False, cast=bool)
+PROCESS_EMAIL_PROFILE_EVERY = config("PROCESS_EMAIL_PROFILE_EVERY", 100, cast=int)
+PROCESS_EMAIL_PROFILE_DIR = config(
+    "PROCESS_EMAIL_PROFILE_DIR", os.path.join(TMP_DIR, "profiles")
+)
+# Settings for manage.py process_emails_from_sqs_async
+PROCESS_EMAIL_ASYNC_MAX_IN_FLIGHT = config(
+    "PROCESS_EMAIL_ASYNC_MAX_IN_FLIGHT", 50, cast=int
+)
 PROCESS_EMAIL_VERBOSITY = config(
     "PROCESS_EMAIL_VERBOSITY", 1, cast=Choices(range(0, 4), cast=int)
 )